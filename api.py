@@ -0,0 +1,225 @@
+"""
+JSON API and event stream routes
+
+Every route here only reads, through engines.READ_SESSION, and answers in
+JSON or a stream rather than a page. init_app() registers them on the
+application under the same endpoint names the statement budgets and
+metrics use.
+"""
+
+import json
+import os
+import threading
+from flask import request, make_response, Response, \
+    stream_with_context, session as login_session
+from database_setup import Item, Want, WantMatch
+from engines import READ_SESSION
+import matching
+import notifications
+import pagination
+import prices
+import projection
+import queries
+import search
+
+# Each open event stream holds a worker thread, so streams are capped per
+# process and end after a while for the browser to reconnect
+EVENT_STREAMS = threading.BoundedSemaphore(
+    int(os.environ.get('TRADING_POST_MAX_STREAMS', 4)))
+STREAM_SECONDS = int(os.environ.get('TRADING_POST_STREAM_SECONDS', 300))
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Columns of a trade match and of its want and item
+MATCH_COLUMNS = ((None, WantMatch, projection.MATCH_FIELDS),
+                 ('want', Want, projection.WANT_FIELDS),
+                 ('item', Item, projection.ITEM_FIELDS))
+
+
+def location_items_json(location_id):
+    """ API endpoint to return items of a given location.
+
+        Paginated the same way as items_json.
+    """
+
+    items = queries.location_items(READ_SESSION, location_id)
+    return items_page(items)
+
+
+def items_json():
+    """ API endpoint to return all items.
+
+        Pages are selected by keyset rather than offset: pass the returned
+        next_cursor back as ?cursor= to fetch the following page. ?limit=
+        sets the page size, ?order= is 'id' (default) or 'newest', and
+        ?format=ndjson streams every remaining item one JSON object per line.
+        ?format=columns returns the page as one list per column, and
+        ?format=msgpack the same packed with MessagePack.
+    """
+
+    return items_page(READ_SESSION.query(Item))
+
+
+def items_page(items):
+    """ Helper function to serve a query of items as JSON.
+
+        Returns either a single keyset page or an NDJSON stream depending
+        on the request arguments.
+    """
+
+    items = projection.select_fields(items)
+    try:
+        order = pagination.parse_order(request.args.get('order'))
+        cursor = pagination.parse_cursor(request.args.get('cursor'), order)
+        if request.args.get('format') == 'ndjson':
+            limit = request.args.get('limit')
+            if limit:
+                limit = pagination.parse_limit(limit)
+            else:
+                limit = None
+            return Response(stream_with_context(
+                pagination.stream_ndjson(items, order, cursor, limit)),
+                            mimetype='application/x-ndjson')
+        limit = pagination.parse_limit(request.args.get('limit'))
+        page_format = projection.parse_format(request.args.get('format'))
+    except (pagination.CursorError, projection.FormatError) as error:
+        response = make_response(json.dumps(str(error)), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    page, next_cursor = pagination.paginate(items, order, cursor, limit)
+    body, mimetype = projection.encode_page(items, page, next_cursor,
+                                            page_format)
+    return Response(body, mimetype=mimetype)
+
+
+def prices_json():
+    """ API endpoint to return a card's daily asking prices.
+
+        ?name= is required; ?cardset= and ?condition= narrow it down, and
+        ?days= sets how many days back to go. Answered from the daily
+        rollups, which `python prices.py` brings up to date.
+    """
+
+    name = request.args.get('name')
+    days = request.args.get('days', prices.DEFAULT_DAYS, type=int)
+    if not name or not 0 < days <= prices.MAX_DAYS:
+        response = make_response(json.dumps(
+            'name and days between 1 and %d are required.' %
+            prices.MAX_DAYS), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    rollups = projection.select_fields(
+        prices.history(READ_SESSION, name,
+                       cardset=request.args.get('cardset'),
+                       condition=request.args.get('condition'),
+                       days=days), projection.ROLLUP_FIELDS)
+    body, mimetype = projection.encode_rows(rollups, rollups.all(), 'prices')
+    return Response(body, mimetype=mimetype)
+
+
+def event_stream():
+    """ Stream new messages and listings as Server-Sent Events
+
+        Signed-in users receive their new messages, and a location_id
+        argument adds new listings at that location.
+    """
+
+    channels = []
+    if 'user_id' in login_session:
+        channels.append(notifications.user_channel(login_session['user_id']))
+    location_id = request.args.get('location_id', type=int)
+    if location_id is not None:
+        channels.append(notifications.location_channel(location_id))
+    if not channels:
+        response = make_response(json.dumps('Nothing to subscribe to.'), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    if not EVENT_STREAMS.acquire(False):
+        response = make_response(json.dumps('Too many open streams.'), 503)
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Retry-After'] = '30'
+        return response
+    subscription = None
+    try:
+        subscription = notifications.BROKER.subscribe(channels)
+        response = Response(notifications.stream(subscription,
+                                                 STREAM_KEEPALIVE_SECONDS,
+                                                 STREAM_SECONDS),
+                            mimetype='text/event-stream')
+        response.call_on_close(subscription.close)
+        response.call_on_close(EVENT_STREAMS.release)
+    except Exception:
+        # The stream never opened, so nothing else gives its slot back
+        if subscription is not None:
+            subscription.close()
+        EVENT_STREAMS.release()
+        raise
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def search_json():
+    """ API endpoint to search items by card name and set.
+
+        Takes q plus optional condition, min_price, max_price, location_id,
+        page and per_page. Results are ranked best match first.
+    """
+
+    try:
+        arguments = search.parse_arguments(request.args)
+    except ValueError:
+        response = make_response(json.dumps('Invalid search parameter'), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    items = projection.select_fields(READ_SESSION.query(Item))
+    rows, has_more = search.search(READ_SESSION, items=items, **arguments)
+    body, mimetype = projection.encode_rows(items, rows, 'items',
+                                            page=arguments['page'],
+                                            has_more=has_more)
+    return Response(body, mimetype=mimetype)
+
+
+def user_matches_json():
+    """ API endpoint to return the items matching the user's wants.
+
+        Oldest match first, paged by keyset like items_json: pass the
+        returned next_cursor back as ?cursor=, and ?limit= sets the page
+        size.
+    """
+
+    if 'email' not in login_session:
+        response = make_response(json.dumps('Current user not connected'), 401)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    try:
+        cursor = pagination.parse_cursor(request.args.get('cursor'), 'id')
+        limit = pagination.parse_limit(request.args.get('limit'))
+    except pagination.CursorError as error:
+        response = make_response(json.dumps(str(error)), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    matches = projection.select_nested(
+        matching.user_matches(READ_SESSION, login_session['user_id'])
+        .join(WantMatch.want).join(WantMatch.item), MATCH_COLUMNS)
+    rows, next_cursor = pagination.paginate(matches, 'id', cursor, limit)
+    body, mimetype = projection.encode_rows(matches, rows, 'matches',
+                                            next_cursor=next_cursor)
+    return Response(body, mimetype=mimetype)
+
+
+# URL rules of the routes above, all answering GET
+ROUTES = [
+    ('/location/<int:location_id>/JSON', location_items_json),
+    ('/items/JSON', items_json),
+    ('/prices/JSON', prices_json),
+    ('/events', event_stream),
+    ('/search/JSON', search_json),
+    ('/user/matches/JSON', user_matches_json),
+]
+
+
+def init_app(app):
+    """ Register the API routes on an application. """
+
+    for rule, view in ROUTES:
+        app.add_url_rule(rule, view.__name__, view)
@@ -0,0 +1,311 @@
+"""
+Archive of sold, stale and deleted items and of idle conversations
+
+Items and messages used to stay in their tables forever, so every page and
+API route reading them got slower as they piled up. Rows that are done with
+are moved into item_archive, reservation_archive and message_archive, which
+only the archive pages read, so the hot tables stay the size of what is
+live:
+
+- sold items, with no copies left, once nothing happened on them for
+  SOLD_DAYS, together with their reservations and conversations
+- stale items nothing happened on for STALE_DAYS
+- deleted items, as they are deleted, with their reservations and
+  conversations
+- conversations idle for MESSAGE_DAYS, with their messages
+
+Something happens on an item when it is added or repriced, reserved, or
+messaged about. Items with a held reservation are never archived.
+
+Each batch of up to ARCHIVE_BATCH_SIZE rows is copied and deleted in its own
+transaction, which also keeps listings, location totals, trade matches and
+unread counters right, so archiving runs while the site is up.
+
+Usage:
+    python archive.py    Archive sold, stale and idle rows
+"""
+
+import datetime
+import os
+import sys
+import time
+from sqlalchemy import event, select, exists, func, and_, or_, case, \
+    literal
+from database_setup import User, Item, Message, Conversation, \
+    ConversationMember, Reservation, WantMatch, PriceEvent, ItemArchive, \
+    ReservationArchive, MessageArchive
+import engines
+import listings
+import pagecache
+
+ITEM = Item.__table__
+MESSAGE = Message.__table__
+CONVERSATION = Conversation.__table__
+MEMBER = ConversationMember.__table__
+RESERVATION = Reservation.__table__
+MATCH = WantMatch.__table__
+EVENT = PriceEvent.__table__
+USER = User.__table__
+ITEM_ARCHIVE = ItemArchive.__table__
+RESERVATION_ARCHIVE = ReservationArchive.__table__
+MESSAGE_ARCHIVE = MessageArchive.__table__
+
+# Days without activity before sold items, stale items and conversations
+# are archived
+SOLD_DAYS = int(os.environ.get('TRADING_POST_ARCHIVE_SOLD_DAYS', 30))
+STALE_DAYS = int(os.environ.get('TRADING_POST_ARCHIVE_STALE_DAYS', 365))
+MESSAGE_DAYS = int(os.environ.get('TRADING_POST_ARCHIVE_MESSAGE_DAYS', 365))
+
+# Items or conversations archived per transaction
+ARCHIVE_BATCH_SIZE = 1000
+
+# Archived rows shown per page, newest first
+PAGE_SIZE = 50
+
+# Columns copied from the live tables into the archive tables
+ITEM_COLUMNS = ('id', 'user_id', 'name', 'cardset', 'condition', 'price',
+                'quantity', 'time_added')
+RESERVATION_COLUMNS = ('id', 'item_id', 'buyer_id', 'quantity', 'time_added',
+                       'expires_at')
+MESSAGE_COLUMNS = ('id', 'sender_id', 'receiver_id', 'item_id', 'message',
+                   'conversation_id', 'time_sent', 'read')
+
+
+def copy_items(connection, item_ids, reason, now):
+    """ Copy items into the archive with the reason they were archived.
+
+    """
+
+    connection.execute(ITEM_ARCHIVE.insert().from_select(
+        list(ITEM_COLUMNS) + ['reason', 'archived_at'],
+        select([ITEM.c[name] for name in ITEM_COLUMNS] +
+               [literal(reason), literal(now)])
+        .where(ITEM.c.id.in_(item_ids))))
+
+
+def move_reservations(connection, item_ids, now):
+    """ Move the reservations of items into the archive.
+
+        Reservations still held are archived as released.
+    """
+
+    where = RESERVATION.c.item_id.in_(item_ids)
+    held = RESERVATION.c.status == 'held'
+    result = connection.execute(RESERVATION_ARCHIVE.insert().from_select(
+        list(RESERVATION_COLUMNS) + ['status', 'time_closed', 'archived_at'],
+        select([RESERVATION.c[name] for name in RESERVATION_COLUMNS] +
+               [case([(held, literal('released'))],
+                     else_=RESERVATION.c.status),
+                func.coalesce(RESERVATION.c.time_closed, literal(now)),
+                literal(now)])
+        .where(where)))
+    if result.rowcount:
+        connection.execute(RESERVATION.delete().where(where))
+
+
+def move_conversations(connection, conversation_ids, now):
+    """ Move conversations' messages into the archive and drop the
+        conversations, taking their unread messages off the unread counts.
+    """
+
+    if not conversation_ids:
+        return
+    messages = MESSAGE.c.conversation_id.in_(conversation_ids)
+    members = MEMBER.c.conversation_id.in_(conversation_ids)
+    connection.execute(MESSAGE_ARCHIVE.insert().from_select(
+        list(MESSAGE_COLUMNS) + ['archived_at'],
+        select([MESSAGE.c[name] for name in MESSAGE_COLUMNS] +
+               [literal(now)]).where(messages)))
+    unread = select([func.sum(MEMBER.c.unread)]) \
+        .where(members).where(MEMBER.c.user_id == USER.c.id).as_scalar()
+    connection.execute(USER.update().where(USER.c.id.in_(
+        select([MEMBER.c.user_id]).where(members)
+        .where(MEMBER.c.unread > 0))).values(
+            unread_count=USER.c.unread_count - unread))
+    connection.execute(MESSAGE.delete().where(messages))
+    connection.execute(MEMBER.delete().where(members))
+    connection.execute(CONVERSATION.delete()
+                       .where(CONVERSATION.c.id.in_(conversation_ids)))
+
+
+def active_since(cutoff):
+    """ Condition that something happened on an item since cutoff, that it
+        is held, or that it is messaged about outside a conversation.
+    """
+
+    return or_(
+        ITEM.c.time_added >= cutoff,
+        exists().where(and_(EVENT.c.item_id == ITEM.c.id,
+                            EVENT.c.recorded_at >= cutoff)),
+        exists().where(and_(RESERVATION.c.item_id == ITEM.c.id,
+                            or_(RESERVATION.c.status == 'held',
+                                RESERVATION.c.time_added >= cutoff,
+                                RESERVATION.c.time_closed >= cutoff))),
+        exists().where(and_(CONVERSATION.c.item_id == ITEM.c.id,
+                            CONVERSATION.c.updated_at >= cutoff)),
+        exists().where(and_(MESSAGE.c.item_id == ITEM.c.id,
+                            MESSAGE.c.conversation_id.is_(None))))
+
+
+def item_conversations(connection, item_ids):
+    """ Ids of the conversations about items. """
+
+    return [row.id for row in connection.execute(
+        select([CONVERSATION.c.id])
+        .where(CONVERSATION.c.item_id.in_(item_ids)))]
+
+
+def move_unthreaded(connection, item_ids, now):
+    """ Move the messages about items that are in no conversation into the
+        archive.
+    """
+
+    where = and_(MESSAGE.c.item_id.in_(item_ids),
+                 MESSAGE.c.conversation_id.is_(None))
+    result = connection.execute(MESSAGE_ARCHIVE.insert().from_select(
+        list(MESSAGE_COLUMNS) + ['archived_at'],
+        select([MESSAGE.c[name] for name in MESSAGE_COLUMNS] +
+               [literal(now)]).where(where)))
+    if result.rowcount:
+        connection.execute(MESSAGE.delete().where(where))
+
+
+def archive_items(connection, item_ids, reason, now):
+    """ Move items, their reservations and conversations into the archive
+        and drop their listings and matches. Returns the locations they
+        were listed at.
+    """
+
+    copy_items(connection, item_ids, reason, now)
+    move_reservations(connection, item_ids, now)
+    move_conversations(connection, item_conversations(connection, item_ids),
+                       now)
+    connection.execute(MATCH.delete().where(MATCH.c.item_id.in_(item_ids)))
+    location_ids = listings.remove(connection,
+                                   listings.LISTING.c.id.in_(item_ids))
+    connection.execute(ITEM.delete().where(ITEM.c.id.in_(item_ids)))
+    return location_ids
+
+
+def item_batch(connection, after, reason, now):
+    """ Archive the next batch of sold or stale items after an item id.
+
+        Returns the ids archived, none once no more are due, and the
+        locations they were listed at.
+    """
+
+    if reason == 'sold':
+        where = and_(ITEM.c.quantity <= 0, ~active_since(
+            now - datetime.timedelta(days=SOLD_DAYS)))
+    else:
+        where = and_(ITEM.c.quantity > 0, ~active_since(
+            now - datetime.timedelta(days=STALE_DAYS)))
+    item_ids = [row.id for row in connection.execute(
+        select([ITEM.c.id]).where(ITEM.c.id > after).where(where)
+        .order_by(ITEM.c.id).limit(ARCHIVE_BATCH_SIZE))]
+    if not item_ids:
+        return item_ids, []
+    return item_ids, archive_items(connection, item_ids, reason, now)
+
+
+def conversation_batch(connection, after, now):
+    """ Archive the next batch of conversations idle for MESSAGE_DAYS.
+
+        Returns the ids archived, none once no more are due.
+    """
+
+    cutoff = now - datetime.timedelta(days=MESSAGE_DAYS)
+    conversation_ids = [row.id for row in connection.execute(
+        select([CONVERSATION.c.id]).where(CONVERSATION.c.id > after)
+        .where(CONVERSATION.c.updated_at < cutoff)
+        .order_by(CONVERSATION.c.id).limit(ARCHIVE_BATCH_SIZE))]
+    move_conversations(connection, conversation_ids, now)
+    return conversation_ids
+
+
+def archive(engine, now=None):
+    """ Archive every idle conversation and sold or stale item.
+
+        Conversations go first, so items only they kept live go in the same
+        run. Each batch commits on its own, and cached public pages of the
+        locations items left are bumped after it. Returns the number of
+        conversations, sold items and stale items archived.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    counts = {'conversations': 0, 'sold': 0, 'stale': 0}
+    after = 0
+    while True:
+        with engine.begin() as connection:
+            conversation_ids = conversation_batch(connection, after, now)
+        if not conversation_ids:
+            break
+        counts['conversations'] += len(conversation_ids)
+        after = conversation_ids[-1]
+    for reason in ('sold', 'stale'):
+        after = 0
+        while True:
+            with engine.begin() as connection:
+                item_ids, location_ids = item_batch(connection, after,
+                                                    reason, now)
+            if not item_ids:
+                break
+            pagecache.bump(*location_ids)
+            counts[reason] += len(item_ids)
+            after = item_ids[-1]
+    return counts
+
+
+# pylint: disable=unused-argument
+@event.listens_for(Item, 'before_delete')
+def item_deleted(mapper, connection, target):
+    """ Archive an item being deleted, with its reservations and the
+        messages about it, before the item row goes.
+    """
+
+    now = datetime.datetime.utcnow()
+    copy_items(connection, [target.id], 'deleted', now)
+    move_reservations(connection, [target.id], now)
+    move_conversations(connection,
+                       item_conversations(connection, [target.id]), now)
+    move_unthreaded(connection, [target.id], now)
+# pylint: enable=unused-argument
+
+
+def user_items(session, user_id, before=None):
+    """ Query of a page of a user's archived items, newest first, before an
+        archive id if one is given.
+    """
+
+    query = session.query(ItemArchive).filter(ItemArchive.user_id == user_id)
+    if before is not None:
+        query = query.filter(ItemArchive.archive_id < before)
+    return query.order_by(ItemArchive.archive_id.desc()).limit(PAGE_SIZE)
+
+
+def user_messages(session, user_id, before=None):
+    """ Query of a page of the archived messages a user sent or received,
+        newest first, before an archive id if one is given.
+    """
+
+    query = session.query(MessageArchive).filter(or_(
+        MessageArchive.receiver_id == user_id,
+        MessageArchive.sender_id == user_id))
+    if before is not None:
+        query = query.filter(MessageArchive.archive_id < before)
+    return query.order_by(MessageArchive.archive_id.desc()).limit(PAGE_SIZE)
+
+
+def main():
+    """ Command line entry point. """
+
+    start = time.time()
+    counts = archive(engines.create(pooled=False))
+    print "Archived %d conversations, %d sold and %d stale items in %.1f s" % (
+        counts['conversations'], counts['sold'], counts['stale'],
+        time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
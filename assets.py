@@ -0,0 +1,280 @@
+"""
+Fingerprinted static assets and compressed responses
+
+Pages link static files through asset_url(), which puts a digest of the
+file's contents in the URL, /assets/<digest>/<filename>. Browsers may then
+cache those URLs for a year without revalidating, since a changed file gets
+a new URL. Files are served precompressed when `python assets.py` has
+written a gzip (.gz) and, with the optional brotli package, a brotli (.br)
+variant next to them.
+
+HTML and JSON responses of at least COMPRESS_MIN_BYTES are compressed with
+brotli or gzip, whichever the client accepts, brotli first. Streamed
+responses are left alone. Responses carrying an ETag, such as the cached
+public pages, are only compressed once per encoding.
+
+Usage:
+    python assets.py    Write the compressed variants of the static files
+"""
+
+import collections
+import hashlib
+import mimetypes
+import os
+import sys
+import threading
+import zlib
+from flask import request, send_file, url_for, abort
+try:
+    import brotli
+except ImportError: # Optional, only needed for brotli encoding
+    brotli = None
+
+# Responses smaller than this many bytes are sent as they are
+COMPRESS_MIN_BYTES = int(os.environ.get('TRADING_POST_COMPRESS_MIN_BYTES',
+                                        1024))
+
+# Content types of the responses compressed on the fly
+COMPRESSIBLE = ('text/html', 'application/json')
+
+# Extensions of the static files given compressed variants
+TEXT_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.json', '.txt')
+
+# Compression levels: quick for responses, best for files compressed once
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+# Extension of the variant file written for each encoding
+VARIANTS = collections.OrderedDict([('br', '.br'), ('gzip', '.gz')])
+
+# Cache-Control of fingerprinted URLs, which never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Compressed bodies of responses with an ETag kept for reuse
+COMPRESSED_CACHE_SIZE = 64
+
+
+def gzip_bytes(data, level=GZIP_LEVEL):
+    """ Compress bytes in gzip format, with no timestamp in the header. """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_bytes(data, quality=BROTLI_QUALITY):
+    """ Compress bytes with brotli. """
+
+    return brotli.compress(data, quality=quality)
+
+
+def encodings():
+    """ Encodings this process can produce, preferred first. """
+
+    return [encoding for encoding in VARIANTS
+            if encoding != 'br' or brotli is not None]
+
+
+def negotiate(available):
+    """ Preferred encoding of those available that the request accepts.
+
+    """
+
+    accepted = request.accept_encodings
+    for encoding in VARIANTS:
+        if encoding in available and accepted[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    """ Compress a response body for an encoding. """
+
+    if encoding == 'br':
+        return brotli_bytes(data)
+    return gzip_bytes(data)
+
+
+class CompressedCache(object): # pylint: disable=too-few-public-methods
+    """ Thread-safe LRU of compressed bodies by ETag and encoding. """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, data, encoding):
+        """ Compressed body for a key, compressing data on a miss. """
+
+        with self.lock:
+            body = self.entries.pop(key, None)
+            if body is not None:
+                self.entries[key] = body
+                return body
+        body = compress(data, encoding)
+        with self.lock:
+            self.entries[key] = body
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return body
+
+
+COMPRESSED = CompressedCache(COMPRESSED_CACHE_SIZE)
+
+
+def compress_response(response):
+    """ Compress an HTML or JSON response if the client accepts it.
+
+        A strong ETag is made weak, since the bytes sent differ from those
+        it was computed over.
+    """
+
+    if response.status_code != 200 or response.direct_passthrough or \
+            response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate(encodings())
+    if encoding is None:
+        return response
+    tag, weak = response.get_etag()
+    if tag is None:
+        body = compress(data, encoding)
+    else:
+        body = COMPRESSED.get((tag, encoding), data, encoding)
+        if not weak:
+            response.set_etag(tag, weak=True)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def static_files(folder):
+    """ Paths of the files under folder, relative to it, leaving out
+        compressed variants and hidden files.
+    """
+
+    for root, directories, names in os.walk(folder):
+        directories[:] = [name for name in directories
+                          if not name.startswith('.')]
+        for name in names:
+            if name.startswith('.') or \
+                    os.path.splitext(name)[1] in VARIANTS.values():
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, folder).replace(os.sep, '/'), path
+
+
+def build_manifest(folder):
+    """ Digest, content type and fresh compressed variants of every
+        static file, by path relative to folder.
+    """
+
+    manifest = {}
+    for filename, path in static_files(folder):
+        with open(path, 'rb') as handle:
+            digest = hashlib.sha1(handle.read()).hexdigest()[:12]
+        modified = os.path.getmtime(path)
+        variants = dict(
+            (encoding, path + extension)
+            for encoding, extension in VARIANTS.items()
+            if os.path.exists(path + extension) and
+            os.path.getmtime(path + extension) >= modified)
+        manifest[filename] = {
+            'path': path,
+            'digest': digest,
+            'mimetype': mimetypes.guess_type(filename)[0] or
+                        'application/octet-stream',
+            'variants': variants
+        }
+    return manifest
+
+
+# Static files of the application, filled by init_app
+MANIFEST = {}
+
+
+def asset_url(filename):
+    """ Fingerprinted URL of a static file, for templates. """
+
+    entry = MANIFEST.get(filename)
+    if entry is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', digest=entry['digest'], filename=filename)
+
+
+def asset(digest, filename):
+    """ Serve a static file, precompressed when a variant exists.
+
+        Current fingerprints are cached for good; a page still linking an
+        older one gets the current file, revalidated each time.
+    """
+
+    entry = MANIFEST.get(filename)
+    if entry is None:
+        abort(404)
+    encoding = negotiate(entry['variants'])
+    path = entry['variants'][encoding] if encoding else entry['path']
+    response = send_file(path, mimetype=entry['mimetype'], conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if digest == entry['digest']:
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def init_app(app):
+    """ Serve an application's static files fingerprinted and compress its
+        responses.
+    """
+
+    MANIFEST.clear()
+    MANIFEST.update(build_manifest(app.static_folder))
+    app.add_url_rule('/assets/<digest>/<path:filename>', 'asset', asset)
+    app.add_template_global(asset_url)
+    app.after_request(compress_response)
+
+
+def write_variants(folder):
+    """ Write the compressed variants of the text files under folder.
+
+        Returns the number of files written.
+    """
+
+    written = 0
+    for filename, path in static_files(folder):
+        if os.path.splitext(filename)[1] not in TEXT_EXTENSIONS:
+            continue
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        for encoding in encodings():
+            if encoding == 'br':
+                body = brotli_bytes(data, STATIC_BROTLI_QUALITY)
+            else:
+                body = gzip_bytes(data, STATIC_GZIP_LEVEL)
+            with open(path + VARIANTS[encoding], 'wb') as handle:
+                handle.write(body)
+            written += 1
+    return written
+
+
+def main():
+    """ Command line entry point. """
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+    print "Wrote %d compressed files" % write_variants(folder)
+    if brotli is None:
+        print "brotli is not installed, only gzip variants were written"
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
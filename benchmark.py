@@ -0,0 +1,248 @@
+"""
+Benchmark every route through the Flask test client
+
+Each route is requested repeatedly as an anonymous visitor and as a signed-in
+user, recording latency percentiles, SQL statements per request and the
+growth in peak memory. Startup is timed too: fresh interpreters import the
+application and call create_app(), as each new mod_wsgi process does, which
+should stay fast and run no SQL. Results can be saved as a JSON baseline and
+later runs compared against it to catch regressions.
+
+Usage:
+    python benchmark.py [--requests N] [--startups N] [--user-id N]
+                        [--save FILE] [--compare FILE] [--tolerance FRACTION]
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from sqlalchemy import func
+from database_setup import User, Location, Item, Message, ConversationMember
+import project
+import queries
+
+
+# Run in a fresh interpreter to time an application start, printing the
+# seconds taken, the statements run and the interpreter's peak memory
+STARTUP_SCRIPT = """
+import json, resource, time
+started = time.time()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute',
+             lambda *args: statements.append(args[2]))
+import project
+project.create_app()
+print json.dumps([time.time() - started, len(statements),
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss])
+"""
+
+
+def percentile(samples, fraction):
+    """ Nearest-rank percentile of a list of numbers. """
+
+    ordered = sorted(samples)
+    index = max(int(round(fraction * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def peak_memory_kb():
+    """ Peak resident set size of this process so far, in kilobytes. """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def sample_ids(session, user_id):
+    """ Pick ids the routes are requested with, taken from the database.
+
+    """
+
+    location_id = session.query(func.min(Location.id)).scalar()
+    item_id = session.query(func.min(Item.id)) \
+        .filter(Item.user_id == user_id).scalar() \
+        or session.query(func.min(Item.id)).scalar()
+    message_id = session.query(func.min(Message.id)) \
+        .filter(Message.receiver_id == user_id).scalar()
+    conversation_id = session.query(
+        func.min(ConversationMember.conversation_id)) \
+        .filter(ConversationMember.user_id == user_id).scalar()
+    return location_id, item_id, message_id, conversation_id
+
+
+def route_urls(session, user_id):
+    """ (name, url, signed in) for every page and API the app serves. """
+
+    location_id, item_id, message_id, conversation_id = \
+        sample_ids(session, user_id)
+    urls = [
+        ('show_main', '/', False),
+        ('show_main', '/', True),
+        ('show_items', '/location/%d/' % location_id, False),
+        ('show_items', '/location/%d/' % location_id, True),
+        ('items_json', '/items/JSON', False),
+        ('items_json newest', '/items/JSON?order=newest', False),
+        ('location_items_json', '/location/%d/JSON' % location_id, False),
+        ('search_json', '/search/JSON?q=lotus', False),
+        ('search_items', '/search?q=lotus', True),
+        ('show_login', '/login', False),
+        ('show_user_items', '/user/items/', True),
+        ('show_user_messages', '/user/messages', True),
+        ('add_item', '/additem', True),
+        ('import_items', '/user/items/import', True),
+        ('export_items', '/user/items/export', True),
+    ]
+    if item_id is not None:
+        urls.extend([
+            ('show_item', '/items/%d' % item_id, True),
+            ('edit_item', '/items/%d/edit' % item_id, True),
+            ('delete_item', '/items/%d/delete' % item_id, True),
+        ])
+    if message_id is not None:
+        urls.extend([
+            ('reply_message', '/messages/%d/reply' % message_id, True),
+            ('delete_message', '/messages/%d/delete' % message_id, True),
+        ])
+    if conversation_id is not None:
+        urls.append(('show_conversation',
+                     '/messages/conversation/%d' % conversation_id, True))
+    return urls
+
+
+def client_for(user, signed_in):
+    """ Test client with or without a signed-in session for user. """
+
+    client = project.APP.test_client()
+    if signed_in:
+        with client.session_transaction() as login_session:
+            login_session['email'] = user.email
+            login_session['user_id'] = user.id
+    return client
+
+
+def measure(client, url, requests):
+    """ Request a URL repeatedly, returning its statistics. """
+
+    latencies = []
+    statements = []
+    memory_before = peak_memory_kb()
+    statuses = set()
+    for _ in xrange(requests):
+        counter = queries.StatementCounter(*project.ENGINES).start()
+        started = time.time()
+        response = client.get(url)
+        response.get_data()
+        latencies.append((time.time() - started) * 1000)
+        counter.stop()
+        statements.append(counter.count)
+        statuses.add(response.status_code)
+    return {
+        'status': sorted(statuses),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'queries': max(statements),
+        'peak_memory_growth_kb': peak_memory_kb() - memory_before
+    }
+
+
+def measure_startup(startups):
+    """ Start the application in fresh interpreters, returning the
+        statistics of its startup time.
+
+        The import time of the interpreter itself is not included.
+    """
+
+    latencies = []
+    statements = []
+    memory = []
+    for _ in xrange(startups):
+        output = subprocess.check_output([sys.executable, '-c',
+                                          STARTUP_SCRIPT])
+        seconds, count, peak_kb = json.loads(output.splitlines()[-1])
+        latencies.append(seconds * 1000)
+        statements.append(count)
+        memory.append(peak_kb)
+    return {
+        'status': [0],
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'queries': max(statements),
+        'peak_memory_growth_kb': max(memory)
+    }
+
+
+def run(requests, user_id):
+    """ Benchmark every route, returning results keyed by route. """
+
+    project.create_app()
+    project.APP.secret_key = project.APP.secret_key or 'benchmark'
+    session = project.DBSESSION()
+    user = session.query(User).filter_by(id=user_id).one()
+    urls = route_urls(session, user_id)
+    results = {}
+    for name, url, signed_in in urls:
+        key = '%s %s' % ('user' if signed_in else 'anon', name)
+        results[key] = measure(client_for(user, signed_in), url, requests)
+    session.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ List routes slower or issuing more queries than the baseline. """
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.3f ms, baseline %.3f ms'
+                               % (key, result['p95_ms'], before['p95_ms']))
+        if result['queries'] > before['queries']:
+            regressions.append('%s: %d queries, baseline %d'
+                               % (key, result['queries'], before['queries']))
+    return regressions
+
+
+def main(argv):
+    """ Command line entry point. """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--startups', type=int, default=10)
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    options = parser.parse_args(argv[1:])
+    results = run(options.requests, options.user_id)
+    if options.startups > 0:
+        results['startup create_app'] = measure_startup(options.startups)
+    print "%-32s %9s %9s %9s %7s %9s" % ('route', 'p50 ms', 'p95 ms',
+                                         'p99 ms', 'queries', 'mem kb')
+    for key, result in sorted(results.items()):
+        print "%-32s %9.3f %9.3f %9.3f %7d %9d" % (
+            key, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['queries'], result['peak_memory_growth_kb'])
+    print "Peak memory %d kb" % peak_memory_kb()
+    if options.save:
+        with open(options.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  options.tolerance)
+        for regression in regressions:
+            print "REGRESSION " + regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,255 @@
+"""
+Bulk import and export of a user's binder
+
+Rows are read from CSV or newline-delimited JSON as a stream, validated a
+batch at a time and inserted with one executemany per batch, committing each
+batch in its own transaction. Rows that fail validation are reported with
+their line number and skipped; the rest of the file still imports.
+
+Usage:
+    python bulk.py import <user_id> <file.csv|file.ndjson>
+    python bulk.py export <user_id> [csv|ndjson]
+"""
+
+import csv
+import datetime
+import decimal
+import json
+import sys
+from sqlalchemy.orm import sessionmaker
+from database_setup import CONDITIONS, User, Item
+import engines
+import listings
+import matching
+import prices
+import projection
+import pagecache
+import pagination
+
+# Rows validated and inserted per transaction
+BATCH_SIZE = 1000
+
+# Rejected rows reported back at most, so a bad file cannot exhaust memory
+MAX_ERRORS = 1000
+
+# Columns read on import and written on export, in export order
+FIELDS = ['name', 'cardset', 'condition', 'price', 'quantity']
+
+
+class ImportReport(object): # pylint: disable=too-few-public-methods
+    """ Outcome of an import: rows inserted and rows rejected.
+
+        errors is a list of (line number, message) pairs.
+    """
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        """ Record a rejected row. """
+
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "errors": [{"line": line, "error": message}
+                       for line, message in self.errors]
+        }
+
+
+def read_csv(stream):
+    """ Yield (line number, row dict) from a CSV stream with a header. """
+
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_ndjson(stream):
+    """ Yield (line number, row dict) from newline-delimited JSON. """
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row
+
+
+def read_rows(stream, file_format):
+    """ Yield (line number, row dict) from a stream in the given format. """
+
+    if file_format == 'csv':
+        return read_csv(stream)
+    if file_format == 'ndjson':
+        return read_ndjson(stream)
+    raise ValueError('Unsupported format: %s' % file_format)
+
+
+def text_field(row, name):
+    """ Required string column, stripped and at most 250 characters. """
+
+    value = row.get(name)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if not isinstance(value, basestring) or not value.strip():
+        raise ValueError('%s is required' % name)
+    value = value.strip()
+    if len(value) > 250:
+        raise ValueError('%s is too long' % name)
+    return value
+
+
+def validate(row, user_id, time_added):
+    """ Turn an input row into an item mapping, raising ValueError. """
+
+    if not isinstance(row, dict):
+        raise ValueError('row is not an object')
+    condition = text_field(row, 'condition')
+    if condition not in CONDITIONS:
+        raise ValueError('unknown condition %r' % condition)
+    try:
+        price = decimal.Decimal(str(row.get('price')).strip())
+    except decimal.InvalidOperation:
+        raise ValueError('price is not a number')
+    if not price.is_finite() or price < 0 or price >= 10 ** 8:
+        raise ValueError('price is out of range')
+    try:
+        quantity = int(row.get('quantity'))
+    except (TypeError, ValueError):
+        raise ValueError('quantity is not an integer')
+    if quantity < 1:
+        raise ValueError('quantity must be at least 1')
+    return {
+        'user_id': user_id,
+        'name': text_field(row, 'name'),
+        'cardset': text_field(row, 'cardset'),
+        'condition': condition,
+        'price': price.quantize(decimal.Decimal('0.01')),
+        'quantity': quantity,
+        'time_added': time_added
+    }
+
+
+def import_items(session, user_id, rows, batch_size=BATCH_SIZE):
+    """ Insert validated rows into a user's binder in batches.
+
+        rows yields (line number, row dict). Each batch is inserted with a
+        single executemany and committed on its own, so a failure part way
+        through keeps the batches before it.
+    """
+
+    report = ImportReport()
+    time_added = datetime.datetime.utcnow()
+    batch = []
+    for line, row in rows:
+        try:
+            batch.append(validate(row, user_id, time_added))
+        except ValueError as error:
+            report.reject(line, str(error))
+            continue
+        if len(batch) >= batch_size:
+            insert_batch(session, user_id, batch, report)
+            batch = []
+    if batch:
+        insert_batch(session, user_id, batch, report)
+    return report
+
+
+def insert_batch(session, user_id, batch, report):
+    """ Insert one batch of item mappings in its own transaction.
+
+        bulk_insert_mappings skips the mapper events, so the batch is
+        listed at the user's location explicitly.
+    """
+
+    session.bulk_insert_mappings(Item, batch)
+    listings.add_user_items(session.connection(), user_id)
+    prices.record_added(session.connection(), Item.user_id == user_id)
+    matching.refresh_items(session.connection(), Item.user_id == user_id)
+    session.commit()
+    report.inserted += len(batch)
+
+
+def export_csv(session, user_id):
+    """ Yield a user's binder as CSV, header first. """
+
+    yield ','.join(FIELDS) + '\r\n'
+    rows = projection.select_fields(
+        session.query(Item).filter_by(user_id=user_id), FIELDS)
+    for row in rows.order_by(Item.id).yield_per(pagination.STREAM_BATCH_SIZE):
+        yield csv_line(row)
+
+
+def csv_line(values):
+    """ Format one CSV record. """
+
+    cells = []
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value)
+        if any(char in value for char in ',"\r\n'):
+            value = '"%s"' % value.replace('"', '""')
+        cells.append(value)
+    return ','.join(cells) + '\r\n'
+
+
+def export_ndjson(session, user_id):
+    """ Yield a user's binder as newline-delimited JSON. """
+
+    return pagination.stream_ndjson(projection.select_fields(
+        session.query(Item).filter_by(user_id=user_id)), 'id')
+
+
+def export_items(session, user_id, file_format):
+    """ Yield a user's binder in the given format. """
+
+    if file_format == 'csv':
+        return export_csv(session, user_id)
+    if file_format == 'ndjson':
+        return export_ndjson(session, user_id)
+    raise ValueError('Unsupported format: %s' % file_format)
+
+
+def main(argv):
+    """ Command line entry point. """
+
+    if len(argv) < 3 or argv[1] not in ('import', 'export'):
+        print __doc__
+        return 1
+    session = sessionmaker(bind=engines.create(pooled=False))()
+    user_id = int(argv[2])
+    if argv[1] == 'import':
+        path = argv[3]
+        file_format = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) \
+            else 'csv'
+        with open(path, 'rb') as stream:
+            report = import_items(session, user_id,
+                                  read_rows(stream, file_format))
+        pagecache.bump(session.query(User).get(user_id).location_id)
+        print "Inserted %d items, rejected %d rows" % (
+            report.inserted, report.rejected)
+        for line, message in report.errors:
+            print "line %d: %s" % (line, message)
+    else:
+        file_format = argv[3] if len(argv) > 3 else 'csv'
+        for chunk in export_items(session, user_id, file_format):
+            sys.stdout.write(chunk)
+    session.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,350 @@
+"""
+Small key/value caches shared by the application
+
+Two interchangeable backends are provided. MemoryBackend lives inside one
+process; SqliteBackend keeps entries in a SQLite file so every worker process
+on the host sees the same values and invalidations, standing in for a shared
+store such as Redis.
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from database_setup import Location, User
+import queries
+
+# Location list as handed to templates, detached from any session
+CachedLocation = collections.namedtuple('CachedLocation', ['id', 'name'])
+
+# Signed-in user as seen by routes, detached from any session
+CachedUser = collections.namedtuple('CachedUser',
+                                    ['id', 'email', 'location_id'])
+
+
+class MemoryBackend(object):
+    """ Thread-safe in-process store with per-entry expiry. """
+
+    # Other processes neither see these entries nor their invalidations
+    shared = False
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the value stored under key, or None if absent or expired.
+
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store value under key, expiring after ttl seconds if given. """
+
+        expires_at = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+
+    def delete(self, key):
+        """ Remove key if present. """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def incr(self, key):
+        """ Atomically increment an integer counter, returning the new value.
+
+        """
+
+        with self.lock:
+            value = self.entries.get(key, (0, None))[0] + 1
+            self.entries[key] = (value, None)
+            return value
+
+
+class SqliteFile(object): # pylint: disable=too-few-public-methods
+    """ Per-thread connections to a SQLite file shared between processes.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        """ Return this thread's connection to the file. """
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self.local.connection = connection
+        return connection
+
+
+class SqliteBackend(SqliteFile):
+    """ Store shared between processes through a SQLite file.
+
+        Values must be JSON serializable.
+    """
+
+    # Every process on the host sees the same entries
+    shared = True
+
+    def __init__(self, path):
+        SqliteFile.__init__(self, path)
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+
+    def get(self, key):
+        """ Return the value stored under key, or None if absent or expired.
+
+        """
+
+        row = self.connect().execute(
+            'SELECT value, expires_at FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """ Store value under key, expiring after ttl seconds if given. """
+
+        expires_at = time.time() + ttl if ttl else None
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) '
+                'VALUES (?, ?, ?)', (key, json.dumps(value), expires_at))
+
+    def delete(self, key):
+        """ Remove key if present. """
+
+        with self.connect() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def incr(self, key):
+        """ Atomically increment an integer counter, returning the new value.
+
+        """
+
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires_at) '
+                'VALUES (?, 0, NULL)', (key,))
+            connection.execute(
+                'UPDATE cache SET value = value + 1 WHERE key = ?', (key,))
+            row = connection.execute(
+                'SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        return int(row[0])
+
+
+def backend_from_url(url):
+    """ Build a backend from a URL such as memory:// or sqlite:///path.
+
+    """
+
+    if not url or url == 'memory://':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SqliteBackend(url[len('sqlite:///'):])
+    raise ValueError('Unsupported cache URL: %s' % url)
+
+
+# Backend shared by the caches in this process
+BACKEND = backend_from_url(os.environ.get('TRADING_POST_CACHE_URL'))
+
+
+class LocationCache(object):
+    """ Sorted location list kept in a cache backend.
+
+        Entries expire after ttl seconds and are dropped as soon as a
+        transaction writing Location rows commits.
+    """
+
+    key = 'locations'
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, session):
+        """ Return the locations, loading them with session on a miss.
+
+        """
+
+        rows = self.backend.get(self.key)
+        if rows is None:
+            rows = [[location.id, location.name]
+                    for location in queries.locations(session)]
+            self.backend.set(self.key, rows, self.ttl)
+        return [CachedLocation(*row) for row in rows]
+
+    def find(self, session, location_id):
+        """ Return the location with an id, or None if there is none. """
+
+        for location in self.get(session):
+            if location.id == location_id:
+                return location
+        return None
+
+    def invalidate(self):
+        """ Drop the cached list so the next read reloads it. """
+
+        self.backend.delete(self.key)
+        self.backend.incr(self.key + ':version')
+
+    def version(self):
+        """ Counter bumped on every invalidation, for caches built on top.
+
+        """
+
+        return self.backend.get(self.key + ':version') or 0
+
+
+LOCATIONS = LocationCache(
+    BACKEND, int(os.environ.get('TRADING_POST_LOCATION_TTL', 300)))
+
+
+@event.listens_for(Location, 'after_insert')
+@event.listens_for(Location, 'after_update')
+@event.listens_for(Location, 'after_delete')
+def location_written(mapper, connection, target): # pylint: disable=unused-argument
+    """ Note on the session that its transaction changed locations. """
+
+    object_session(target).info['locations_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_locations(session):
+    """ Invalidate the location cache once location changes are committed.
+
+    """
+
+    if session.info.pop('locations_changed', False):
+        LOCATIONS.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_location_changes(session):
+    """ Rolled back location writes leave the cache valid. """
+
+    session.info.pop('locations_changed', None)
+
+
+class UserCache(object):
+    """ Bounded least recently used cache of user records in this process.
+
+        Each record is kept with the user's version in the backend when it
+        was loaded. Committing a write to a user bumps that version, so
+        every process sharing the backend reloads the record on its next
+        read. Records are also reloaded once they are ttl seconds old,
+        which bounds how long processes that cannot see the bump, such as
+        with a per-process backend, serve the old record.
+    """
+
+    def __init__(self, backend, size, ttl):
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def version_key(user_id):
+        """ Backend key holding a user's version. """
+
+        return 'users:version:%d' % user_id
+
+    def get(self, session, user_id):
+        """ Return a user's record, loading it with session on a miss.
+
+            Returns None if there is no such user.
+        """
+
+        version = self.backend.get(self.version_key(user_id)) or 0
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(user_id, None)
+            if entry is not None and entry[0] == version and \
+                    entry[1] > now:
+                self.entries[user_id] = entry
+                return entry[2]
+        user = queries.user(session, user_id).first()
+        if user is None:
+            return None
+        record = CachedUser(user.id, user.email, user.location_id)
+        with self.lock:
+            self.entries[user_id] = (version, now + self.ttl, record)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return record
+
+    def invalidate(self, user_ids):
+        """ Make every process reload the given users on their next read.
+
+        """
+
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+        for user_id in user_ids:
+            self.backend.incr(self.version_key(user_id))
+
+
+USERS = UserCache(BACKEND,
+                  int(os.environ.get('TRADING_POST_USER_CACHE_SIZE', 1000)),
+                  int(os.environ.get('TRADING_POST_USER_TTL', 30)))
+
+
+# pylint: disable=unused-argument
+@event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, target):
+    """ Note on the session a user whose cached fields it changed. """
+
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes()
+           for name in CachedUser._fields):
+        object_session(target).info.setdefault('users_changed', set()) \
+            .add(target.id)
+
+
+@event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, target):
+    """ Note on the session a user it deleted. """
+
+    object_session(target).info.setdefault('users_changed', set()) \
+        .add(target.id)
+# pylint: enable=unused-argument
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_users(session):
+    """ Invalidate cached users once changes to them are committed. """
+
+    user_ids = session.info.pop('users_changed', None)
+    if user_ids:
+        USERS.invalidate(user_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_user_changes(session):
+    """ Rolled back user writes leave the cache valid. """
+
+    session.info.pop('users_changed', None)
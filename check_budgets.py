@@ -0,0 +1,226 @@
+"""
+Request every route with its SQL statement budget enforced
+
+Creates the tables of the first release in a scratch SQLite database, or in
+the empty database at --url, and upgrades them with every migration. It
+then adds a few synthetic users, items and messages and drives the
+application through the Flask test client with ENFORCE_QUERY_BUDGETS set:
+every page and API route is requested, anonymously and signed in, and every
+form that writes is posted, including deleting an item that was messaged
+about. Routes going over their budget in queries.ROUTE_BUDGETS or failing,
+and budgeted routes that were never requested, are reported and make the
+exit status 1. So is a deleted item whose conversation was not archived or
+left the unread counts off.
+
+Usage:
+    python check_budgets.py [--url URL]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+from sqlalchemy import MetaData, Table, func
+from database_setup import BASE, User, Location, Item, Message, \
+    Reservation, Want, Conversation, ConversationMember, MessageArchive
+import benchmark
+import engines
+import generate_data
+import migrations
+import project
+import queries
+
+# Columns of the tables the first release created, before any migration
+FIRST_RELEASE = (
+    ('location', ('id', 'name')),
+    ('user', ('id', 'location_id', 'email')),
+    ('item', ('id', 'user_id', 'name', 'cardset', 'condition', 'price',
+              'quantity', 'time_added')),
+    ('message', ('id', 'sender_id', 'receiver_id', 'item_id', 'message')),
+)
+
+# Rows of synthetic data the routes are requested against
+SAMPLE = argparse.Namespace(locations=3, users=10, items=200, messages=100)
+
+
+def create_first_release(engine):
+    """ Create the tables as the first release did, so the migrations
+        upgrade a database that predates them all.
+    """
+
+    metadata = MetaData()
+    for name, columns in FIRST_RELEASE:
+        Table(name, metadata, *[column.copy() for column
+                                in BASE.metadata.tables[name].columns
+                                if column.name in columns])
+    metadata.create_all(engine)
+
+
+class Check(object):
+    """ Test clients for a seller and a buyer, and what went wrong. """
+
+    def __init__(self, app, seller_id, buyer_id):
+        self.adapter = app.url_map.bind('localhost')
+        self.clients = {None: app.test_client()}
+        for user_id in (seller_id, buyer_id):
+            client = app.test_client()
+            with client.session_transaction() as login_session:
+                login_session['email'] = 'user%d@example.com' % user_id
+                login_session['user_id'] = user_id
+            self.clients[user_id] = client
+        self.seller_id = seller_id
+        self.buyer_id = buyer_id
+        self.endpoints = set()
+        self.problems = []
+
+    def request(self, user_id, url, data=None):
+        """ Request a URL as a user, or anonymously for None, posting data
+            if given. Notes the endpoint and any failure.
+        """
+
+        method = 'GET' if data is None else 'POST'
+        self.endpoints.add(self.adapter.match(url.split('?')[0],
+                                              method=method)[0])
+        try:
+            response = self.clients[user_id].open(url, method=method,
+                                                  data=data)
+            response.get_data()
+        except Exception as error: # pylint: disable=broad-except
+            self.problems.append('%s %s: %s' % (
+                method, url, str(error).split('\n')[0] or repr(error)))
+            return
+        if response.status_code >= 500:
+            self.problems.append('%s %s: status %d' % (
+                method, url, response.status_code))
+
+    def pages(self, session):
+        """ Request every page and API route. """
+
+        for _, url, signed_in in benchmark.route_urls(session,
+                                                      self.seller_id):
+            self.request(self.seller_id if signed_in else None, url)
+        item = session.query(Item).filter_by(user_id=self.seller_id).first()
+        for url in ('/user/items/%d' % item.id,
+                    '/prices/JSON?name=%s' % item.name,
+                    '/user/matches/JSON',
+                    '/user/wants',
+                    '/user/reservations',
+                    '/user/items/archive',
+                    '/user/messages/archive'):
+            self.request(self.seller_id, url)
+
+    def forms(self, session):
+        """ Post every form that writes, as the seller or the buyer. """
+
+        item = session.query(Item).filter_by(user_id=self.seller_id).first()
+        card = {'name': item.name, 'cardset': item.cardset,
+                'condition': item.condition}
+        self.request(self.buyer_id, '/user/wants', card)
+        self.request(self.buyer_id, '/items/%d' % item.id,
+                     {'message': 'Is it still available?'})
+        message = session.query(Message) \
+            .filter_by(receiver_id=self.seller_id) \
+            .order_by(Message.id.desc()).first()
+        self.request(self.seller_id,
+                     '/messages/conversation/%d' % message.conversation_id)
+        self.request(self.seller_id, '/messages/%d/reply' % message.id,
+                     {'message': 'It is'})
+        for action in ('release', 'confirm'):
+            self.request(self.buyer_id, '/items/%d/reserve' % item.id,
+                         {'quantity': 1})
+            reservation_id = session.query(func.max(Reservation.id)).scalar()
+            self.request(self.seller_id, '/reservations/%d/%s'
+                         % (reservation_id, action), {})
+        session.expire_all()
+        self.request(self.seller_id, '/items/%d/edit' % item.id, dict(
+            card, price='1.00', quantity=str(item.quantity + 1),
+            version=str(session.query(Item.version)
+                        .filter_by(id=item.id).scalar())))
+        self.request(self.seller_id, '/additem',
+                     dict(card, price='2.00', quantity='1'))
+        self.request(self.seller_id, '/items/%d/delete' % session.query(
+            func.max(Item.id)).filter_by(user_id=self.seller_id).scalar(), {})
+        self.request(self.seller_id, '/messages/%d/delete' % message.id, {})
+        self.request(self.buyer_id, '/user/wants/%d/delete' % session.query(
+            func.max(Want.id)).filter_by(user_id=self.buyer_id).scalar(), {})
+        self.request(self.buyer_id, '/user/location', {
+            'location_id': session.query(func.max(Location.id)).scalar()})
+
+    def delete_messaged(self, session):
+        """ Delete an item the buyer messaged the seller about, and check
+            that its conversation was archived and its unread message came
+            off the seller's unread count.
+        """
+
+        item_id = session.query(func.min(Item.id)) \
+            .filter_by(user_id=self.seller_id).scalar()
+        self.request(self.buyer_id, '/items/%d' % item_id,
+                     {'message': 'Would you take less?'})
+        self.request(self.seller_id, '/items/%d/delete' % item_id, {})
+        session.expire_all()
+        if session.query(Item).filter_by(id=item_id).count():
+            self.problems.append('item %d was not deleted' % item_id)
+            return
+        if session.query(Conversation).filter_by(item_id=item_id).count():
+            self.problems.append('item %d left its conversations' % item_id)
+        if not session.query(MessageArchive).filter_by(
+                item_id=item_id).count():
+            self.problems.append('item %d messages were not archived'
+                                 % item_id)
+        unread = session.query(func.sum(ConversationMember.unread)) \
+            .filter_by(user_id=self.seller_id).scalar() or 0
+        if session.query(User.unread_count).filter_by(
+                id=self.seller_id).scalar() != unread:
+            self.problems.append('user %d unread count is off after '
+                                 'deleting item %d'
+                                 % (self.seller_id, item_id))
+
+    def unchecked(self):
+        """ Budgeted endpoints that were never requested. """
+
+        return sorted(set(queries.ROUTE_BUDGETS) - self.endpoints)
+
+
+def main(argv):
+    """ Command line entry point. """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url')
+    options = parser.parse_args(argv[1:])
+    scratch = None if options.url else tempfile.mkdtemp()
+    url = options.url or 'sqlite:///' + os.path.join(scratch, 'check.db')
+    engine = engines.create(url, pooled=False)
+    create_first_release(engine)
+    migrations.upgrade(engine)
+    generate_data.generate(engine, SAMPLE, random.Random(0))
+    engine.dispose()
+    app = project.create_app({'DATABASE_URL': url,
+                              'REPLICA_URLS': [url],
+                              'ENFORCE_QUERY_BUDGETS': True,
+                              'TESTING': True})
+    app.secret_key = app.secret_key or 'check'
+    session = project.DBSESSION()
+    seller_id = session.query(Item.user_id).order_by(Item.id).first()[0]
+    buyer_id = session.query(func.min(User.id)) \
+        .filter(User.id != seller_id).scalar()
+    check = Check(app, seller_id, buyer_id)
+    check.pages(session)
+    check.forms(session)
+    check.delete_messaged(session)
+    session.close()
+    for problem in check.problems:
+        print "FAILED " + problem
+    for endpoint in check.unchecked():
+        print "FAILED %s was never requested" % endpoint
+    print "Checked %d endpoints against their budgets" % len(check.endpoints)
+    for other in project.ENGINES:
+        other.dispose()
+    if scratch:
+        shutil.rmtree(scratch)
+    return 1 if check.problems or check.unchecked() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -3,14 +3,20 @@ Set up postgres database
 """
 
 import datetime
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Numeric
+import decimal
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Numeric, \
+    Boolean, Date, Index, false
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+import engines
 
 # Create base class for classes to inherit SQLAlchemy properties
 BASE = declarative_base()
 
+# Card conditions offered by the item forms, best first
+CONDITIONS = ["Near Mint", "Lightly Played", "Moderately Played",
+              "Heavily Played", "Damaged"]
+
 
 class Location(BASE): # pylint: disable=too-few-public-methods
     """ Create location table
@@ -21,6 +27,10 @@ class Location(BASE): # pylint: disable=too-few-public-methods
     """
 
     __tablename__ = "location"
+    __table_args__ = (
+        # Location dropdown is sorted by name on every page
+        Index("ix_location_name", "name"),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
 
@@ -41,12 +51,21 @@ class User(BASE): # pylint: disable=too-few-public-methods
             id: An integer acting as the primary key
             email: A string represeting email of the user
             location: A string representing location of the user
+            unread_count: An integer counting unread messages received
     """
 
     __tablename__ = "user"
+    __table_args__ = (
+        # Location pages walk location -> users -> items
+        Index("ix_user_location_id_id", "location_id", "id"),
+        # Log-in looks users up by email
+        Index("ix_user_email", "email"),
+    )
     id = Column(Integer, primary_key=True)
     location_id = Column(Integer, ForeignKey("location.id"))
     email = Column(String(250), nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0,
+                          server_default="0")
     location = relationship(Location)
 
     @property
@@ -72,9 +91,19 @@ class Item(BASE): # pylint: disable=too-few-public-methods
             price: A float representing asking price of card
             quantity: An integer representing quantity of card
             time_added: A datetime representing time card was added
+            version: An integer bumped by every write, so concurrent writes
+                compare and swap on it instead of overwriting each other
     """
 
     __tablename__ = "item"
+    __table_args__ = (
+        # Binder and location pages select items by owner
+        Index("ix_item_user_id_time_added", "user_id", "time_added"),
+        # Main page and the newest-first API sort by time added
+        Index("ix_item_time_added_id", "time_added", "id"),
+        # Trade matching finds the items a want is after
+        Index("ix_item_card_price", "name", "cardset", "condition", "price"),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("user.id"))
     name = Column(String(250), nullable=False)
@@ -82,8 +111,11 @@ class Item(BASE): # pylint: disable=too-few-public-methods
     condition = Column(String(250), nullable=False)
     price = Column(Numeric(10, 2), nullable=False)
     quantity = Column(Integer, nullable=False)
-    time_added = Column(DateTime, default=datetime.datetime.utcnow())
+    time_added = Column(DateTime, default=datetime.datetime.utcnow)
+    version = Column(Integer, nullable=False, default=0, server_default="0")
     user = relationship(User)
+    # ORM updates and deletes only apply to the version they loaded
+    __mapper_args__ = {"version_id_col": version}
 
     @property
     def serialize(self):
@@ -101,6 +133,175 @@ class Item(BASE): # pylint: disable=too-few-public-methods
         }
 
 
+class Listing(BASE): # pylint: disable=too-few-public-methods
+    """ Create listing table
+
+        Copy of each item along with its owner's location, kept up to date
+        by listings.py so location pages read one index range instead of
+        joining item through user.
+
+        Attributes:
+            id: Integer foreign key of the item, acting as the primary key
+            location_id: An integer representing the owner's location
+            user_id, name, cardset, condition, price, quantity, time_added:
+                Copied from the item
+    """
+
+    __tablename__ = "listing"
+    __table_args__ = (
+        # Location pages list a location's items, newest first
+        Index("ix_listing_location_time_added", "location_id", "time_added",
+              "id"),
+        # Location API walks a location's items by id
+        Index("ix_listing_location_id_id", "location_id", "id"),
+        # Cheapest and dearest item at a location
+        Index("ix_listing_location_price", "location_id", "price"),
+        # Moving a user moves their listings
+        Index("ix_listing_user_id", "user_id"),
+    )
+    id = Column(Integer, ForeignKey("item.id"), primary_key=True,
+                autoincrement=False)
+    location_id = Column(Integer, ForeignKey("location.id"))
+    user_id = Column(Integer, ForeignKey("user.id"))
+    name = Column(String(250), nullable=False)
+    cardset = Column(String(250), nullable=False)
+    condition = Column(String(250), nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    time_added = Column(DateTime)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "name": self.name,
+            "cardset": self.cardset,
+            "condition": self.condition,
+            "price": self.price,
+            "quantity": self.quantity,
+            "time_added": self.time_added
+        }
+
+
+class LocationSummary(BASE): # pylint: disable=too-few-public-methods
+    """ Create location summary table
+
+        Running totals of the items at each location, kept up to date by
+        listings.py.
+
+        Attributes:
+            location_id: Integer foreign key of the location, primary key
+            item_count: An integer counting items listed at the location
+            quantity: An integer counting cards across those items
+            price_total: A decimal sum of the items' prices
+            price_min: A decimal representing the cheapest item's price
+            price_max: A decimal representing the dearest item's price
+    """
+
+    __tablename__ = "location_summary"
+    location_id = Column(Integer, ForeignKey("location.id"),
+                         primary_key=True, autoincrement=False)
+    item_count = Column(Integer, nullable=False, default=0)
+    quantity = Column(Integer, nullable=False, default=0)
+    price_total = Column(Numeric(14, 2), nullable=False, default=0)
+    price_min = Column(Numeric(10, 2))
+    price_max = Column(Numeric(10, 2))
+
+    @property
+    def price_average(self):
+        """ Mean asking price of the location's items, or None. """
+
+        if not self.item_count:
+            return None
+        return (decimal.Decimal(self.price_total) / self.item_count) \
+            .quantize(decimal.Decimal('0.01'))
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "location_id": self.location_id,
+            "item_count": self.item_count,
+            "quantity": self.quantity,
+            "price_min": self.price_min,
+            "price_max": self.price_max,
+            "price_average": self.price_average
+        }
+
+
+class Conversation(BASE): # pylint: disable=too-few-public-methods
+    """ Create conversation table
+
+        Groups the messages two users exchange about one item.
+
+        Attributes:
+            id: An integer acting as the primary key
+            item_id: An integer representing the item being discussed
+            user_low_id: The smaller of the two participants' user ids
+            user_high_id: The larger of the two participants' user ids
+            last_message_id: An integer representing the latest message
+            message_count: An integer counting messages in the conversation
+            updated_at: A datetime representing time of the latest message
+    """
+
+    __tablename__ = "conversation"
+    __table_args__ = (
+        # One conversation per item and pair of users
+        Index("ix_conversation_item_users", "item_id", "user_low_id",
+              "user_high_id", unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer, ForeignKey("item.id"), nullable=False)
+    user_low_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    user_high_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    last_message_id = Column(Integer)
+    message_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+    item = relationship(Item)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "item_id": self.item_id,
+            "user_ids": [self.user_low_id, self.user_high_id],
+            "last_message_id": self.last_message_id,
+            "message_count": self.message_count,
+            "updated_at": self.updated_at
+        }
+
+
+class ConversationMember(BASE): # pylint: disable=too-few-public-methods
+    """ Create conversation member table
+
+        One row per participant, so a user's inbox is a single index range.
+
+        Attributes:
+            conversation_id: Integer foreign key of the conversation
+            user_id: Integer foreign key of the participant
+            unread: An integer counting messages the participant has not read
+            updated_at: A datetime copied from the conversation for sorting
+    """
+
+    __tablename__ = "conversation_member"
+    __table_args__ = (
+        # Inbox lists a user's conversations, latest first
+        Index("ix_conversation_member_user_updated", "user_id", "updated_at"),
+    )
+    conversation_id = Column(Integer, ForeignKey("conversation.id"),
+                             primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id"), primary_key=True)
+    unread = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+    conversation = relationship(Conversation)
+
+
 class Message(BASE): # pylint: disable=too-few-public-methods
     """ Create message table
 
@@ -110,17 +311,411 @@ class Message(BASE): # pylint: disable=too-few-public-methods
             receiver_id: An integer representing the person receiving the message
             item_id: An integer representing the item this message is about
             message: A string representing the message
+            conversation_id: Integer foreign key of the conversation
+            time_sent: A datetime representing time message was sent
+            read: A boolean set once the receiver has seen the message
     """
 
     __tablename__ = "message"
+    __table_args__ = (
+        # Inbox lists a user's received messages in order
+        Index("ix_message_receiver_id_id", "receiver_id", "id"),
+        Index("ix_message_item_id", "item_id"),
+        # Conversation view lists a conversation's messages in order
+        Index("ix_message_conversation_id_id", "conversation_id", "id"),
+    )
     id = Column(Integer, primary_key=True)
     sender_id = Column(Integer, ForeignKey("user.id"))
     receiver_id = Column(Integer, ForeignKey("user.id"))
     item_id = Column(Integer, ForeignKey("item.id"))
     message = Column(String(250), nullable=False)
+    conversation_id = Column(Integer, ForeignKey("conversation.id"))
+    time_sent = Column(DateTime, default=datetime.datetime.utcnow)
+    read = Column(Boolean, nullable=False, default=False,
+                  server_default=false())
     sender = relationship("User", foreign_keys=[sender_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
     item = relationship(Item)
+    conversation = relationship(Conversation)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "sender_id": self.sender_id,
+            "receiver_id": self.receiver_id,
+            "item_id": self.item_id,
+            "message": self.message,
+            "conversation_id": self.conversation_id,
+            "time_sent": self.time_sent,
+            "read": self.read
+        }
+
+
+class PriceEvent(BASE): # pylint: disable=too-few-public-methods
+    """ Create price event table
+
+        Append-only record of every asking price an item has had, kept by
+        prices.py. Rows are never updated, and outlive the items they
+        describe.
+
+        Attributes:
+            id: An integer acting as the primary key
+            item_id: An integer naming the item, which may since be deleted
+            kind: A string, one of "added", "edited" or "deleted"
+            name, cardset, condition, price: The item's values at the time
+            recorded_at: A datetime representing when the event happened
+    """
+
+    __tablename__ = "price_event"
+    __table_args__ = (
+        # Rollups recompute one card's events of one day
+        Index("ix_price_event_card_recorded", "name", "cardset", "condition",
+              "recorded_at"),
+        Index("ix_price_event_item_id", "item_id"),
+    )
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer, nullable=False)
+    kind = Column(String(20), nullable=False)
+    name = Column(String(250), nullable=False)
+    cardset = Column(String(250), nullable=False)
+    condition = Column(String(250), nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    recorded_at = Column(DateTime, nullable=False,
+                         default=datetime.datetime.utcnow)
+
+
+class PriceRollup(BASE): # pylint: disable=too-few-public-methods
+    """ Create price rollup table
+
+        Daily asking price statistics per card, built from price events by
+        prices.rollup.
+
+        Attributes:
+            name, cardset, condition: The card, part of the primary key
+            day: A date, the last part of the primary key
+            event_count: An integer counting the prices asked that day
+            price_min: A decimal representing the lowest price asked
+            price_median: A decimal representing the median price asked
+            price_max: A decimal representing the highest price asked
+    """
+
+    __tablename__ = "price_rollup"
+    name = Column(String(250), primary_key=True)
+    cardset = Column(String(250), primary_key=True)
+    condition = Column(String(250), primary_key=True)
+    day = Column(Date, primary_key=True)
+    event_count = Column(Integer, nullable=False)
+    price_min = Column(Numeric(10, 2), nullable=False)
+    price_median = Column(Numeric(10, 2), nullable=False)
+    price_max = Column(Numeric(10, 2), nullable=False)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "name": self.name,
+            "cardset": self.cardset,
+            "condition": self.condition,
+            "day": self.day,
+            "event_count": self.event_count,
+            "price_min": self.price_min,
+            "price_median": self.price_median,
+            "price_max": self.price_max
+        }
+
+
+class JobProgress(BASE): # pylint: disable=too-few-public-methods
+    """ Create job progress table
+
+        Where each incremental job left off, so a run only reads rows
+        added since the previous one.
+
+        Attributes:
+            job: A string naming the job, primary key
+            last_id: An integer, the highest source row id processed
+    """
+
+    __tablename__ = "job_progress"
+    job = Column(String(50), primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+
+
+class Want(BASE): # pylint: disable=too-few-public-methods
+    """ Create want table
+
+        A card a user is looking for, matched against items by matching.py.
+
+        Attributes:
+            id: An integer acting as the primary key
+            user_id: Integer foreign key of the user wanting the card
+            name, cardset, condition: The card wanted
+            max_price: A decimal, the most the user will pay, or None
+            location_id: Integer foreign key of the only location to match
+                items at, or None for anywhere
+            time_added: A datetime representing time the want was added
+    """
+
+    __tablename__ = "want"
+    __table_args__ = (
+        # Trade matching finds the wants an item satisfies
+        Index("ix_want_card", "name", "cardset", "condition"),
+        Index("ix_want_user_id", "user_id"),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    name = Column(String(250), nullable=False)
+    cardset = Column(String(250), nullable=False)
+    condition = Column(String(250), nullable=False)
+    max_price = Column(Numeric(10, 2))
+    location_id = Column(Integer, ForeignKey("location.id"))
+    time_added = Column(DateTime, default=datetime.datetime.utcnow)
+    location = relationship(Location)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "name": self.name,
+            "cardset": self.cardset,
+            "condition": self.condition,
+            "max_price": self.max_price,
+            "location_id": self.location_id,
+            "time_added": self.time_added
+        }
+
+
+class WantMatch(BASE): # pylint: disable=too-few-public-methods
+    """ Create want match table
+
+        An item currently satisfying a want, kept up to date by
+        matching.py as items, wants and user locations change.
+
+        Attributes:
+            id: An integer acting as the primary key, in order of matching
+            want_id: Integer foreign key of the want
+            item_id: Integer foreign key of the matching item
+            user_id: Integer foreign key of the user wanting the card
+            time_matched: A datetime representing time the match was found
+    """
+
+    __tablename__ = "want_match"
+    __table_args__ = (
+        Index("ix_want_match_want_item", "want_id", "item_id", unique=True),
+        Index("ix_want_match_item_id", "item_id"),
+        # Matches are listed per user in order
+        Index("ix_want_match_user_id_id", "user_id", "id"),
+    )
+    id = Column(Integer, primary_key=True)
+    want_id = Column(Integer, ForeignKey("want.id"), nullable=False)
+    item_id = Column(Integer, ForeignKey("item.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    time_matched = Column(DateTime, default=datetime.datetime.utcnow)
+    want = relationship(Want, lazy="joined")
+    item = relationship(Item, lazy="joined")
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "want": self.want.serialize,
+            "item": self.item.serialize,
+            "time_matched": self.time_matched
+        }
+
+
+class Reservation(BASE): # pylint: disable=too-few-public-methods
+    """ Create reservation table
+
+        Copies of an item held for a buyer while they arrange the trade,
+        taken off the item's quantity by reservations.py.
+
+        Attributes:
+            id: An integer acting as the primary key
+            item_id: Integer foreign key of the item reserved
+            buyer_id: Integer foreign key of the user the copies are held for
+            quantity: An integer, the number of copies held
+            status: 'held' until the seller confirms the trade, or it is
+                released by either side or expires
+            time_added: A datetime representing time of the reservation
+            expires_at: A datetime after which a held reservation is swept
+            time_closed: A datetime representing time it stopped being held
+    """
+
+    __tablename__ = "reservation"
+    __table_args__ = (
+        # The sweeper reads held reservations in order of expiry
+        Index("ix_reservation_status_expires_at", "status", "expires_at"),
+        Index("ix_reservation_item_id", "item_id"),
+        Index("ix_reservation_buyer_id", "buyer_id"),
+    )
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer, ForeignKey("item.id"), nullable=False)
+    buyer_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    status = Column(String(20), nullable=False)
+    time_added = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    time_closed = Column(DateTime)
+    item = relationship(Item)
+    buyer = relationship(User)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "item_id": self.item_id,
+            "buyer_id": self.buyer_id,
+            "quantity": self.quantity,
+            "status": self.status,
+            "time_added": self.time_added,
+            "expires_at": self.expires_at,
+            "time_closed": self.time_closed
+        }
+
+
+class ItemArchive(BASE): # pylint: disable=too-few-public-methods
+    """ Create item_archive table
+
+        Items moved out of the item table by archive.py once sold, stale or
+        deleted. Carries no foreign keys, so the users and items it refers
+        to can go.
+
+        Attributes:
+            archive_id: An integer acting as the primary key
+            id: An integer, the id the item had, which SQLite may hand out
+                again once the row is gone
+            user_id: An integer representing the person who listed the card
+            name: A string representing the name of the item
+            cardset: A string representing the set of the card
+            condition: A string representing card condition
+            price: A float representing the last asking price of the card
+            quantity: An integer representing quantity left of the card
+            time_added: A datetime representing time card was added
+            reason: 'sold', 'stale' or 'deleted'
+            archived_at: A datetime representing time it was archived
+    """
+
+    __tablename__ = "item_archive"
+    __table_args__ = (
+        # A user's archived items are listed newest first
+        Index("ix_item_archive_user_id_archive_id", "user_id", "archive_id"),
+    )
+    archive_id = Column(Integer, primary_key=True)
+    id = Column(Integer, nullable=False)
+    user_id = Column(Integer)
+    name = Column(String(250), nullable=False)
+    cardset = Column(String(250), nullable=False)
+    condition = Column(String(250), nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    time_added = Column(DateTime)
+    reason = Column(String(20), nullable=False)
+    archived_at = Column(DateTime, nullable=False)
+
+    @property
+    def serialize(self):
+        """ Serialize json object """
+
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "name": self.name,
+            "cardset": self.cardset,
+            "condition": self.condition,
+            "price": self.price,
+            "quantity": self.quantity,
+            "time_added": self.time_added,
+            "reason": self.reason,
+            "archived_at": self.archived_at
+        }
+
+
+class ReservationArchive(BASE): # pylint: disable=too-few-public-methods
+    """ Create reservation_archive table
+
+        Closed reservations of archived items, with the columns of
+        reservation and no foreign keys.
+
+        Attributes:
+            archive_id: An integer acting as the primary key
+            id: An integer, the id the reservation had, which SQLite may hand out
+                again once the row is gone
+            item_id: An integer, the id of the item reserved
+            buyer_id: An integer, the id of the user the copies were held for
+            quantity: An integer, the number of copies held
+            status: 'confirmed', 'released' or 'expired'
+            time_added: A datetime representing time of the reservation
+            expires_at: A datetime after which it would have been swept
+            time_closed: A datetime representing time it stopped being held
+            archived_at: A datetime representing time it was archived
+    """
+
+    __tablename__ = "reservation_archive"
+    __table_args__ = (
+        Index("ix_reservation_archive_item_id", "item_id"),
+    )
+    archive_id = Column(Integer, primary_key=True)
+    id = Column(Integer, nullable=False)
+    item_id = Column(Integer, nullable=False)
+    buyer_id = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    status = Column(String(20), nullable=False)
+    time_added = Column(DateTime)
+    expires_at = Column(DateTime, nullable=False)
+    time_closed = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False)
+
+
+class MessageArchive(BASE): # pylint: disable=too-few-public-methods
+    """ Create message_archive table
+
+        Messages of conversations archive.py moved out once idle, or along
+        with the item they were about, with the columns of message and no
+        foreign keys.
+
+        Attributes:
+            archive_id: An integer acting as the primary key
+            id: An integer, the id the message had, which SQLite may hand out
+                again once the row is gone
+            sender_id: An integer representing the person sending the message
+            receiver_id: An integer representing the person receiving the message
+            item_id: An integer representing the item this message is about
+            message: A string representing the message
+            conversation_id: An integer, the id of the conversation it was in
+            time_sent: A datetime representing time message was sent
+            read: A boolean set once the receiver had seen the message
+            archived_at: A datetime representing time it was archived
+    """
+
+    __tablename__ = "message_archive"
+    __table_args__ = (
+        # A user's archived messages are listed newest first
+        Index("ix_message_archive_receiver_id_archive_id", "receiver_id",
+              "archive_id"),
+        Index("ix_message_archive_sender_id_archive_id", "sender_id",
+              "archive_id"),
+    )
+    archive_id = Column(Integer, primary_key=True)
+    id = Column(Integer, nullable=False)
+    sender_id = Column(Integer)
+    receiver_id = Column(Integer)
+    item_id = Column(Integer)
+    message = Column(String(250), nullable=False)
+    conversation_id = Column(Integer)
+    time_sent = Column(DateTime)
+    read = Column(Boolean, nullable=False)
+    archived_at = Column(DateTime, nullable=False)
 
     @property
     def serialize(self):
@@ -131,9 +726,24 @@ class Message(BASE): # pylint: disable=too-few-public-methods
             "sender_id": self.sender_id,
             "receiver_id": self.receiver_id,
             "item_id": self.item_id,
-            "message": self.message
+            "message": self.message,
+            "conversation_id": self.conversation_id,
+            "time_sent": self.time_sent,
+            "read": self.read,
+            "archived_at": self.archived_at
         }
 
-# Final configuration code
-ENGINE = create_engine('sqlite:///catalog.db')
-BASE.metadata.create_all(ENGINE)
+
+def init_db(engine):
+    """ Create the tables and indexes the database lacks.
+
+        Importing the models no longer touches the database, so this runs
+        only when asked: from `flask init-db`, migrations.upgrade() or
+        `python database_setup.py`.
+    """
+
+    BASE.metadata.create_all(engine)
+
+
+if __name__ == '__main__':
+    init_db(engines.create(pooled=False))
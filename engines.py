@@ -0,0 +1,173 @@
+"""
+Database engines built from configuration
+
+Every module connects through create(), so one set of environment variables
+selects the database, sizes the connection pool and bounds statement time:
+
+    TRADING_POST_DATABASE_URL       SQLAlchemy URL of the primary database
+                                    (default sqlite:///catalog.db)
+    TRADING_POST_REPLICA_URLS       Comma-separated URLs of read replicas
+    TRADING_POST_POOL_SIZE          Connections kept open per engine
+    TRADING_POST_MAX_OVERFLOW       Extra connections allowed under load
+    TRADING_POST_POOL_TIMEOUT       Seconds to wait for a free connection
+    TRADING_POST_POOL_RECYCLE       Seconds before a connection is replaced
+    TRADING_POST_STATEMENT_TIMEOUT  Milliseconds a statement may run on
+                                    Postgres, or wait for a lock on SQLite
+
+Read-only sessions are spread over the replicas, or use read-only
+connections to the primary when there are none.
+"""
+
+import itertools
+import os
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_URL = 'sqlite:///catalog.db'
+
+
+def database_url():
+    """ URL of the primary database. """
+
+    return os.environ.get('TRADING_POST_DATABASE_URL') or DEFAULT_URL
+
+
+def replica_urls():
+    """ URLs of the read replicas, possibly none. """
+
+    urls = os.environ.get('TRADING_POST_REPLICA_URLS', '')
+    return [url.strip() for url in urls.split(',') if url.strip()]
+
+
+def statement_timeout_ms():
+    """ Statement timeout in milliseconds, 0 for none. """
+
+    return int(os.environ.get('TRADING_POST_STATEMENT_TIMEOUT', 30000))
+
+
+def pool_options():
+    """ Connection pool settings for an engine.
+
+        Read from the environment so each deployment can size the pool to
+        its worker model (threads per process under mod_wsgi).
+    """
+
+    return {
+        'poolclass': QueuePool,
+        'pool_size': int(os.environ.get('TRADING_POST_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('TRADING_POST_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('TRADING_POST_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('TRADING_POST_POOL_RECYCLE', 3600))
+    }
+
+
+def connect_args(url, read_only):
+    """ DBAPI connection arguments for the URL's database. """
+
+    timeout = statement_timeout_ms()
+    backend = make_url(url).get_backend_name()
+    if backend == 'sqlite':
+        # Connections are handed between request threads by the pool
+        args = {'check_same_thread': False}
+        if timeout:
+            args['timeout'] = timeout / 1000.0
+        return args
+    if backend == 'postgresql':
+        options = []
+        if timeout:
+            options.append('-c statement_timeout=%d' % timeout)
+        if read_only:
+            options.append('-c default_transaction_read_only=on')
+        return {'options': ' '.join(options)} if options else {}
+    return {}
+
+
+def sqlite_writer_connect(dbapi_connection, connection_record):
+    """ Put SQLite in write-ahead logging mode so reads never wait on writes.
+
+    """
+
+    # pylint: disable=unused-argument
+    dbapi_connection.execute('PRAGMA journal_mode=WAL')
+
+
+def sqlite_reader_connect(dbapi_connection, connection_record):
+    """ Make a SQLite connection refuse writes. """
+
+    # pylint: disable=unused-argument
+    dbapi_connection.execute('PRAGMA query_only=ON')
+
+
+def create(url=None, read_only=False, pooled=True):
+    """ Create an engine for a URL, the primary database by default.
+
+        Read-only engines open connections that refuse writes. Scripts
+        that connect once can pass pooled=False to use the dialect's
+        default pool.
+    """
+
+    url = url or database_url()
+    options = pool_options() if pooled else {}
+    engine = create_engine(url, connect_args=connect_args(url, read_only),
+                           **options)
+    if engine.dialect.name == 'sqlite':
+        if read_only:
+            event.listen(engine, 'connect', sqlite_reader_connect)
+        else:
+            event.listen(engine, 'connect', sqlite_writer_connect)
+    return engine
+
+
+def create_readers(urls=None, primary_url=None):
+    """ Read-only engines for the replicas, or for the primary if none.
+
+        Both default to the URLs in the environment.
+    """
+
+    urls = urls or replica_urls() or [primary_url or database_url()]
+    return [create(url, read_only=True) for url in urls]
+
+
+class ReplicaRouter(object):
+    """ Session factory binding each new session to the next reader.
+
+        Used as the factory of a scoped_session, so a request reads from
+        one replica throughout and successive requests take turns. Until
+        engines are configured its sessions are unbound, like those of a
+        sessionmaker without a bind.
+    """
+
+    def __init__(self, engines=()):
+        self.lock = threading.Lock()
+        self.factories = None
+        self.configure(engines=engines)
+
+    def configure(self, engines):
+        """ Spread sessions created from now on over engines.
+
+            Called through scoped_session.configure().
+        """
+
+        factories = itertools.cycle([sessionmaker(bind=engine)
+                                     for engine in engines] or
+                                    [sessionmaker()])
+        with self.lock:
+            self.factories = factories
+
+    def __call__(self):
+        with self.lock:
+            factory = next(self.factories)
+        return factory()
+
+
+# Session registries giving each request its own sessions, bound to their
+# engines by project.create_app(). Routes that write use SESSION on the
+# primary database; pages and APIs that only read use READ_SESSION, whose
+# connections cannot write and which is spread over the read replicas when
+# there are any.
+DBSESSION = sessionmaker()
+SESSION = scoped_session(DBSESSION)
+READ_SESSION = scoped_session(ReplicaRouter())
@@ -0,0 +1,136 @@
+"""
+Fill the database with synthetic data for load testing
+
+Rows are inserted with executemany in large chunks, bypassing the ORM, so
+millions of rows load in minutes. Run against an empty database created by
+database_setup.py and migrations.py.
+
+Usage:
+    python generate_data.py [--locations N] [--users N] [--items N]
+                            [--messages N] [--seed N]
+"""
+
+import argparse
+import datetime
+import random
+import sys
+import time
+from database_setup import CONDITIONS, User, Location, Item, Message
+import engines
+import listings
+import matching
+import prices
+import messaging
+
+# Rows sent to the database per executemany
+CHUNK_SIZE = 10000
+
+CARD_NAMES = ["Black Lotus", "Aether Vial", "Liliana of the Veil", "Mox Opal",
+              "Tarmogoyf", "Snapcaster Mage", "Thoughtseize", "Dark Confidant",
+              "Force of Will", "Lightning Bolt", "Counterspell", "Brainstorm",
+              "Wasteland", "Ancestral Recall", "Time Walk",
+              "Jace, the Mind Sculptor", "Noble Hierarch", "Goblin Guide",
+              "Path to Exile", "Scalding Tarn"]
+
+CARD_SETS = ["Alpha", "Beta", "Unlimited", "Kaladesh", "Modern Masters",
+             "Scars of Mirrodin", "Future Sight", "Innistrad", "Zendikar",
+             "Ravnica", "Time Spiral", "Eternal Masters"]
+
+
+def insert_chunks(engine, table, rows):
+    """ Insert an iterable of row dicts in CHUNK_SIZE executemany calls.
+
+    """
+
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            engine.execute(table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        engine.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+def first_id(engine, table):
+    """ Id the next inserted row of a table will get. """
+
+    last = engine.execute(table.select().with_only_columns(
+        [table.c.id]).order_by(table.c.id.desc()).limit(1)).scalar()
+    return (last or 0) + 1
+
+
+def generate(engine, options, rng):
+    """ Insert the requested numbers of rows, returning counts per table.
+
+    """
+
+    counts = {}
+    start = first_id(engine, Location.__table__)
+    counts['location'] = insert_chunks(engine, Location.__table__, (
+        {'name': 'GP %d' % number}
+        for number in xrange(start, start + options.locations)))
+    location_ids = (start, start + options.locations - 1)
+
+    start = first_id(engine, User.__table__)
+    counts['user'] = insert_chunks(engine, User.__table__, (
+        {'email': 'user%d@example.com' % number,
+         'location_id': rng.randint(*location_ids)}
+        for number in xrange(start, start + options.users)))
+    user_ids = (start, start + options.users - 1)
+
+    now = datetime.datetime.utcnow()
+    start = first_id(engine, Item.__table__)
+    counts['item'] = insert_chunks(engine, Item.__table__, (
+        {'user_id': rng.randint(*user_ids),
+         'name': rng.choice(CARD_NAMES),
+         'cardset': rng.choice(CARD_SETS),
+         'condition': rng.choice(CONDITIONS),
+         'price': round(rng.uniform(0.25, 500), 2),
+         'quantity': rng.randint(1, 4),
+         'time_added': now - datetime.timedelta(
+             seconds=rng.randint(0, 90 * 86400))}
+        for _ in xrange(options.items)))
+    item_ids = (start, start + options.items - 1)
+
+    counts['message'] = insert_chunks(engine, Message.__table__, (
+        {'sender_id': rng.randint(*user_ids),
+         'receiver_id': rng.randint(*user_ids),
+         'item_id': rng.randint(*item_ids),
+         'message': 'Would you take %d for it?' % rng.randint(1, 500)}
+        for _ in xrange(options.messages)))
+    with engine.begin() as connection:
+        messaging.backfill(connection)
+        listings.rebuild(connection)
+        prices.rebuild(connection)
+        matching.rebuild(connection)
+    return counts
+
+
+def main(argv):
+    """ Command line entry point. """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--locations', type=int, default=20)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv[1:])
+    if min(options.locations, options.users, options.items) < 1:
+        parser.error('need at least one location, user and item')
+    started = time.time()
+    counts = generate(engines.create(pooled=False), options,
+                      random.Random(options.seed))
+    for table in ('location', 'user', 'item', 'message'):
+        print "%-8s %d rows" % (table, counts[table])
+    print "Done in %.1f seconds" % (time.time() - started)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
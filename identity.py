@@ -0,0 +1,173 @@
+"""
+Verification of third-party sign-in tokens
+
+IdentityClient wraps a provider with a short-lived cache of verified tokens and
+a cap on concurrent upstream calls so a burst of log-ins cannot tie up every
+worker thread. GoogleIdentity talks to Google over a pooled HTTP session with
+timeouts; FakeIdentity answers locally so the log-in flow can run offline.
+"""
+
+import abc
+import hashlib
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import cache
+
+
+class IdentityError(Exception):
+    """ Raised when a token cannot be verified. """
+
+
+class IdentityBusy(IdentityError):
+    """ Raised when too many verifications are already in flight. """
+
+
+class IdentityClient(object):
+    """ Caching, concurrency-limited front for an identity provider.
+
+        Subclasses implement fetch_email and revoke_token.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, cache_ttl=300, max_concurrent=4, backend=None):
+        self.cache_ttl = cache_ttl
+        self.backend = backend if backend is not None else cache.MemoryBackend()
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    @staticmethod
+    def cache_key(access_token):
+        """ Cache key for a token; the token itself is never stored. """
+
+        return 'identity:' + hashlib.sha256(access_token).hexdigest()
+
+    @abc.abstractmethod
+    def fetch_email(self, access_token):
+        """ Ask the provider for the email the token belongs to. """
+
+    @abc.abstractmethod
+    def revoke_token(self, access_token):
+        """ Ask the provider to revoke the token, returning success. """
+
+    def verify(self, access_token):
+        """ Return the email address an access token was issued for.
+
+            Recently verified tokens are answered from the cache. Raises
+            IdentityBusy rather than queueing when every upstream slot is
+            taken, and IdentityError when the provider rejects the token.
+        """
+
+        key = self.cache_key(access_token)
+        email = self.backend.get(key)
+        if email is not None:
+            return email
+        if not self.slots.acquire(False):
+            raise IdentityBusy('Too many log-ins in progress')
+        try:
+            email = self.fetch_email(access_token)
+        finally:
+            self.slots.release()
+        self.backend.set(key, email, self.cache_ttl)
+        return email
+
+    def forget(self, access_token):
+        """ Stop answering a token from the cache, ahead of revoking it. """
+
+        self.backend.delete(self.cache_key(access_token))
+
+    def revoke(self, access_token):
+        """ Revoke a token and forget that it was verified. """
+
+        self.forget(access_token)
+        return self.revoke_token(access_token)
+
+
+class GoogleIdentity(IdentityClient):
+    """ Verifies Google OAuth access tokens. """
+
+    userinfo_url = 'https://www.googleapis.com/oauth2/v1/userinfo'
+    revoke_url = 'https://accounts.google.com/o/oauth2/revoke'
+
+    def __init__(self, timeout=(3.05, 10), pool_size=10, **kwargs):
+        IdentityClient.__init__(self, **kwargs)
+        self.timeout = timeout
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=1)
+        self.http.mount('https://', adapter)
+
+    def fetch_email(self, access_token):
+        try:
+            answer = self.http.get(self.userinfo_url,
+                                   params={'access_token': access_token,
+                                           'alt': 'json'},
+                                   timeout=self.timeout)
+        except requests.RequestException as error:
+            raise IdentityError('Google unreachable: %s' % error)
+        if answer.status_code != 200:
+            raise IdentityError('Google rejected token: %d'
+                                % answer.status_code)
+        data = answer.json()
+        if 'email' not in data:
+            raise IdentityError('Google returned no email')
+        return data['email']
+
+    def revoke_token(self, access_token):
+        try:
+            answer = self.http.get(self.revoke_url,
+                                   params={'token': access_token},
+                                   timeout=self.timeout)
+        except requests.RequestException:
+            return False
+        return answer.status_code == 200
+
+
+class FakeIdentity(IdentityClient):
+    """ Offline provider for development and tests.
+
+        Tokens registered with register() verify to their email, as does
+        any token of the form 'fake:<email>'.
+    """
+
+    prefix = 'fake:'
+
+    def __init__(self, **kwargs):
+        IdentityClient.__init__(self, **kwargs)
+        self.tokens = {}
+        self.revoked = set()
+
+    def register(self, access_token, email):
+        """ Make a token verify to an email. """
+
+        self.tokens[access_token] = email
+
+    def fetch_email(self, access_token):
+        if access_token in self.revoked:
+            raise IdentityError('Token revoked')
+        if access_token in self.tokens:
+            return self.tokens[access_token]
+        if access_token.startswith(self.prefix):
+            return access_token[len(self.prefix):]
+        raise IdentityError('Unknown token')
+
+    def revoke_token(self, access_token):
+        self.revoked.add(access_token)
+        return True
+
+
+def client_from_environment():
+    """ Build the identity client selected by TRADING_POST_IDENTITY.
+
+        'fake' selects the offline provider, anything else Google.
+    """
+
+    options = {
+        'cache_ttl': int(os.environ.get('TRADING_POST_IDENTITY_TTL', 300)),
+        'max_concurrent': int(
+            os.environ.get('TRADING_POST_IDENTITY_CONCURRENCY', 4))
+    }
+    if os.environ.get('TRADING_POST_IDENTITY') == 'fake':
+        return FakeIdentity(**options)
+    return GoogleIdentity(**options)
@@ -0,0 +1,284 @@
+"""
+Request, SQL and template instrumentation
+
+Every request is timed, along with the SQL statements it issues through the
+engine and the time spent rendering templates. Each response reports its
+breakdown in a Server-Timing header, totals are exported in Prometheus text
+format at /metrics, and statements slower than a threshold are logged. A
+request can also be run under cProfile when profiling is enabled, and fails
+when it issues more statements than its budget in queries.ROUTE_BUDGETS if
+budgets are enforced.
+
+Everything here is a handful of clock reads and dictionary updates per
+request or statement, cheap enough to leave on in production.
+"""
+
+import cProfile
+import logging
+import os
+import threading
+import time
+from flask import g, request, has_request_context, current_app, Response
+from jinja2 import Template
+from sqlalchemy import event
+import queries
+
+LOGGER = logging.getLogger(__name__)
+
+# Statements taking at least this long are logged, and the engines whose
+# statements count against route budgets, set by init_app
+SETTINGS = {'slow_query_seconds': 0.1, 'budget_engines': ()}
+
+# Upper bounds, in seconds, of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """ Thread-safe in-process counters and histograms for /metrics. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.histograms = {}
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def observe_request(self, endpoint, status, duration):
+        """ Record one finished request. """
+
+        with self.lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.durations[endpoint] = \
+                self.durations.get(endpoint, 0.0) + duration
+            buckets = self.histograms.setdefault(endpoint,
+                                                 [0] * (len(BUCKETS) + 1))
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            buckets[-1] += 1
+
+    def add(self, name, value=1):
+        """ Add to a named counter. """
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """ Record a duration in a named histogram. """
+
+        with self.lock:
+            timing = self.timings.setdefault(name,
+                                             [[0] * (len(BUCKETS) + 1), 0.0])
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timing[0][index] += 1
+            timing[0][-1] += 1
+            timing[1] += seconds
+
+    def gauge(self, name, read):
+        """ Export a value read by calling read() whenever metrics are
+            rendered.
+        """
+
+        with self.lock:
+            self.gauges[name] = read
+
+    def render(self):
+        """ Return every metric in Prometheus text exposition format. """
+
+        lines = []
+        with self.lock:
+            lines.append('# TYPE trading_post_requests_total counter')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append('trading_post_requests_total{endpoint="%s",'
+                             'status="%s"} %d' % (endpoint, status, count))
+            lines.append('# TYPE trading_post_request_seconds histogram')
+            for endpoint, buckets in sorted(self.histograms.items()):
+                for bound, count in zip(BUCKETS, buckets):
+                    lines.append('trading_post_request_seconds_bucket{'
+                                 'endpoint="%s",le="%s"} %d'
+                                 % (endpoint, bound, count))
+                lines.append('trading_post_request_seconds_bucket{'
+                             'endpoint="%s",le="+Inf"} %d'
+                             % (endpoint, buckets[-1]))
+                lines.append('trading_post_request_seconds_sum{'
+                             'endpoint="%s"} %f'
+                             % (endpoint, self.durations[endpoint]))
+                lines.append('trading_post_request_seconds_count{'
+                             'endpoint="%s"} %d' % (endpoint, buckets[-1]))
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE trading_post_%s counter' % name)
+                lines.append('trading_post_%s %s' % (name, value))
+            for name, (buckets, total) in sorted(self.timings.items()):
+                lines.append('# TYPE trading_post_%s histogram' % name)
+                for bound, count in zip(BUCKETS, buckets):
+                    lines.append('trading_post_%s_bucket{le="%s"} %d'
+                                 % (name, bound, count))
+                lines.append('trading_post_%s_bucket{le="+Inf"} %d'
+                             % (name, buckets[-1]))
+                lines.append('trading_post_%s_sum %f' % (name, total))
+                lines.append('trading_post_%s_count %d' % (name, buckets[-1]))
+            gauges = sorted(self.gauges.items())
+        # Read outside the lock, as a gauge may be slow or record metrics
+        for name, read in gauges:
+            try:
+                value = read()
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception('Reading gauge %s failed', name)
+                continue
+            lines.append('# TYPE trading_post_%s gauge' % name)
+            lines.append('trading_post_%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class TimedTemplate(Template): # pylint: disable=abstract-method
+    """ Jinja template class adding its render time to the request. """
+
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            METRICS.add('template_render_seconds_total', elapsed)
+            if has_request_context():
+                g.template_seconds = g.get('template_seconds', 0.0) + elapsed
+
+
+# pylint: disable=too-many-arguments,unused-argument
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """ Engine event listener starting a statement's timer. """
+
+    conn.info.setdefault('statement_started', []).append(
+        (context, time.time()))
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    """ Engine event listener recording a statement's duration. """
+
+    elapsed = time.time() - conn.info['statement_started'].pop()[1]
+    METRICS.add('sql_statements_total')
+    METRICS.add('sql_seconds_total', elapsed)
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+    if elapsed >= SETTINGS['slow_query_seconds']:
+        METRICS.add('sql_slow_statements_total')
+        LOGGER.warning('Slow query (%.1f ms) during %s: %s',
+                       elapsed * 1000,
+                       request.endpoint if has_request_context() else None,
+                       statement)
+# pylint: enable=too-many-arguments,unused-argument
+
+
+def handle_error(exception_context):
+    """ Engine event listener dropping the timer of a statement that
+        failed before after_cursor_execute saw it.
+    """
+
+    conn = exception_context.connection
+    timers = conn.info.get('statement_started') if conn is not None else None
+    if timers and timers[-1][0] is exception_context.execution_context:
+        timers.pop()
+
+
+def start_request():
+    """ before_request hook starting the request timer and profiler. """
+
+    g.request_started = time.time()
+    if request.args.get('profile') and current_app.config.get('PROFILE_DIR'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_request(response):
+    """ after_request hook recording the request and adding its timings.
+
+    """
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        name = '%s-%d.prof' % (request.endpoint, int(time.time() * 1000))
+        profiler.dump_stats(os.path.join(current_app.config['PROFILE_DIR'],
+                                         name))
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.time() - started
+    METRICS.observe_request(request.endpoint, response.status_code, elapsed)
+    response.headers['Server-Timing'] = \
+        'app;dur=%.1f, db;dur=%.1f;desc="%d queries", tpl;dur=%.1f' % (
+            elapsed * 1000, g.get('sql_seconds', 0.0) * 1000,
+            g.get('sql_statements', 0), g.get('template_seconds', 0.0) * 1000)
+    return response
+
+
+def start_statement_count():
+    """ before_request hook counting the request's SQL statements. """
+
+    g.statement_counter = queries.StatementCounter(
+        *SETTINGS['budget_engines']).start()
+
+
+def check_statement_count(response):
+    """ after_request hook checking the request's SQL statement count
+        against its budget.
+    """
+
+    counter = g.get('statement_counter')
+    if counter is not None:
+        counter.check(request.endpoint)
+    return response
+
+
+def stop_statement_count(error): # pylint: disable=unused-argument
+    """ teardown_request hook stopping the count, even for a request whose
+        view raised and so never reached check_statement_count.
+    """
+
+    counter = g.pop('statement_counter', None)
+    if counter is not None:
+        counter.stop()
+
+
+def metrics():
+    """ Serve collected metrics in Prometheus text format. """
+
+    return Response(METRICS.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app, *engines):
+    """ Install instrumentation on an application and its engines.
+
+        PROFILE_DIR in the app config enables ?profile=1, dumping a cProfile
+        of that request to the directory. SLOW_QUERY_MS (default 100) sets
+        the slow query log threshold. ENFORCE_QUERY_BUDGETS fails any route
+        exceeding queries.ROUTE_BUDGETS, for driving the application with
+        the test client.
+    """
+
+    app.jinja_env.template_class = TimedTemplate
+    SETTINGS['slow_query_seconds'] = \
+        float(app.config.get('SLOW_QUERY_MS', 100)) / 1000
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'handle_error', handle_error)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    if app.config.get('ENFORCE_QUERY_BUDGETS'):
+        SETTINGS['budget_engines'] = engines
+        app.before_request(start_statement_count)
+        app.after_request(check_statement_count)
+        app.teardown_request(stop_statement_count)
@@ -0,0 +1,257 @@
+"""
+Per-location listings and totals
+
+Location pages used to join item through user on every request. The listing
+table holds a copy of each item along with its owner's location, and
+location_summary holds running totals per location. Both are updated in the
+same transaction as the writes that change them: by mapper events for writes
+made through the ORM, and by explicit calls after bulk loads that bypass it.
+A location page is then a primary key read of its summary and one index range
+read of its listings.
+"""
+
+import decimal
+from sqlalchemy import event, select, func, exists, inspect
+from database_setup import User, Item, Listing, LocationSummary
+
+LISTING = Listing.__table__
+SUMMARY = LocationSummary.__table__
+ITEM = Item.__table__
+USER = User.__table__
+
+# Item columns copied onto its listing
+COPIED = ('user_id', 'name', 'cardset', 'condition', 'price', 'quantity',
+          'time_added')
+
+
+def price_bounds(location_id):
+    """ Scalar subqueries reading a location's cheapest and dearest price.
+
+        Both resolve to one probe of the (location_id, price) index, so the
+        range stays right when the cheapest item goes without a rescan.
+    """
+
+    where = LISTING.c.location_id == location_id
+    return (select([func.min(LISTING.c.price)]).where(where).as_scalar(),
+            select([func.max(LISTING.c.price)]).where(where).as_scalar())
+
+
+def adjust_summary(connection, location_id, count, quantity, price_total):
+    """ Add to a location's totals and refresh its price range.
+
+        Called after the location's listings have been written.
+    """
+
+    if location_id is None:
+        return
+    price_min, price_max = price_bounds(location_id)
+    result = connection.execute(
+        SUMMARY.update()
+        .where(SUMMARY.c.location_id == location_id)
+        .values(item_count=SUMMARY.c.item_count + count,
+                quantity=SUMMARY.c.quantity + quantity,
+                price_total=SUMMARY.c.price_total + price_total,
+                price_min=price_min,
+                price_max=price_max))
+    if result.rowcount == 0:
+        connection.execute(SUMMARY.insert().values(
+            location_id=location_id, item_count=count, quantity=quantity,
+            price_total=price_total, price_min=price_min,
+            price_max=price_max))
+
+
+def refresh_summary(connection, location_id):
+    """ Recompute a location's totals from its listings. """
+
+    if location_id is None:
+        return
+    totals = connection.execute(
+        select([func.count(LISTING.c.id),
+                func.coalesce(func.sum(LISTING.c.quantity), 0),
+                func.coalesce(func.sum(LISTING.c.price), 0)])
+        .where(LISTING.c.location_id == location_id)).first()
+    connection.execute(SUMMARY.delete()
+                       .where(SUMMARY.c.location_id == location_id))
+    adjust_summary(connection, location_id, *totals)
+
+
+def user_location(connection, user_id):
+    """ Location of a user, which is where their items are listed. """
+
+    return connection.execute(select([USER.c.location_id])
+                              .where(USER.c.id == user_id)).scalar()
+
+
+def copied_values(item):
+    """ Listing column values for an item, with form input normalized. """
+
+    values = dict((name, getattr(item, name)) for name in COPIED)
+    values['price'] = decimal.Decimal(str(values['price']))
+    values['quantity'] = int(values['quantity'])
+    return values
+
+
+def listing_totals(connection, where):
+    """ Location, count, quantity and price total of matching listings. """
+
+    return connection.execute(
+        select([LISTING.c.location_id, func.count(LISTING.c.id),
+                func.coalesce(func.sum(LISTING.c.quantity), 0),
+                func.coalesce(func.sum(LISTING.c.price), 0)])
+        .where(where).group_by(LISTING.c.location_id)).fetchall()
+
+
+def remove(connection, where):
+    """ Remove the listings matching where and take them off their
+        locations' totals. Returns the locations they were at.
+    """
+
+    totals = listing_totals(connection, where)
+    connection.execute(LISTING.delete().where(where))
+    for location_id, count, quantity, price_total in totals:
+        adjust_summary(connection, location_id, -count, -quantity,
+                       -price_total)
+    return [location_id for location_id, _, _, _ in totals]
+
+
+# pylint: disable=unused-argument
+@event.listens_for(Item, 'after_insert')
+def item_inserted(mapper, connection, target):
+    """ List a new item at its owner's location. """
+
+    location_id = user_location(connection, target.user_id)
+    values = copied_values(target)
+    connection.execute(LISTING.insert().values(id=target.id,
+                                               location_id=location_id,
+                                               **values))
+    adjust_summary(connection, location_id, 1, values['quantity'],
+                   values['price'])
+
+
+@event.listens_for(Item, 'after_update')
+def item_updated(mapper, connection, target):
+    """ Copy an edited item onto its listing and adjust the totals. """
+
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in COPIED):
+        return
+    old = connection.execute(
+        select([LISTING.c.location_id, LISTING.c.quantity, LISTING.c.price])
+        .where(LISTING.c.id == target.id)).first()
+    if old is None:
+        item_inserted(mapper, connection, target)
+        return
+    values = copied_values(target)
+    location_id = old.location_id
+    if state.attrs.user_id.history.has_changes():
+        location_id = user_location(connection, target.user_id)
+    connection.execute(LISTING.update().where(LISTING.c.id == target.id)
+                       .values(location_id=location_id, **values))
+    if location_id == old.location_id:
+        adjust_summary(connection, location_id, 0,
+                       values['quantity'] - old.quantity,
+                       values['price'] - old.price)
+    else:
+        adjust_summary(connection, old.location_id, -1, -old.quantity,
+                       -old.price)
+        adjust_summary(connection, location_id, 1, values['quantity'],
+                       values['price'])
+
+
+@event.listens_for(Item, 'before_delete')
+def item_deleted(mapper, connection, target):
+    """ Remove a deleted item's listing ahead of the item itself. """
+
+    remove(connection, LISTING.c.id == target.id)
+
+
+@event.listens_for(User, 'after_update')
+def user_moved(mapper, connection, target):
+    """ Move a user's listings along with them to a new location. """
+
+    history = inspect(target).attrs.location_id.history
+    if not history.has_changes():
+        return
+    where = LISTING.c.user_id == target.id
+    totals = listing_totals(connection, where)
+    connection.execute(LISTING.update().where(where)
+                       .values(location_id=target.location_id))
+    for location_id, count, quantity, price_total in totals:
+        if location_id != target.location_id:
+            adjust_summary(connection, location_id, -count, -quantity,
+                           -price_total)
+            adjust_summary(connection, target.location_id, count, quantity,
+                           price_total)
+# pylint: enable=unused-argument
+
+
+def adjust_quantity(connection, item_id, delta):
+    """ Apply a change to an item's quantity made without the ORM, such as
+        by a reservation, to its listing and location totals.
+    """
+
+    connection.execute(LISTING.update().where(LISTING.c.id == item_id)
+                       .values(quantity=LISTING.c.quantity + delta))
+    location_id = select([LISTING.c.location_id]) \
+        .where(LISTING.c.id == item_id).as_scalar()
+    connection.execute(SUMMARY.update()
+                       .where(SUMMARY.c.location_id == location_id)
+                       .values(quantity=SUMMARY.c.quantity + delta))
+
+
+def item_location(connection, item_id):
+    """ Location an item is listed at. """
+
+    return connection.execute(select([LISTING.c.location_id])
+                              .where(LISTING.c.id == item_id)).scalar()
+
+
+def item_locations(connection, item_ids):
+    """ Locations the given items are listed at. """
+
+    if not item_ids:
+        return []
+    return [row.location_id for row in connection.execute(
+        select([LISTING.c.location_id])
+        .where(LISTING.c.id.in_(item_ids)).distinct())]
+
+
+def listing_source():
+    """ Select of every item's listing column values, for bulk copies. """
+
+    return select([ITEM.c.id, USER.c.location_id] +
+                  [ITEM.c[name] for name in COPIED]) \
+        .select_from(ITEM.outerjoin(USER, USER.c.id == ITEM.c.user_id))
+
+
+def add_user_items(connection, user_id):
+    """ List a user's items written without the ORM, such as by bulk import.
+
+    """
+
+    source = listing_source().where(ITEM.c.user_id == user_id) \
+        .where(~exists().where(LISTING.c.id == ITEM.c.id))
+    connection.execute(LISTING.insert().from_select(
+        ['id', 'location_id'] + list(COPIED), source))
+    refresh_summary(connection, user_location(connection, user_id))
+
+
+def rebuild(connection):
+    """ Rebuild every listing and location total from the item table. """
+
+    connection.execute(SUMMARY.delete())
+    connection.execute(LISTING.delete())
+    connection.execute(LISTING.insert().from_select(
+        ['id', 'location_id'] + list(COPIED), listing_source()))
+    price_min = select([func.min(LISTING.c.price)]) \
+        .where(LISTING.c.location_id == SUMMARY.c.location_id).as_scalar()
+    price_max = select([func.max(LISTING.c.price)]) \
+        .where(LISTING.c.location_id == SUMMARY.c.location_id).as_scalar()
+    connection.execute(SUMMARY.insert().from_select(
+        ['location_id', 'item_count', 'quantity', 'price_total'],
+        select([LISTING.c.location_id, func.count(LISTING.c.id),
+                func.sum(LISTING.c.quantity), func.sum(LISTING.c.price)])
+        .where(LISTING.c.location_id.isnot(None))
+        .group_by(LISTING.c.location_id)))
+    connection.execute(SUMMARY.update().values(price_min=price_min,
+                                               price_max=price_max))
@@ -0,0 +1,199 @@
+"""
+Trade matching between wants and items
+
+A want names a card by (name, cardset, condition), optionally capped at a
+maximum price and restricted to one location. The want_match table holds
+every item with copies left currently satisfying each want. It is updated
+in the same transaction as the writes that change it, and only for the
+items or wants those writes touch: mapper events refresh an item's matches
+when it is added, edited or its owner moves, and a want's matches when it
+is added or edited. Reservations, which change quantities without the ORM,
+refresh the matches of the items they sell out or restock themselves. Both
+sides are found through (name, cardset, condition) indexes, so no write
+rescans the catalog.
+"""
+
+import datetime
+import decimal
+from sqlalchemy import event, select, exists, and_, or_, inspect, literal, \
+    true
+from database_setup import CONDITIONS, User, Item, Want, WantMatch
+
+WANT = Want.__table__
+MATCH = WantMatch.__table__
+ITEM = Item.__table__
+USER = User.__table__
+
+# Want and item columns that decide whether they match
+WANT_TERMS = ('name', 'cardset', 'condition', 'max_price', 'location_id')
+ITEM_TERMS = ('name', 'cardset', 'condition', 'price', 'quantity',
+              'user_id')
+
+# Matches returned per page when the client does not ask for a size
+DEFAULT_PAGE_SIZE = 20
+
+
+def satisfies():
+    """ Condition under which an item, with its owner, satisfies a want.
+
+    """
+
+    return and_(ITEM.c.name == WANT.c.name,
+                ITEM.c.cardset == WANT.c.cardset,
+                ITEM.c.condition == WANT.c.condition,
+                ITEM.c.user_id != WANT.c.user_id,
+                ITEM.c.quantity > 0,
+                USER.c.id == ITEM.c.user_id,
+                or_(WANT.c.max_price.is_(None),
+                    ITEM.c.price <= WANT.c.max_price),
+                or_(WANT.c.location_id.is_(None),
+                    WANT.c.location_id == USER.c.location_id))
+
+
+def refresh(connection, where, scope):
+    """ Bring the matches of the items or wants selected by where up to
+        date.
+
+        scope is MATCH.c.item_id or MATCH.c.want_id, the side where
+        selects. Matches that no longer hold are removed, and new ones added
+        without disturbing those that still hold.
+    """
+
+    side = ITEM if scope is MATCH.c.item_id else WANT
+    still_holds = exists().where(and_(WANT.c.id == MATCH.c.want_id,
+                                      ITEM.c.id == MATCH.c.item_id,
+                                      satisfies()))
+    connection.execute(MATCH.delete().where(and_(
+        scope.in_(select([side.c.id]).where(where)), ~still_holds)))
+    known = exists().where(and_(MATCH.c.want_id == WANT.c.id,
+                                MATCH.c.item_id == ITEM.c.id))
+    connection.execute(MATCH.insert().from_select(
+        ['want_id', 'item_id', 'user_id', 'time_matched'],
+        select([WANT.c.id, ITEM.c.id, WANT.c.user_id,
+                literal(datetime.datetime.utcnow())])
+        .where(satisfies()).where(where).where(~known)
+        .order_by(ITEM.c.id, WANT.c.id)))
+
+
+def refresh_items(connection, where):
+    """ Refresh the matches of the items selected by where. """
+
+    refresh(connection, where, MATCH.c.item_id)
+
+
+def refresh_wants(connection, where):
+    """ Refresh the matches of the wants selected by where. """
+
+    refresh(connection, where, MATCH.c.want_id)
+
+
+def changed(target, terms):
+    """ Whether any of the named attributes of target changed. """
+
+    state = inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in terms)
+
+
+# pylint: disable=unused-argument
+@event.listens_for(Item, 'after_insert')
+def item_inserted(mapper, connection, target):
+    """ Match a new item against the wants for its card. """
+
+    refresh_items(connection, ITEM.c.id == target.id)
+
+
+@event.listens_for(Item, 'after_update')
+def item_updated(mapper, connection, target):
+    """ Rematch an item whose card, price, quantity or owner changed.
+
+    """
+
+    if changed(target, ITEM_TERMS):
+        refresh_items(connection, ITEM.c.id == target.id)
+
+
+@event.listens_for(Item, 'before_delete')
+def item_deleted(mapper, connection, target):
+    """ Remove a deleted item's matches ahead of the item itself. """
+
+    connection.execute(MATCH.delete().where(MATCH.c.item_id == target.id))
+
+
+@event.listens_for(User, 'after_update')
+def user_moved(mapper, connection, target):
+    """ Rematch a user's items when they move, for location-bound wants.
+
+    """
+
+    if changed(target, ('location_id',)):
+        refresh_items(connection, ITEM.c.user_id == target.id)
+
+
+@event.listens_for(Want, 'after_insert')
+def want_inserted(mapper, connection, target):
+    """ Match a new want against the items of its card. """
+
+    refresh_wants(connection, WANT.c.id == target.id)
+
+
+@event.listens_for(Want, 'after_update')
+def want_updated(mapper, connection, target):
+    """ Rematch a want whose card, price cap or location changed. """
+
+    if changed(target, WANT_TERMS):
+        refresh_wants(connection, WANT.c.id == target.id)
+
+
+@event.listens_for(Want, 'before_delete')
+def want_deleted(mapper, connection, target):
+    """ Remove a deleted want's matches ahead of the want itself. """
+
+    connection.execute(MATCH.delete().where(MATCH.c.want_id == target.id))
+# pylint: enable=unused-argument
+
+
+def rebuild(connection):
+    """ Recompute every match from the wants and items. """
+
+    connection.execute(MATCH.delete())
+    refresh_wants(connection, true())
+
+
+def user_matches(session, user_id):
+    """ Query of the items matching a user's wants, oldest match first.
+
+        Pages through pagination.paginate by match id, reading one range of
+        the (user_id, id) index.
+    """
+
+    return session.query(WantMatch).filter(WantMatch.user_id == user_id)
+
+
+def user_wants(session, user_id):
+    """ Query of a user's wants, newest first. """
+
+    return session.query(Want).filter(Want.user_id == user_id) \
+        .order_by(Want.id.desc())
+
+
+def want_from_form(form, user_id):
+    """ Build a user's want from a posted form.
+
+        Raises ValueError for a missing card or malformed price.
+    """
+
+    if not form.get('name') or not form.get('cardset') or \
+            form.get('condition') not in CONDITIONS:
+        raise ValueError('Card name, set and condition are required')
+    want = Want(user_id=user_id,
+                name=form['name'],
+                cardset=form['cardset'],
+                condition=form['condition'])
+    if form.get('max_price'):
+        try:
+            want.max_price = decimal.Decimal(form['max_price'])
+        except decimal.InvalidOperation:
+            raise ValueError('Invalid maximum price')
+    if form.get('location_id'):
+        want.location_id = int(form['location_id'])
+    return want
@@ -0,0 +1,258 @@
+"""
+Conversations and unread counters for messages between users
+
+Messages two users exchange about an item form one conversation. Each
+participant has a conversation_member row holding their unread count and the
+time of the latest message, and each user row holds their total unread count.
+These are kept up to date as messages are sent, read and deleted, so the
+inbox is one index range read and the unread badge a primary key lookup.
+"""
+
+import datetime
+from sqlalchemy import desc, select, func, bindparam, and_, or_
+from database_setup import User, Message, Conversation, ConversationMember
+import notifications
+import pagination
+import queries
+
+# Conversations shown per inbox page
+INBOX_PAGE_SIZE = 20
+
+
+def participants(user_id, other_id):
+    """ Order two user ids the way conversations store them. """
+
+    return min(user_id, other_id), max(user_id, other_id)
+
+
+def find_or_create_conversation(session, item_id, user_id, other_id):
+    """ Return the conversation about an item between two users.
+
+        Creates it and its member rows on first contact.
+    """
+
+    low, high = participants(user_id, other_id)
+    conversation = session.query(Conversation).filter_by(
+        item_id=item_id, user_low_id=low, user_high_id=high).first()
+    if conversation is not None:
+        return conversation
+    conversation = Conversation(item_id=item_id, user_low_id=low,
+                                user_high_id=high, message_count=0)
+    session.add(conversation)
+    session.flush()
+    for member_id in set([low, high]):
+        session.add(ConversationMember(conversation_id=conversation.id,
+                                       user_id=member_id, unread=0))
+    return conversation
+
+
+# pylint: disable=too-many-arguments
+def send_message(session, sender_id, receiver_id, item_id, text,
+                 conversation=None):
+    """ Add a message to its conversation and update the counters.
+
+        The caller commits, which also notifies the receiver. Counters are
+        updated with SQL increments so concurrent senders do not overwrite
+        each other.
+    """
+
+    if conversation is None:
+        conversation = find_or_create_conversation(session, item_id,
+                                                   sender_id, receiver_id)
+    now = datetime.datetime.utcnow()
+    message = Message(sender_id=sender_id,
+                      receiver_id=receiver_id,
+                      item_id=item_id,
+                      message=text,
+                      conversation_id=conversation.id,
+                      time_sent=now,
+                      read=sender_id == receiver_id)
+    session.add(message)
+    session.flush()
+    session.query(Conversation).filter_by(id=conversation.id).update({
+        Conversation.last_message_id: message.id,
+        Conversation.message_count: Conversation.message_count + 1,
+        Conversation.updated_at: now
+    }, synchronize_session=False)
+    session.query(ConversationMember) \
+        .filter_by(conversation_id=conversation.id) \
+        .update({ConversationMember.updated_at: now},
+                synchronize_session=False)
+    if not message.read:
+        session.query(ConversationMember).filter_by(
+            conversation_id=conversation.id, user_id=receiver_id).update(
+                {ConversationMember.unread: ConversationMember.unread + 1},
+                synchronize_session=False)
+        session.query(User).filter_by(id=receiver_id).update(
+            {User.unread_count: User.unread_count + 1},
+            synchronize_session=False)
+        notifications.notify(session,
+                             notifications.user_channel(receiver_id),
+                             'message', {
+                                 'id': message.id,
+                                 'conversation_id': conversation.id,
+                                 'item_id': item_id,
+                                 'sender_id': sender_id,
+                                 'message': text
+                             })
+    return message
+
+
+def delete_message(session, message):
+    """ Delete a message, keeping its conversation's counters right.
+
+        Deleting the last message of a conversation removes it from both
+        participants' inboxes. The caller commits.
+    """
+
+    conversation_id = message.conversation_id
+    if not message.read:
+        mark_unread_delta(session, conversation_id, message.receiver_id, -1)
+    session.delete(message)
+    session.flush()
+    if conversation_id is None:
+        return
+    latest = session.query(Message) \
+        .filter_by(conversation_id=conversation_id) \
+        .order_by(desc(Message.id)).first()
+    if latest is None:
+        session.query(ConversationMember) \
+            .filter_by(conversation_id=conversation_id) \
+            .delete(synchronize_session=False)
+        session.query(Conversation).filter_by(id=conversation_id) \
+            .delete(synchronize_session=False)
+        return
+    session.query(Conversation).filter_by(id=conversation_id).update({
+        Conversation.last_message_id: latest.id,
+        Conversation.message_count: Conversation.message_count - 1,
+        Conversation.updated_at: latest.time_sent
+    }, synchronize_session=False)
+
+
+def mark_unread_delta(session, conversation_id, user_id, delta):
+    """ Adjust a participant's unread counters by delta. """
+
+    if conversation_id is not None:
+        session.query(ConversationMember).filter_by(
+            conversation_id=conversation_id, user_id=user_id).update(
+                {ConversationMember.unread: ConversationMember.unread + delta},
+                synchronize_session=False)
+    session.query(User).filter_by(id=user_id).update(
+        {User.unread_count: User.unread_count + delta},
+        synchronize_session=False)
+
+
+def mark_read(session, conversation_id, user_id):
+    """ Mark every message a user received in a conversation as read.
+
+        The caller commits.
+    """
+
+    count = session.query(Message).filter_by(
+        conversation_id=conversation_id, receiver_id=user_id, read=False) \
+        .update({Message.read: True}, synchronize_session=False)
+    if count:
+        mark_unread_delta(session, conversation_id, user_id, -count)
+    return count
+
+
+def inbox(session, user_id, cursor=None, per_page=INBOX_PAGE_SIZE):
+    """ One page of a user's conversations, most recently active first,
+        past a keyset cursor of (updated_at, conversation_id).
+
+        Returns (member, conversation, latest message) rows and the cursor
+        of the next page, or None when this page is the last one.
+    """
+
+    query = queries.inbox(session, user_id)
+    if cursor is not None:
+        updated_at, conversation_id = cursor
+        query = query.filter(or_(
+            ConversationMember.updated_at < updated_at,
+            and_(ConversationMember.updated_at == updated_at,
+                 ConversationMember.conversation_id < conversation_id)))
+    rows = query.limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    member = rows[per_page - 1][0]
+    return rows[:per_page], pagination.encode_cursor(
+        [member.updated_at, member.conversation_id])
+
+
+def conversation_messages(session, conversation_id):
+    """ Messages of a conversation in the order they were sent. """
+
+    return session.query(Message) \
+        .filter_by(conversation_id=conversation_id) \
+        .order_by(Message.id)
+
+
+def unread_count(session, user_id):
+    """ A user's total unread messages, read from the user row. """
+
+    return session.query(User.unread_count).filter_by(id=user_id).scalar() \
+        or 0
+
+
+def unthreaded_messages(connection):
+    """ Group messages without a conversation by (item, low, high). """
+
+    table = Message.__table__
+    messages = connection.execute(
+        select([table.c.id, table.c.sender_id, table.c.receiver_id,
+                table.c.item_id, table.c.time_sent])
+        .where(table.c.conversation_id.is_(None))
+        .order_by(table.c.id))
+    conversations = {}
+    for row in messages:
+        if row.sender_id is None or row.receiver_id is None:
+            continue
+        key = (row.item_id,) + participants(row.sender_id, row.receiver_id)
+        conversations.setdefault(key, []).append(row)
+    return conversations
+
+
+def backfill(connection):
+    """ Group messages without a conversation into conversations.
+
+        Used by the migration introducing conversations and after bulk
+        loading messages. The grouped messages are marked as read.
+    """
+
+    # Messages from before conversations carry no time sent
+    now = datetime.datetime.utcnow()
+    conversation_table = Conversation.__table__
+    previous_id = connection.execute(
+        select([func.max(conversation_table.c.id)])).scalar() or 0
+    grouped = unthreaded_messages(connection)
+    if not grouped:
+        return
+    # Ids come from the database so a Postgres sequence stays in step;
+    # inserted with executemany, which a bulk load needs to stay fast
+    connection.execute(conversation_table.insert(), [
+        {'item_id': item_id, 'user_low_id': low, 'user_high_id': high,
+         'last_message_id': rows[-1].id, 'message_count': len(rows),
+         'updated_at': rows[-1].time_sent or now}
+        for (item_id, low, high), rows in grouped.items()])
+    ids = dict(((row.item_id, row.user_low_id, row.user_high_id), row.id)
+               for row in connection.execute(
+                   select([conversation_table.c.id,
+                           conversation_table.c.item_id,
+                           conversation_table.c.user_low_id,
+                           conversation_table.c.user_high_id])
+                   .where(conversation_table.c.id > previous_id)))
+    members = []
+    assignments = []
+    for key, rows in grouped.items():
+        members.extend({'conversation_id': ids[key], 'user_id': member_id,
+                        'unread': 0,
+                        'updated_at': rows[-1].time_sent or now}
+                       for member_id in set(key[1:]))
+        assignments.extend({'message_id': row.id, 'conversation': ids[key]}
+                           for row in rows)
+    connection.execute(ConversationMember.__table__.insert(), members)
+    table = Message.__table__
+    connection.execute(
+        table.update().where(table.c.id == bindparam('message_id'))
+        .values(conversation_id=bindparam('conversation'), read=True),
+        assignments)
@@ -0,0 +1,267 @@
+"""
+Versioned schema migrations for the trading post database
+
+Usage:
+    python migrations.py status     Show the current and latest versions
+    python migrations.py upgrade    Apply pending migrations
+    python migrations.py explain    Show query plans for each route's queries
+"""
+
+import sys
+import datetime
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, \
+    inspect, insert, desc, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateColumn
+from database_setup import User, Location, Item, Message, Conversation, \
+    ConversationMember, Reservation, ItemArchive, ReservationArchive, \
+    MessageArchive, init_db
+import archive
+import engines
+import listings
+import matching
+import messaging
+import pagination
+import prices
+import queries
+import search
+
+# Bookkeeping table recording which migrations have been applied
+VERSION_METADATA = MetaData()
+SCHEMA_VERSION = Table(
+    "schema_version", VERSION_METADATA,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(250), nullable=False),
+    Column("applied_at", DateTime, nullable=False))
+
+
+def create_missing_indexes(connection, model):
+    """ Create the indexes declared on a model that the database lacks.
+
+        Lets a migration bring an existing database in line with the
+        indexes database_setup.py declares for new ones.
+    """
+
+    table = model.__table__
+    inspector = inspect(connection)
+    existing = set(index["name"]
+                   for index in inspector.get_indexes(table.name))
+    # Indexes on columns a later migration adds are created by that one
+    columns = set(column["name"]
+                  for column in inspector.get_columns(table.name))
+    for index in table.indexes:
+        if index.name not in existing and \
+                set(column.name for column in index.columns) <= columns:
+            index.create(connection)
+
+
+def add_missing_columns(connection, model):
+    """ Add the columns declared on a model that the database lacks.
+
+        New columns must be nullable or have a server default.
+    """
+
+    table = model.__table__
+    existing = set(column["name"]
+                   for column in inspect(connection).get_columns(table.name))
+    for column in table.columns:
+        if column.name not in existing:
+            connection.execute("ALTER TABLE %s ADD COLUMN %s" % (
+                connection.dialect.identifier_preparer.format_table(table),
+                CreateColumn(column).compile( # pylint: disable=no-value-for-parameter
+                    dialect=connection.dialect)))
+
+
+def add_lookup_indexes(connection):
+    """ Index the columns the routes filter and sort on. """
+
+    for model in (Location, User, Item, Message):
+        create_missing_indexes(connection, model)
+
+
+def add_conversations(connection):
+    """ Thread messages into conversations with unread counters.
+
+        Existing messages are grouped into conversations and marked read.
+    """
+
+    for model in (User, Message):
+        add_missing_columns(connection, model)
+    for model in (Conversation, ConversationMember):
+        model.__table__.create(connection, checkfirst=True)
+        create_missing_indexes(connection, model)
+    create_missing_indexes(connection, Message)
+    messaging.backfill(connection)
+
+
+def add_wants(connection):
+    """ Index items by card for trade matching and match existing wants.
+
+    """
+
+    create_missing_indexes(connection, Item)
+    matching.rebuild(connection)
+
+
+def add_reservations(connection):
+    """ Version items for compare-and-swap writes and add reservations.
+
+    """
+
+    add_missing_columns(connection, Item)
+    Reservation.__table__.create(connection, checkfirst=True)
+    create_missing_indexes(connection, Reservation)
+
+
+def add_archives(connection):
+    """ Add the tables archived items, reservations and messages move to.
+
+    """
+
+    for model in (ItemArchive, ReservationArchive, MessageArchive):
+        model.__table__.create(connection, checkfirst=True)
+        create_missing_indexes(connection, model)
+
+
+def drop_sold_out_matches(connection):
+    """ Drop the trade matches of items with no copies left. """
+
+    connection.execute(matching.MATCH.delete().where(
+        matching.MATCH.c.item_id.in_(select([matching.ITEM.c.id])
+                                     .where(matching.ITEM.c.quantity <= 0))))
+
+
+# Ordered list of (version, description, function). Functions receive a
+# connection inside a transaction and must be safe to run against a
+# database whose tables were just created with the current models.
+MIGRATIONS = [
+    (1, "Add lookup indexes for routes", add_lookup_indexes),
+    (2, "Add item full-text search index", search.install),
+    (3, "Thread messages into conversations", add_conversations),
+    (4, "Precompute location listings and totals", listings.rebuild),
+    (5, "Record price history and daily rollups", prices.rebuild),
+    (6, "Add wants and trade matches", add_wants),
+    (7, "Add item versions and reservations", add_reservations),
+    (8, "Add archive tables", add_archives),
+    (9, "Drop trade matches of sold-out items", drop_sold_out_matches),
+]
+
+
+def latest_version():
+    """ Return the version the newest migration brings the schema to. """
+
+    return MIGRATIONS[-1][0]
+
+
+def current_version(engine):
+    """ Return the version the database is at, 0 if never migrated. """
+
+    SCHEMA_VERSION.create(engine, checkfirst=True)
+    result = engine.execute(SCHEMA_VERSION.select()
+                            .order_by(desc(SCHEMA_VERSION.c.version))
+                            .limit(1)).first()
+    if result is None:
+        return 0
+    return result.version
+
+
+def upgrade(engine):
+    """ Apply every pending migration, each in its own transaction.
+
+        Returns the list of versions applied.
+    """
+
+    init_db(engine)
+    applied = []
+    version = current_version(engine)
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(insert(SCHEMA_VERSION).values(
+                version=number,
+                description=description,
+                applied_at=datetime.datetime.utcnow()))
+        applied.append(number)
+    return applied
+
+
+def route_queries(session):
+    """ Build a representative query for each route's database access.
+
+        Uses id 1 wherever a route takes an id.
+    """
+
+    return [
+        ("location cache refill: location list", queries.locations(session)),
+        ("show_main: latest items", queries.latest_items(session)),
+        ("show_items: location items",
+         queries.location_page_items(session, 1)),
+        ("show_items: location totals", queries.location_summary(session, 1)),
+        ("show_item: item by id", queries.item(session, 1)),
+        ("show_user_items: binder", queries.user_items(session, 1)),
+        ("show_user_messages: inbox", queries.inbox(session, 1)),
+        ("show_conversation: messages",
+         messaging.conversation_messages(session, 1)),
+        ("reply_message: message by id", queries.message(session, 1)),
+        ("gconnect: user by email",
+         queries.user_by_email(session, "john_smith@email.com")),
+        ("items_json: newest page",
+         pagination.keyset_query(session.query(Item), "newest").limit(100)),
+        ("user_matches_json: matches page",
+         pagination.keyset_query(matching.user_matches(session, 1), "id")
+         .limit(100)),
+        ("prices_json: daily rollups",
+         prices.history(session, "Black Lotus")),
+        ("show_archived_items: archived binder",
+         archive.user_items(session, 1)),
+        ("show_archived_messages: archived messages",
+         archive.user_messages(session, 1)),
+    ]
+
+
+def explain(engine, query):
+    """ Return the database's query plan for a query as a list of lines. """
+
+    compiled = query.statement.compile(dialect=engine.dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    if engine.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    rows = engine.execute(prefix + str(compiled), params)
+    return [" | ".join(str(value) for value in row) for row in rows]
+
+
+def main(argv):
+    """ Command line entry point. """
+
+    command = argv[1] if len(argv) > 1 else "status"
+    engine = engines.create(pooled=False)
+    if command == "status":
+        print "Schema version %d of %d" % (current_version(engine),
+                                           latest_version())
+    elif command == "upgrade":
+        applied = upgrade(engine)
+        for number in applied:
+            print "Applied migration %d" % number
+        print "Schema version %d" % current_version(engine)
+    elif command == "explain":
+        session = sessionmaker(bind=engine)()
+        for name, query in route_queries(session):
+            print name
+            for line in explain(engine, query):
+                print "    " + line
+        session.close()
+    else:
+        print __doc__
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,266 @@
+"""
+Push notifications for new messages and listings
+
+Routes record events on their database session with notify(); the events
+are published to a broker only once the transaction commits, so subscribers
+never hear about rows that were rolled back. A shared broker is published to
+by a background task, so the request does not wait on it; the in-process
+broker is handed events directly, since a task on a shared queue could run
+in another process whose subscribers are not the ones listening. Browsers
+subscribe through a Server-Sent Events stream and update the page in place
+instead of reloading it.
+
+Two interchangeable brokers are provided. Broker fans events out to the
+subscribers in its own process; SqliteBroker also writes them to a SQLite
+file that every worker process polls, so an event published by one worker
+reaches streams held open by the others, standing in for a shared broker
+such as Redis pub/sub.
+"""
+
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from six.moves import queue
+from cache import SqliteFile
+from pagination import CatalogJSONEncoder
+import tasks
+
+LOGGER = logging.getLogger(__name__)
+
+# Events buffered per subscriber before further events are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Seconds between SqliteBroker polls for events from other processes
+POLL_SECONDS = 0.5
+
+# Seconds SqliteBroker keeps published events for other processes to read
+RETENTION_SECONDS = 60
+
+
+def user_channel(user_id):
+    """ Channel carrying events for one user, such as new messages. """
+
+    return 'user:%d' % user_id
+
+
+def location_channel(location_id):
+    """ Channel carrying new listings at one location. """
+
+    return 'location:%d' % location_id
+
+
+class Subscription(object):
+    """ Queue of events published to a set of channels. """
+
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self.events = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, published):
+        """ Queue an event, dropping it if the subscriber has fallen behind.
+
+        """
+
+        try:
+            self.events.put_nowait(published)
+        except queue.Full:
+            LOGGER.warning('Dropped event for slow subscriber to %s',
+                           ', '.join(self.channels))
+
+    def get(self, timeout):
+        """ Next event, or None if none arrives within timeout seconds. """
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """ Stop receiving events. """
+
+        self.broker.unsubscribe(self)
+
+
+class Broker(object):
+    """ Thread-safe publish/subscribe within one process. """
+
+    # Whether events published reach the subscribers of every process
+    shared = False
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def subscribe(self, channels):
+        """ Return a Subscription receiving events published to channels.
+
+        """
+
+        subscription = Subscription(self, list(channels))
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Remove a subscription from every channel it listens to. """
+
+        with self.lock:
+            for channel in subscription.channels:
+                listeners = self.subscribers.get(channel)
+                if listeners is not None:
+                    listeners.discard(subscription)
+                    if not listeners:
+                        del self.subscribers[channel]
+
+    def publish(self, channel, kind, data):
+        """ Send an event of a kind with JSON serializable data to channel.
+
+        """
+
+        with self.lock:
+            event_id = next(self.ids)
+        self.deliver({'id': event_id, 'channel': channel, 'kind': kind,
+                      'data': data})
+
+    def deliver(self, published):
+        """ Hand an event to this process's subscribers of its channel. """
+
+        with self.lock:
+            listeners = list(self.subscribers.get(published['channel'], ()))
+        for subscription in listeners:
+            subscription.put(published)
+
+
+class SqliteBroker(Broker, SqliteFile):
+    """ Broker sharing events between processes through a SQLite file.
+
+        Published events are appended to a table. A daemon thread in each
+        process that has subscribers polls the table and delivers new
+        events locally, including the ones this process published.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        Broker.__init__(self)
+        SqliteFile.__init__(self, path)
+        self.poller = None
+        self.published = 0
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, '
+                'kind TEXT NOT NULL, data TEXT NOT NULL, '
+                'created_at REAL NOT NULL)')
+
+    def subscribe(self, channels):
+        """ Return a Subscription, starting the poller on first use. """
+
+        with self.lock:
+            if self.poller is None:
+                last_id = self.connect().execute(
+                    'SELECT MAX(id) FROM events').fetchone()[0] or 0
+                self.poller = threading.Thread(target=self.poll,
+                                               args=(last_id,))
+                self.poller.daemon = True
+                self.poller.start()
+        return Broker.subscribe(self, channels)
+
+    def publish(self, channel, kind, data):
+        """ Append an event for every process's subscribers to read. """
+
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT INTO events (channel, kind, data, created_at) '
+                'VALUES (?, ?, ?, ?)',
+                (channel, kind, json.dumps(data, cls=CatalogJSONEncoder), now))
+            self.published += 1
+            if self.published % 100 == 0:
+                connection.execute('DELETE FROM events WHERE created_at < ?',
+                                   (now - RETENTION_SECONDS,))
+
+    def poll(self, last_id):
+        """ Daemon thread delivering events appended after last_id. """
+
+        while True:
+            try:
+                rows = self.connect().execute(
+                    'SELECT id, channel, kind, data FROM events '
+                    'WHERE id > ? ORDER BY id', (last_id,)).fetchall()
+                for event_id, channel, kind, data in rows:
+                    self.deliver({'id': event_id, 'channel': channel,
+                                  'kind': kind, 'data': json.loads(data)})
+                    last_id = event_id
+            except sqlite3.Error:
+                LOGGER.exception('Polling for events failed')
+            time.sleep(POLL_SECONDS)
+
+
+def broker_from_url(url):
+    """ Build a broker from a URL such as memory:// or sqlite:///path.
+
+    """
+
+    if not url or url == 'memory://':
+        return Broker()
+    if url.startswith('sqlite:///'):
+        return SqliteBroker(url[len('sqlite:///'):])
+    raise ValueError('Unsupported broker URL: %s' % url)
+
+
+# Broker events are published to and streamed from in this process
+BROKER = broker_from_url(os.environ.get('TRADING_POST_BROKER_URL'))
+
+
+def notify(session, channel, kind, data):
+    """ Publish an event once session's transaction commits. """
+
+    if BROKER.shared:
+        tasks.after_commit(session, publish, channel, kind, data)
+    else:
+        tasks.call_after_commit(session, BROKER.publish, channel, kind, data)
+
+
+@tasks.task
+def publish(channel, kind, data):
+    """ Background task publishing an event to the shared broker. """
+
+    BROKER.publish(channel, kind, data)
+
+
+def format_event(published):
+    """ Encode an event in the Server-Sent Events wire format. """
+
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (
+        published['id'], published['kind'],
+        json.dumps(published['data'], cls=CatalogJSONEncoder))
+
+
+def stream(subscription, keepalive, duration):
+    """ Generate a Server-Sent Events body from a subscription.
+
+        Sends a comment every keepalive seconds so proxies keep the
+        connection open, and ends after duration seconds so the worker
+        thread holding the stream is released; browsers reconnect on their
+        own. The caller closes the subscription when the response closes.
+    """
+
+    yield 'retry: 3000\n\n'
+    deadline = time.time() + duration
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        published = subscription.get(min(keepalive, remaining))
+        if published is None:
+            yield ': keepalive\n\n'
+        else:
+            yield format_event(published)
@@ -0,0 +1,116 @@
+"""
+Cache of rendered public pages
+
+Anonymous visitors all see the same page for a given route and location, so
+the rendered HTML is stored in the shared cache backend. Each entry is tagged
+with the data versions it was rendered from; writes bump those versions
+instead of deleting pages, which also gives every page a cheap ETag that can
+be checked before any rendering or database work.
+
+Pages are only cached when the backend is shared by every worker process.
+With a per-process backend, a write bumps the versions of the process that
+made it only, so the others would keep serving the old page, and counters
+that start from 0 in every process would hand out the same ETag for
+different pages.
+"""
+
+import os
+import time
+import uuid
+import cache
+
+# Seconds an unused page stays in the backend
+PAGE_TTL = int(os.environ.get('TRADING_POST_PAGE_TTL', 3600))
+
+# Version key covering items at every location
+ALL_ITEMS = 'all'
+
+# Backend key holding the random epoch every ETag carries
+EPOCH_KEY = 'pages:epoch'
+
+
+def enabled():
+    """ Whether pages are cached, which needs a backend shared by every
+        process.
+    """
+
+    return cache.BACKEND.shared
+
+
+def epoch():
+    """ Random token naming the backend's current run of version counters.
+
+        Set on first use, so counters starting again from 0 in a new or
+        emptied backend never repeat an ETag handed out before.
+    """
+
+    value = cache.BACKEND.get(EPOCH_KEY)
+    if value is None:
+        value = uuid.uuid4().hex[:8]
+        cache.BACKEND.set(EPOCH_KEY, value)
+    return value
+
+
+def version_key(scope):
+    """ Backend key holding the item version for a location or ALL_ITEMS.
+
+    """
+
+    return 'items:version:%s' % scope
+
+
+def item_version(scope):
+    """ Current item version for a location or ALL_ITEMS. """
+
+    return cache.BACKEND.get(version_key(scope)) or 0
+
+
+def bump(*location_ids):
+    """ Record that items changed at the given locations.
+
+        Called after committing an item write. Pages for those locations
+        and pages listing items from every location go stale.
+    """
+
+    cache.BACKEND.incr(version_key(ALL_ITEMS))
+    for location_id in set(location_ids):
+        if location_id is not None:
+            cache.BACKEND.incr(version_key(location_id))
+
+
+def etag(route, location_id=None):
+    """ Entity tag for a page built from the current data versions. """
+
+    scope = ALL_ITEMS if location_id is None else location_id
+    return '%s-%s-%s-%d-%d' % (route, scope, epoch(), item_version(scope),
+                               cache.LOCATIONS.version())
+
+
+def page_key(route, location_id=None):
+    """ Backend key holding the rendered page. """
+
+    return 'page:%s:%s' % (route, location_id)
+
+
+def lookup(route, location_id=None):
+    """ Return the current ETag and the cached page if it matches it.
+
+        The page is a dict with 'body' and 'last_modified' (a Unix time),
+        or None when it has to be rendered again.
+    """
+
+    tag = etag(route, location_id)
+    page = cache.BACKEND.get(page_key(route, location_id))
+    if page is None or page['etag'] != tag:
+        return tag, None
+    return tag, page
+
+
+def store(route, location_id, tag, body):
+    """ Cache a freshly rendered page under the ETag it was rendered for.
+
+    """
+
+    page = {'etag': tag, 'body': body, 'last_modified': int(time.time())}
+    cache.BACKEND.set(page_key(route, location_id), page, PAGE_TTL)
+    return page
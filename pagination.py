@@ -0,0 +1,168 @@
+"""
+Keyset pagination and streaming helpers for the JSON API
+"""
+
+import base64
+import datetime
+import decimal
+import json
+from sqlalchemy import and_, or_
+from flask.json import JSONEncoder
+import projection
+
+# Page size used when the client does not ask for one, and the cap on it
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# Number of rows fetched per round trip when streaming
+STREAM_BATCH_SIZE = 500
+
+# Supported sort orders mapped to the columns making up their keyset
+ORDERS = {
+    'id': ('id',),
+    'newest': ('time_added', 'id')
+}
+
+
+class CatalogJSONEncoder(JSONEncoder):
+    """ JSON encoder understanding the column types used by the catalog.
+
+        Prices are encoded as strings so no precision is lost, timestamps
+        and dates as ISO 8601 so they sort lexically and round-trip through
+        cursors.
+    """
+
+    def default(self, o): # pylint: disable=method-hidden
+        if isinstance(o, decimal.Decimal):
+            return str(o)
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+        return JSONEncoder.default(self, o)
+
+
+class CursorError(ValueError):
+    """ Raised when a pagination parameter cannot be understood. """
+
+
+def encode_cursor(values):
+    """ Encode the keyset of the last row of a page as an opaque token. """
+
+    raw = json.dumps(values, cls=CatalogJSONEncoder)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token, order):
+    """ Decode a cursor token back into the keyset values for an order.
+
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise CursorError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(ORDERS[order]):
+        raise CursorError('Invalid cursor')
+    if order == 'newest':
+        try:
+            values[0] = datetime.datetime.strptime(values[0],
+                                                   '%Y-%m-%dT%H:%M:%S.%f')
+        except (TypeError, ValueError):
+            try:
+                values[0] = datetime.datetime.strptime(values[0],
+                                                       '%Y-%m-%dT%H:%M:%S')
+            except (TypeError, ValueError):
+                raise CursorError('Invalid cursor')
+    return values
+
+
+def parse_cursor(token, order):
+    """ Decode the cursor parameter if one was given, else return None. """
+
+    if not token:
+        return None
+    return decode_cursor(token, order)
+
+
+def parse_limit(value):
+    """ Validate the limit parameter, falling back to the default page size.
+
+    """
+
+    if value is None or value == '':
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise CursorError('Invalid limit')
+    if limit < 1:
+        raise CursorError('Invalid limit')
+    return min(limit, MAX_LIMIT)
+
+
+def parse_order(value):
+    """ Validate the order parameter. """
+
+    order = value or 'id'
+    if order not in ORDERS:
+        raise CursorError('Invalid order')
+    return order
+
+
+def keyset_query(query, order, cursor=None):
+    """ Order a query of items or listings by keyset and seek past the
+        given cursor.
+
+        'id' walks the catalog by ascending id, 'newest' by descending
+        (time_added, id). Both resolve to an index range scan instead of an
+        OFFSET that has to read and discard every earlier row.
+    """
+
+    model = query.column_descriptions[0]['entity']
+    if order == 'newest':
+        query = query.order_by(model.time_added.desc(), model.id.desc())
+        if cursor is not None:
+            time_added, item_id = cursor
+            query = query.filter(or_(
+                model.time_added < time_added,
+                and_(model.time_added == time_added, model.id < item_id)))
+        return query
+    query = query.order_by(model.id.asc())
+    if cursor is not None:
+        query = query.filter(model.id > cursor[0])
+    return query
+
+
+def cursor_for(item, order):
+    """ Build the cursor token pointing just past an item. """
+
+    return encode_cursor([getattr(item, name) for name in ORDERS[order]])
+
+
+def paginate(query, order, cursor, limit):
+    """ Fetch one page of a keyset-ordered query.
+
+        Returns the items and the cursor for the next page, or None when
+        this page is the last one.
+    """
+
+    rows = keyset_query(query, order, cursor).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, cursor_for(rows[-1], order)
+
+
+def stream_ndjson(query, order, cursor=None, limit=None):
+    """ Yield the rows of a projected query as newline-delimited JSON.
+
+        Rows are fetched STREAM_BATCH_SIZE at a time with yield_per so
+        memory stays flat regardless of the size of the result.
+    """
+
+    query = keyset_query(query, order, cursor)
+    if limit is not None:
+        query = query.limit(limit)
+    encode = projection.row_encoder(query)
+    for row in query.yield_per(STREAM_BATCH_SIZE):
+        yield json.dumps(encode(row), separators=(',', ':'),
+                         sort_keys=True) + '\n'
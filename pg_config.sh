@@ -11,3 +11,6 @@ pip install oauth2client
 pip install requests
 pip install httplib2
 pip install pylint==1.9.3
+# Local Postgres database for TRADING_POST_DATABASE_URL=postgresql:///tradingpost
+sudo -u postgres createuser -s vagrant || true
+sudo -u postgres createdb -O vagrant tradingpost || true
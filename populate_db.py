@@ -3,14 +3,18 @@ Populate postgresql database for testing
 """
 
 import datetime
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 # Import empty database we created in database_setup.py
-from database_setup import BASE, User, Location, Item, Message
+from database_setup import BASE, User, Location, Item
+import engines
+import listings # pylint: disable=unused-import
+import matching # pylint: disable=unused-import
+import messaging
+import prices # pylint: disable=unused-import
 
 # Let our program know which database engine we want to communicate with
-ENGINE = create_engine('sqlite:///catalog.db')
+ENGINE = engines.create(pooled=False)
 
 # Bind engine to Base class so declaratives can be accessed through DBSession
 BASE.metadata.bind = ENGINE
@@ -66,12 +70,7 @@ SESSION.add(Item(
     time_added=datetime.datetime.utcnow()))
 
 # Add messages
-SESSION.add(Message(
-    sender_id=1,
-    receiver_id=2,
-    item_id=2,
-    message="I want that Mox Ruby!"
-))
+messaging.send_message(SESSION, 1, 2, 2, "I want that Mox Ruby!")
 
 # Commit session
 SESSION.commit()
@@ -0,0 +1,270 @@
+"""
+Price history and daily price rollups
+
+Editing an item overwrites its price and deleting it removes it, so every
+asking price is also appended to the price_event table: by mapper events for
+writes made through the ORM, and by record_added() after bulk loads that
+bypass it. rollup() folds new events into price_rollup, which holds the
+lowest, median and highest price asked per card per day. It only reads
+events added since its previous run, plus the other events of the days they
+touch, so price history is served from rollups however many events pile up.
+
+Usage:
+    python prices.py    Fold new price events into the daily rollups
+"""
+
+import datetime
+import decimal
+import itertools
+import sys
+import time
+from sqlalchemy import event, select, exists, func, inspect, literal
+from database_setup import Item, PriceEvent, PriceRollup, JobProgress
+import engines
+
+EVENT = PriceEvent.__table__
+ROLLUP = PriceRollup.__table__
+PROGRESS = JobProgress.__table__
+ITEM = Item.__table__
+
+# Item columns recorded with each price event
+RECORDED = ('name', 'cardset', 'condition', 'price')
+
+# Events that put a price on the market; deletions only record the last one
+ASKING_KINDS = ('added', 'edited')
+
+# Job name of the rollup in the job_progress table
+ROLLUP_JOB = 'price_rollup'
+
+# Events read per rollup transaction
+ROLLUP_BATCH_SIZE = 10000
+
+# Seconds events must have been recorded before the rollup reads them.
+# Ids are handed out before transactions commit, so a recent id may still
+# become visible after a higher one has been processed.
+SETTLE_SECONDS = 60
+
+# Days of history the JSON API returns by default and at most
+DEFAULT_DAYS = 30
+MAX_DAYS = 366
+
+
+def record(connection, kind, item):
+    """ Append a price event for an item. """
+
+    values = dict((name, getattr(item, name)) for name in RECORDED)
+    values['price'] = decimal.Decimal(str(values['price']))
+    connection.execute(EVENT.insert().values(
+        item_id=item.id, kind=kind,
+        recorded_at=datetime.datetime.utcnow(), **values))
+
+
+# pylint: disable=unused-argument
+@event.listens_for(Item, 'after_insert')
+def item_inserted(mapper, connection, target):
+    """ Record a new item's asking price. """
+
+    record(connection, 'added', target)
+
+
+@event.listens_for(Item, 'after_update')
+def item_updated(mapper, connection, target):
+    """ Record an edited item's asking price. """
+
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in RECORDED):
+        record(connection, 'edited', target)
+
+
+@event.listens_for(Item, 'before_delete')
+def item_deleted(mapper, connection, target):
+    """ Record the last asking price of an item being deleted. """
+
+    record(connection, 'deleted', target)
+# pylint: enable=unused-argument
+
+
+def record_added(connection, where=None):
+    """ Record items written without the ORM, such as by bulk import.
+
+        Adds an "added" event, dated when the item was added, for each item
+        matching where that has no events yet.
+    """
+
+    source = select([ITEM.c.id, literal('added')] +
+                    [ITEM.c[name] for name in RECORDED] +
+                    [func.coalesce(ITEM.c.time_added,
+                                   datetime.datetime.utcnow())]) \
+        .where(~exists().where(EVENT.c.item_id == ITEM.c.id))
+    if where is not None:
+        source = source.where(where)
+    connection.execute(EVENT.insert().from_select(
+        ['item_id', 'kind'] + list(RECORDED) + ['recorded_at'], source))
+
+
+def median(prices):
+    """ Median of a sorted list of prices, rounded to the cent. """
+
+    middle = len(prices) // 2
+    if len(prices) % 2:
+        return prices[middle]
+    return ((prices[middle - 1] + prices[middle]) / 2) \
+        .quantize(decimal.Decimal('0.01'))
+
+
+def day_bounds(day):
+    """ First instant of a day and of the day after. """
+
+    start = datetime.datetime.combine(day, datetime.time())
+    return start, start + datetime.timedelta(days=1)
+
+
+def refresh_rollup(connection, name, cardset, condition, day):
+    """ Recompute one card's rollup for one day from its events.
+
+        Reads one range of the (name, cardset, condition, recorded_at)
+        index.
+    """
+
+    start, end = day_bounds(day)
+    prices = sorted(decimal.Decimal(str(price)) for price, in
+                    connection.execute(
+                        select([EVENT.c.price])
+                        .where(EVENT.c.name == name)
+                        .where(EVENT.c.cardset == cardset)
+                        .where(EVENT.c.condition == condition)
+                        .where(EVENT.c.recorded_at >= start)
+                        .where(EVENT.c.recorded_at < end)
+                        .where(EVENT.c.kind.in_(ASKING_KINDS))))
+    where = (ROLLUP.c.name == name) & (ROLLUP.c.cardset == cardset) & \
+        (ROLLUP.c.condition == condition) & (ROLLUP.c.day == day)
+    connection.execute(ROLLUP.delete().where(where))
+    if prices:
+        connection.execute(ROLLUP.insert().values(
+            name=name, cardset=cardset, condition=condition, day=day,
+            event_count=len(prices), price_min=prices[0],
+            price_median=median(prices), price_max=prices[-1]))
+
+
+def rollup_batch(connection, settled):
+    """ Fold the next batch of settled events into the rollups.
+
+        Returns the number of events read, 0 once caught up.
+    """
+
+    last_id = connection.execute(select([PROGRESS.c.last_id])
+                                 .where(PROGRESS.c.job == ROLLUP_JOB)) \
+        .scalar()
+    if last_id is None:
+        last_id = 0
+        connection.execute(PROGRESS.insert().values(job=ROLLUP_JOB,
+                                                    last_id=0))
+    rows = connection.execute(
+        select([EVENT.c.id, EVENT.c.kind, EVENT.c.name, EVENT.c.cardset,
+                EVENT.c.condition, EVENT.c.recorded_at])
+        .where(EVENT.c.id > last_id)
+        .where(EVENT.c.recorded_at < settled)
+        .order_by(EVENT.c.id).limit(ROLLUP_BATCH_SIZE)).fetchall()
+    if not rows:
+        return 0
+    touched = set((row.name, row.cardset, row.condition,
+                   row.recorded_at.date())
+                  for row in rows if row.kind in ASKING_KINDS)
+    for name, cardset, condition, day in sorted(touched):
+        refresh_rollup(connection, name, cardset, condition, day)
+    connection.execute(PROGRESS.update()
+                       .where(PROGRESS.c.job == ROLLUP_JOB)
+                       .values(last_id=rows[-1].id))
+    return len(rows)
+
+
+def rollup(engine, settle_seconds=SETTLE_SECONDS):
+    """ Fold every settled event not yet rolled up into the rollups.
+
+        Each batch commits with the progress it made, so an interrupted
+        run resumes where it stopped. Returns the number of events read.
+    """
+
+    settled = datetime.datetime.utcnow() - \
+        datetime.timedelta(seconds=settle_seconds)
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            count = rollup_batch(connection, settled)
+        if not count:
+            return total
+        total += count
+
+
+def rollup_rows(events):
+    """ Rollup rows of (name, cardset, condition, recorded_at, price)
+        events sorted in that order.
+    """
+
+    days = itertools.groupby(events, lambda row: (row[0], row[1], row[2],
+                                                  row[3].date()))
+    for (name, cardset, condition, day), rows in days:
+        prices = sorted(decimal.Decimal(str(row[4])) for row in rows)
+        yield {'name': name, 'cardset': cardset, 'condition': condition,
+               'day': day, 'event_count': len(prices),
+               'price_min': prices[0], 'price_median': median(prices),
+               'price_max': prices[-1]}
+
+
+def rebuild(connection):
+    """ Record events for existing items and roll up all of them.
+
+        Used by the migration introducing price history and after bulk
+        loads. Reads the events once in index order rather than day by day.
+    """
+
+    record_added(connection)
+    connection.execute(ROLLUP.delete())
+    events = connection.execute(
+        select([EVENT.c.name, EVENT.c.cardset, EVENT.c.condition,
+                EVENT.c.recorded_at, EVENT.c.price])
+        .where(EVENT.c.kind.in_(ASKING_KINDS))
+        .order_by(EVENT.c.name, EVENT.c.cardset, EVENT.c.condition,
+                  EVENT.c.recorded_at))
+    rows = rollup_rows(events)
+    while True:
+        chunk = list(itertools.islice(rows, ROLLUP_BATCH_SIZE))
+        if not chunk:
+            break
+        connection.execute(ROLLUP.insert(), chunk)
+    last_id = connection.execute(select([func.max(EVENT.c.id)])).scalar()
+    connection.execute(PROGRESS.delete().where(PROGRESS.c.job == ROLLUP_JOB))
+    connection.execute(PROGRESS.insert().values(job=ROLLUP_JOB,
+                                                last_id=last_id or 0))
+
+
+def history(session, name, cardset=None, condition=None, days=DEFAULT_DAYS):
+    """ Query of a card's daily rollups over the last days, oldest first.
+
+        Cardset and condition narrow the card down when given.
+    """
+
+    first_day = datetime.datetime.utcnow().date() - \
+        datetime.timedelta(days=days - 1)
+    query = session.query(PriceRollup).filter(PriceRollup.name == name)
+    if cardset:
+        query = query.filter(PriceRollup.cardset == cardset)
+    if condition:
+        query = query.filter(PriceRollup.condition == condition)
+    return query.filter(PriceRollup.day >= first_day) \
+        .order_by(PriceRollup.day, PriceRollup.cardset,
+                  PriceRollup.condition)
+
+
+def main():
+    """ Command line entry point. """
+
+    start = time.time()
+    count = rollup(engines.create(pooled=False))
+    print "Rolled up %d price events in %.1f s" % (count,
+                                                   time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,25 +2,145 @@
 Main trading post Flask application file
 """
 
+import os
+import datetime
 import random
 import string
 import json
+import logging
 from flask import Flask, render_template, request, redirect, jsonify, \
-    url_for, flash, make_response, session as login_session
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker
-import httplib2
-import requests
-from database_setup import BASE, User, Location, Item, Message
+    url_for, flash, make_response, Response, stream_with_context, g, abort, \
+    session as login_session
+from sqlalchemy.orm.exc import StaleDataError
+from database_setup import BASE, CONDITIONS, User, Item, Want
+import api
+import archive
+import assets
+import bulk
+import cache
+import engines
+import identity
+import instrumentation
+import listings
+import matching
+import messaging
+import migrations
+import notifications
+import pagecache
+import pagination
+import queries
+import reservations
+import search
+import tasks
 
 # Create instance of flask class with the name of the running application
 APP = Flask(__name__)
+APP.json_encoder = pagination.CatalogJSONEncoder
+api.init_app(APP)
+
+# Client verifying sign-in tokens, selected by TRADING_POST_IDENTITY
+IDENTITY = identity.client_from_environment()
+
+
+# Settings read by create_app(), overridable through its config argument
+APP.config['DATABASE_URL'] = engines.database_url()
+APP.config['REPLICA_URLS'] = engines.replica_urls()
+APP.config['SLOW_QUERY_MS'] = int(
+    os.environ.get('TRADING_POST_SLOW_QUERY_MS', 100))
+APP.config['PROFILE_DIR'] = os.environ.get('TRADING_POST_PROFILE_DIR')
+
+# Session registries the routes use, see engines.py
+DBSESSION = engines.DBSESSION
+SESSION = engines.SESSION
+READ_SESSION = engines.READ_SESSION
+
+# The primary engine followed by the read engines, once created
+ENGINES = []
+
+
+def create_app(config=None):
+    """ Configure the application and connect it to its databases.
+
+        config overrides settings such as DATABASE_URL and REPLICA_URLS.
+        Importing this module creates no engine and runs no SQL, so scripts
+        and worker processes only pay for what they use; engines are created
+        here and connect on first use. Later calls return the application
+        as first configured.
+    """
+
+    if ENGINES:
+        return APP
+    APP.config.update(config or {})
+    engine = engines.create(APP.config['DATABASE_URL'])
+    read_engines = engines.create_readers(APP.config['REPLICA_URLS'],
+                                          APP.config['DATABASE_URL'])
+    ENGINES.extend([engine] + read_engines)
+    BASE.metadata.bind = engine
+    SESSION.configure(bind=engine)
+    READ_SESSION.configure(engines=read_engines)
+    # Fingerprinted static files and compressed responses
+    assets.init_app(APP)
+    # Request timing, SQL and template metrics, slow query log and profiling
+    instrumentation.init_app(APP, *ENGINES)
+    # Run queued tasks on this process's worker threads, including any left
+    # in a durable queue by an earlier run
+    tasks.WORKERS.start()
+    return APP
+
+
+@APP.cli.command('init-db')
+def init_db_command():
+    """ Create the database's tables and apply pending migrations. """
+
+    create_app()
+    for number in migrations.upgrade(ENGINES[0]):
+        print "Applied migration %d" % number
+    print "Schema version %d" % migrations.current_version(ENGINES[0])
+
+
+@APP.teardown_appcontext
+def remove_session(exception=None): # pylint: disable=unused-argument
+    """ Release the request's sessions and return their connections to the
+        pool.
+    """
+
+    SESSION.remove()
+    READ_SESSION.remove()
+
+
+@APP.errorhandler(StaleDataError)
+def write_conflict(error): # pylint: disable=unused-argument
+    """ Ask the user to check an item again when their write lost a race.
+
+        Items are versioned, so an edit or delete committed after someone
+        else changed the item, such as by reserving copies, fails instead
+        of overwriting that change.
+    """
+
+    SESSION.rollback()
+    flash('The item changed meanwhile, check it and try again')
+    return redirect(url_for('show_user_items'))
+
+
+@APP.context_processor
+def inject_unread_count():
+    """ Give templates the signed-in user's unread message count.
+
+        Passed as a function so only pages showing the badge read it.
+    """
+
+    def unread_count():
+        """ Unread messages for the signed-in user, one primary key read. """
+
+        if 'user_id' not in login_session:
+            return 0
+        if 'unread_count' not in g:
+            g.unread_count = messaging.unread_count(
+                READ_SESSION, login_session['user_id'])
+        return g.unread_count
+
+    return {'unread_count': unread_count}
 
-# Create session and connect to database
-ENGINE = create_engine('sqlite:///catalog.db')
-BASE.metadata.bind = ENGINE
-DBSESSION = sessionmaker(bind=ENGINE)
-SESSION = DBSESSION()
 
 @APP.route('/login')
 def show_login():
@@ -46,15 +166,24 @@ def gconnect():
         response = make_response(json.dumps('Invalid state parameter.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    # Store access token in session for later use
+    # Get user info
     access_token = request.data
+    try:
+        email = IDENTITY.verify(access_token)
+    except identity.IdentityBusy:
+        response = make_response(json.dumps(
+            'Too many log-ins in progress, try again.'), 503)
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Retry-After'] = '1'
+        return response
+    except identity.IdentityError:
+        response = make_response(json.dumps(
+            'Failed to verify access token.'), 401)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    # Store access token in session for later use
     login_session['access_token'] = access_token
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-    data = answer.json()
-    login_session['email'] = data['email']
+    login_session['email'] = email
     # See if user exists, if not then make a new one
     user_id = get_user_id(login_session['email'])
     if not user_id:
@@ -69,6 +198,18 @@ def gconnect():
     return output
 
 
+@tasks.task
+def revoke_token(access_token):
+    """ Background task revoking a signed-out user's token.
+
+        Errors reaching the provider raise and are retried; a refusal is
+        final.
+    """
+
+    if not IDENTITY.revoke_token(access_token):
+        logging.getLogger(__name__).warning('Token revocation was refused')
+
+
 @APP.route('/gdisconnect')
 def gdisconnect():
     """ Disconnect user from Google.
@@ -81,15 +222,18 @@ def gdisconnect():
             'Current user not connected'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    # Revoke access token
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=' + access_token
-    http_var = httplib2.Http()
-    result = http_var.request(url, 'GET')[0]
+    # Revoke access token, in the background if configured to
+    if APP.config.get('ASYNC_REVOKE'):
+        IDENTITY.forget(access_token)
+        tasks.enqueue(revoke_token, access_token)
+        revoked = True
+    else:
+        revoked = IDENTITY.revoke(access_token)
     output = ''
     # Delete login session
     del login_session['access_token']
     del login_session['email']
-    if result['status'] == '200':
+    if revoked:
         output += '<h1> Successfully disconnected </h1>'
     else:
         output += '<h1> Unable to disconnect user </h1>'
@@ -111,24 +255,33 @@ def location_json(location):
     return jsonify(locations=[c.serialize for c in locations])
 
 
-@APP.route('/location/<int:location_id>/JSON')
-def location_items_json(location_id):
-    """ API endpoint to return all items of a given location.
-
-    """
-
-    items = SESSION.query(Item).filter_by(location_id=location_id).all()
-    return jsonify(items=[i.serialize for i in items])
-
+@APP.route('/search')
+def search_items():
+    """ Search page for card name and set
 
-@APP.route('/items/JSON')
-def items_json():
-    """ API endpoint to return all items.
 
     """
 
-    items = SESSION.query(Item).all()
-    return jsonify(items=[i.serialize for i in items])
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    try:
+        arguments = search.parse_arguments(request.args)
+    except ValueError:
+        flash('Invalid search')
+        arguments = None
+    if arguments:
+        items, has_more = search.search(READ_SESSION, **arguments)
+    else:
+        items, has_more = [], False
+    return render_template('search.html',
+                           logged_in='email' in login_session,
+                           locations=locations,
+                           conditions=CONDITIONS,
+                           items=items,
+                           has_more=has_more,
+                           page=arguments['page'] if arguments else 1,
+                           args=dict((key, value) for key, value
+                                     in request.args.items()
+                                     if key != 'page'))
 
 
 @APP.route('/location/<int:location_id>/')
@@ -136,26 +289,70 @@ def items_json():
 def show_items(location_id):
     """ Show items for selected location
 
-
+        Only reads; users move to a location with set_location. Listings
+        are paged by keyset; pass the cursor of the More link back as
+        ?cursor=. Only the first page is served from the page cache and
+        has new listings added to it live.
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    location = SESSION.query(Location).filter_by(id=location_id).one()
-    items = SESSION.query(Item).join(User).filter(User.location_id == location_id).all()
+    location = cache.LOCATIONS.find(READ_SESSION, location_id)
+    if location is None:
+        abort(404)
+    try:
+        cursor = pagination.parse_cursor(request.args.get('cursor'),
+                                         'newest')
+    except pagination.CursorError:
+        cursor = None
     if 'email' not in login_session:
-        return render_template('publicitems.html',
-                               locations=locations,
-                               location=location,
-                               items=items)
-    # Update location of user
-    user = SESSION.query(User).filter_by(id=login_session['user_id']).one()
-    user.location_id = location_id
-    location = SESSION.query(Location).filter_by(id=location_id).one()
+        def render():
+            """ Render the page for anonymous visitors. """
+            items, next_cursor = location_page(location_id, cursor)
+            return render_template(
+                'publicitems.html',
+                locations=cache.LOCATIONS.get(READ_SESSION),
+                location=location,
+                summary=queries.location_summary(READ_SESSION,
+                                                 location_id).first(),
+                items=items,
+                next_cursor=next_cursor,
+                first_page=cursor is None)
+        if cursor is not None:
+            return render()
+        return public_page('show_items', location_id, render)
+    user = current_user()
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    summary = queries.location_summary(READ_SESSION, location_id).first()
+    items, next_cursor = location_page(location_id, cursor)
     return render_template('privateitems.html',
                            user_id=login_session['user_id'],
+                           user_location_id=user.location_id,
                            locations=locations,
                            location=location,
-                           items=items)
+                           summary=summary,
+                           items=items,
+                           next_cursor=next_cursor,
+                           first_page=cursor is None)
+
+
+@APP.route('/user/location', methods=['POST'])
+def set_location():
+    """ Move the user, and the items in their binder, to a location
+
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    location_id = request.form.get('location_id', type=int)
+    if cache.LOCATIONS.find(SESSION, location_id) is None:
+        abort(400)
+    user = queries.user(SESSION, login_session['user_id']).one()
+    previous_location_id = user.location_id
+    if previous_location_id != location_id:
+        user.location_id = location_id
+        SESSION.commit()
+        pagecache.bump(previous_location_id, location_id)
+        flash('Location changed')
+    return redirect(url_for('show_items', location_id=location_id))
 
 
 @APP.route('/items/<int:item_id>', methods=['GET', 'POST'])
@@ -165,18 +362,16 @@ def show_item(item_id):
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    item = SESSION.query(Item).filter_by(id=item_id).one()
-    user = SESSION.query(User).filter_by(id=login_session["user_id"]).one()
     if request.method == "POST":
-        new_message = Message(sender_id=login_session["user_id"],
-                              receiver_id=item.user_id,
-                              item_id=item_id,
-                              message=request.form["message"])
-        SESSION.add(new_message)
+        item = queries.item(SESSION, item_id).one()
+        user = current_user()
+        messaging.send_message(SESSION, user.id,
+                               item.user_id, item_id, request.form["message"])
         SESSION.commit()
         flash("Message sent")
         return redirect(url_for("show_items", location_id=user.location_id))
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    item = queries.item(READ_SESSION, item_id).one()
     return render_template('privateitem.html',
                            user_id=login_session['user_id'],
                            locations=locations,
@@ -190,8 +385,8 @@ def show_user_items():
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    items = SESSION.query(Item).filter_by(user_id=login_session['user_id']).all()
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    items = queries.user_items(READ_SESSION, login_session['user_id']).all()
     return render_template('useritems.html',
                            locations=locations,
                            items=items)
@@ -204,8 +399,8 @@ def show_user_item(item_id):
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    item = SESSION.query(Item).filter_by(id=item_id).one()
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    item = queries.item(READ_SESSION, item_id).one()
     return render_template('useritem.html',
                            user_id=login_session['user_id'],
                            locations=locations,
@@ -216,37 +411,115 @@ def show_user_item(item_id):
 def show_user_messages():
     """ Show user messages
 
-
+        Conversations are paged by keyset; pass the cursor of the Older
+        link back as ?cursor=.
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    messages = SESSION.query(Message) \
-               .filter_by(receiver_id=login_session["user_id"]) \
-               .join(Item) \
-               .all()
+    try:
+        cursor = pagination.parse_cursor(request.args.get('cursor'),
+                                         'newest')
+    except pagination.CursorError:
+        cursor = None
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    conversations, next_cursor = messaging.inbox(
+        READ_SESSION, login_session["user_id"], cursor)
     return render_template('usermessages.html',
                            user_id=login_session['user_id'],
-                           messages=messages,
+                           conversations=conversations,
+                           first_page=cursor is None,
+                           next_cursor=next_cursor,
                            locations=locations)
 
 
+def archive_page(query_for, template):
+    """ Render a page of the signed-in user's archived rows, newest first,
+        before the id in the before parameter.
+    """
+
+    try:
+        before = int(request.args['before'])
+    except (KeyError, ValueError):
+        before = None
+    rows = query_for(READ_SESSION, login_session['user_id'], before).all()
+    return render_template(template,
+                           user_id=login_session['user_id'],
+                           locations=cache.LOCATIONS.get(READ_SESSION),
+                           rows=rows,
+                           older=rows[-1].archive_id
+                           if len(rows) == archive.PAGE_SIZE else None)
+
+
+@APP.route('/user/items/archive')
+def show_archived_items():
+    """ Show the user's sold, stale and deleted items
+
+    """
+
+    return archive_page(archive.user_items, 'archiveditems.html')
+
+
+@APP.route('/user/messages/archive')
+def show_archived_messages():
+    """ Show the user's messages from archived conversations
+
+    """
+
+    return archive_page(archive.user_messages, 'archivedmessages.html')
+
+
+@APP.route('/messages/conversation/<int:conversation_id>',
+           methods=['GET', 'POST'])
+def show_conversation(conversation_id):
+    """ Show a conversation, marking its messages to the user as read
+
+    """
+
+    user_id = login_session['user_id']
+    conversation = queries.conversation(SESSION, conversation_id).one()
+    if user_id not in (conversation.user_low_id, conversation.user_high_id):
+        flash("User not authorized")
+        return redirect(url_for("show_user_messages"))
+    if conversation.user_low_id == user_id:
+        other_id = conversation.user_high_id
+    else:
+        other_id = conversation.user_low_id
+    if request.method == "POST":
+        messaging.send_message(SESSION, user_id, other_id,
+                               conversation.item_id, request.form["message"],
+                               conversation=conversation)
+        SESSION.commit()
+        flash("Reply sent")
+        return redirect(url_for("show_conversation",
+                                conversation_id=conversation_id))
+    # Render before committing so the page does not reload the expired rows
+    marked = messaging.mark_read(SESSION, conversation_id, user_id)
+    locations = cache.LOCATIONS.get(SESSION)
+    messages = messaging.conversation_messages(SESSION, conversation_id).all()
+    page = render_template("conversation.html",
+                           user_id=user_id,
+                           locations=locations,
+                           conversation=conversation,
+                           item=conversation.item,
+                           messages=messages)
+    if marked:
+        SESSION.commit()
+    return page
+
+
 @APP.route('/messages/<int:message_id>/reply', methods=['GET', 'POST'])
 def reply_message(message_id):
     """ Reply to a message
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    message = SESSION.query(Message).filter_by(id=message_id).one()
-    user = SESSION.query(User).filter_by(id=login_session['user_id']).one()
-    item = SESSION.query(Item).filter_by(id=message.item_id).one()
+    locations = cache.LOCATIONS.get(SESSION)
+    message = queries.message(SESSION, message_id).one()
+    item = message.item
     if request.method == "POST":
-        if user.id == message.receiver_id:
-            new_message = Message(sender_id=login_session["user_id"],
-                                  receiver_id=message.sender_id,
-                                  item_id=message.item_id,
-                                  message=request.form["message"])
-            SESSION.add(new_message)
+        if login_session['user_id'] == message.receiver_id:
+            messaging.send_message(SESSION, login_session["user_id"],
+                                   message.sender_id, message.item_id,
+                                   request.form["message"])
             SESSION.commit()
             flash("Reply sent")
             return redirect(url_for("show_user_messages"))
@@ -264,12 +537,11 @@ def delete_message(message_id):
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    message = SESSION.query(Message).filter_by(id=message_id).one()
-    user = SESSION.query(User).filter_by(id=login_session['user_id']).one()
+    locations = cache.LOCATIONS.get(SESSION)
+    message = queries.message(SESSION, message_id).one()
     if request.method == 'POST':
-        if user.id == message.receiver_id:
-            SESSION.delete(message)
+        if login_session['user_id'] == message.receiver_id:
+            messaging.delete_message(SESSION, message)
             SESSION.commit()
             flash('Message deleted')
             return redirect(url_for('show_user_messages'))
@@ -280,6 +552,132 @@ def delete_message(message_id):
                            message=message)
 
 
+@APP.route('/user/wants', methods=['GET', 'POST'])
+def show_user_wants():
+    """ Show the user's wants and the items matching them
+
+        Posting the form adds a want. Matches are paged by keyset; pass
+        the cursor of the More link back as ?cursor=.
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    if request.method == 'POST':
+        try:
+            want = matching.want_from_form(request.form,
+                                           login_session['user_id'])
+        except ValueError as error:
+            flash(str(error))
+            return redirect(url_for('show_user_wants'))
+        SESSION.add(want)
+        SESSION.commit()
+        flash('Want added')
+        return redirect(url_for('show_user_wants'))
+    try:
+        cursor = pagination.parse_cursor(request.args.get('cursor'), 'id')
+    except pagination.CursorError:
+        cursor = None
+    matches, next_cursor = pagination.paginate(
+        matching.user_matches(READ_SESSION, login_session['user_id']), 'id',
+        cursor, matching.DEFAULT_PAGE_SIZE)
+    return render_template('userwants.html',
+                           locations=cache.LOCATIONS.get(READ_SESSION),
+                           conditions=CONDITIONS,
+                           wants=matching.user_wants(
+                               READ_SESSION, login_session['user_id']).all(),
+                           matches=matches,
+                           next_cursor=next_cursor)
+
+
+@APP.route('/user/wants/<int:want_id>/delete', methods=['POST'])
+def delete_want(want_id):
+    """ Delete one of the user's wants along with its matches
+
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    want = SESSION.query(Want).filter_by(
+        id=want_id, user_id=login_session['user_id']).first()
+    if want is None:
+        abort(404)
+    SESSION.delete(want)
+    SESSION.commit()
+    flash('Want deleted')
+    return redirect(url_for('show_user_wants'))
+
+
+@APP.route('/items/<int:item_id>/reserve', methods=['POST'])
+def reserve_item(item_id):
+    """ Hold copies of an item for the user while they arrange the trade
+
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    connection = SESSION.connection()
+    try:
+        reservations.reserve(connection, item_id, login_session['user_id'],
+                             request.form.get('quantity', 1, type=int),
+                             request.form.get('version', type=int))
+    except reservations.ReservationError as error:
+        SESSION.rollback()
+        flash(str(error))
+        return redirect(url_for('show_item', item_id=item_id))
+    location_id = listings.item_location(connection, item_id)
+    SESSION.commit()
+    pagecache.bump(location_id)
+    flash('Reserved')
+    return redirect(url_for('show_user_reservations'))
+
+
+@APP.route('/user/reservations')
+def show_user_reservations():
+    """ Show the reservations the user holds and those on their items
+
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    user_id = login_session['user_id']
+    return render_template(
+        'userreservations.html',
+        locations=cache.LOCATIONS.get(READ_SESSION),
+        bought=reservations.buyer_reservations(READ_SESSION, user_id).all(),
+        sold=reservations.seller_reservations(READ_SESSION, user_id).all())
+
+
+@APP.route('/reservations/<int:reservation_id>/<any(confirm, release):action>',
+           methods=['POST'])
+def close_reservation(reservation_id, action):
+    """ Confirm the trade of a reservation on the user's item, or release a
+        reservation the user holds or one on their item.
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    connection = SESSION.connection()
+    try:
+        if action == 'confirm':
+            reservations.confirm(connection, reservation_id,
+                                 login_session['user_id'])
+            location_id = None
+        else:
+            location_id = listings.item_location(
+                connection, reservations.release(
+                    connection, reservation_id, login_session['user_id']))
+    except reservations.ReservationError as error:
+        SESSION.rollback()
+        flash(str(error))
+        return redirect(url_for('show_user_reservations'))
+    SESSION.commit()
+    if location_id is not None:
+        pagecache.bump(location_id)
+    flash('Reservation confirmed' if action == 'confirm'
+          else 'Reservation released')
+    return redirect(url_for('show_user_reservations'))
+
+
 @APP.route('/additem', methods=['GET', 'POST'])
 def add_item():
     """ Add item to database.
@@ -298,22 +696,119 @@ def add_item():
                         quantity=request.form['quantity'],
                         user_id=login_session['user_id'])
         SESSION.add(new_item)
+        SESSION.flush()
+        location_id = current_user().location_id
+        if location_id is not None:
+            notifications.notify(
+                SESSION, notifications.location_channel(location_id), 'item',
+                dict(new_item.serialize,
+                     url=url_for('show_item', item_id=new_item.id)))
         SESSION.commit()
+        pagecache.bump(location_id)
         flash('Item added')
         return redirect(url_for('show_user_items'))
     return render_template('newitem.html')
 
 
+@APP.route('/user/items/import', methods=['GET', 'POST'])
+def import_items():
+    """ Import items into the user's binder from an uploaded file
+
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    if request.method == 'POST':
+        report = import_upload()
+        if report is None:
+            flash('Choose a CSV or NDJSON file to import')
+            return redirect(url_for('import_items'))
+        flash('Imported %d items' % report.inserted)
+        for line, message in report.errors[:10]:
+            flash('Line %d skipped: %s' % (line, message))
+        if report.rejected > 10:
+            flash('%d more lines skipped' % (report.rejected - 10))
+        return redirect(url_for('show_user_items'))
+    return render_template('importitems.html',
+                           locations=cache.LOCATIONS.get(READ_SESSION))
+
+
+@APP.route('/user/items/import/JSON', methods=['POST'])
+def import_items_json():
+    """ API endpoint to import items into the user's binder.
+
+        Takes a CSV or NDJSON file upload and returns counts of inserted
+        and rejected rows with the reason each row was rejected.
+    """
+
+    if 'email' not in login_session:
+        response = make_response(json.dumps('Current user not connected'), 401)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    report = import_upload()
+    if report is None:
+        response = make_response(json.dumps('No file uploaded'), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    return jsonify(report.serialize)
+
+
+def import_upload():
+    """ Helper function to import the file uploaded with the request.
+
+        Returns the import report, or None when no usable file was sent.
+    """
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return None
+    file_format = request.form.get('format') or (
+        'ndjson' if upload.filename.endswith(('.ndjson', '.jsonl'))
+        else 'csv')
+    if file_format not in ('csv', 'ndjson'):
+        return None
+    user = current_user()
+    location_id = user.location_id
+    report = bulk.import_items(SESSION, user.id,
+                               bulk.read_rows(upload.stream, file_format))
+    if report.inserted:
+        pagecache.bump(location_id)
+    return report
+
+
+@APP.route('/user/items/export')
+def export_items():
+    """ Download the user's binder as CSV or NDJSON
+
+    """
+
+    if 'email' not in login_session:
+        return redirect('/login')
+    file_format = request.args.get('format', 'csv')
+    if file_format not in ('csv', 'ndjson'):
+        file_format = 'csv'
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(bulk.export_items(
+        READ_SESSION, login_session['user_id'], file_format)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=binder.%s' % file_format
+    return response
+
+
 @APP.route('/items/<int:item_id>/edit', methods=['GET', 'POST'])
 def edit_item(item_id):
     """ Edit selected item
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    edited_item = SESSION.query(Item).filter_by(id=item_id).one()
-    user = SESSION.query(User).filter_by(id=login_session['user_id']).one()
+    locations = cache.LOCATIONS.get(SESSION)
+    edited_item = queries.item(SESSION, item_id).one()
+    user = current_user()
     if request.method == "POST":
+        version = request.form.get("version", type=int)
+        if version is not None and version != edited_item.version:
+            flash("The item changed meanwhile, check it and try again")
+            return redirect(url_for("edit_item", item_id=item_id))
         if user.id == edited_item.user_id:
             edited_item.name = request.form["name"]
             edited_item.cardset = request.form["cardset"]
@@ -322,6 +817,7 @@ def edit_item(item_id):
             edited_item.price = request.form["price"]
             SESSION.add(edited_item)
             SESSION.commit()
+            pagecache.bump(user.location_id)
             flash("Item changed")
             return redirect(url_for("show_user_items"))
         flash("User not authorized")
@@ -337,13 +833,14 @@ def delete_item(item_id):
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    deleted_item = SESSION.query(Item).filter_by(id=item_id).one()
-    user = SESSION.query(User).filter_by(id=login_session['user_id']).one()
+    locations = cache.LOCATIONS.get(SESSION)
+    deleted_item = queries.item(SESSION, item_id).one()
+    user = current_user()
     if request.method == 'POST':
         if user.id == deleted_item.user_id:
             SESSION.delete(deleted_item)
             SESSION.commit()
+            pagecache.bump(user.location_id)
             flash('Item deleted')
             return redirect(url_for('show_user_items'))
         flash('User not authorized')
@@ -359,17 +856,62 @@ def show_main():
 
     """
 
-    locations = SESSION.query(Location).order_by(asc(Location.name))
-    items = SESSION.query(Item).order_by(desc(Item.time_added)).limit(5)
     if 'email' not in login_session:
-        return render_template('publicmain.html',
-                               locations=locations,
-                               items=items)
+        def render():
+            """ Render the page for anonymous visitors. """
+            return render_template('publicmain.html',
+                                   locations=cache.LOCATIONS.get(READ_SESSION),
+                                   items=queries.latest_items(READ_SESSION))
+        return public_page('show_main', None, render)
+    locations = cache.LOCATIONS.get(READ_SESSION)
+    items = queries.latest_items(READ_SESSION)
     return render_template('privatemain.html',
                            locations=locations,
                            items=items)
 
 
+def public_page(route, location_id, render):
+    """ Helper function to serve a page that is the same for all visitors.
+
+        Serves the page from pagecache when its data has not changed,
+        answering conditional requests with 304 Not Modified, and only
+        calls render on a miss. Without a shared cache every request
+        renders the page, tagged with a hash of its contents.
+    """
+
+    if not pagecache.enabled():
+        response = make_response(render())
+        response.add_etag()
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    tag, page = pagecache.lookup(route, location_id)
+    if page is None:
+        page = pagecache.store(route, location_id, tag, render())
+    response = make_response(page['body'])
+    response.set_etag(tag)
+    response.last_modified = datetime.datetime.utcfromtimestamp(
+        page['last_modified'])
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def location_page(location_id, cursor):
+    """ Helper function to read a page of the listings at a location.
+
+        Returns the listings and the cursor of the next page, or None on
+        the last one.
+    """
+
+    rows = queries.location_page_items(READ_SESSION, location_id,
+                                       cursor).all()
+    if len(rows) <= queries.LOCATION_PAGE_SIZE:
+        return rows, None
+    rows = rows[:queries.LOCATION_PAGE_SIZE]
+    return rows, pagination.cursor_for(rows[-1], 'newest')
+
+
 def create_user():
     """ Helper function to set up user log-in.
 
@@ -379,17 +921,29 @@ def create_user():
     new_user = User(email=login_session['email'])
     SESSION.add(new_user)
     SESSION.commit()
-    user = SESSION.query(User).filter_by(email=login_session['email']).one()
+    user = queries.user_by_email(SESSION, login_session['email']).one()
     return user.id
 
 
+def current_user():
+    """ Helper function returning the signed-in user as a cache.CachedUser.
+
+        Resolved once per request through cache.USERS. Misses read the
+        primary, so a lagging replica is never cached.
+    """
+
+    if 'current_user' not in g:
+        g.current_user = cache.USERS.get(SESSION, login_session['user_id'])
+    return g.current_user
+
+
 def get_user_info(user_id):
     """ Helper function to set up user login.
 
         Return user information given user id.
     """
 
-    user = SESSION.query(User).filter_by(id=user_id).one()
+    user = queries.user(SESSION, user_id).one()
     return user
 
 
@@ -400,13 +954,14 @@ def get_user_id(email):
     """
 
     try:
-        user = SESSION.query(User).filter_by(email=email).one()
+        user = queries.user_by_email(SESSION, email).one()
         return user.id
     except Exception: # pylint: disable=broad-except
         return None
 
 
 if __name__ == '__main__':
+    create_app()
     APP.secret_key = 'super_secret_key'
     APP.debug = True
     APP.run(host='0.0.0.0.xip.io', port=5000)
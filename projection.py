@@ -0,0 +1,180 @@
+"""
+Column projections and encoders for the JSON API
+
+API routes select only the columns they return, as plain row tuples instead
+of ORM objects, and encode a whole page in one pass. Each column's values are
+converted by a function picked once per column from its SQL type, so prices
+become strings and times ISO 8601 like CatalogJSONEncoder does, without
+testing the type of every value.
+
+Pages can be returned as a list of objects (json), as one list per column
+(columns), or as the columnar document packed with MessagePack (msgpack),
+which is an optional dependency.
+"""
+
+import json
+from sqlalchemy import Date, DateTime, Numeric
+try:
+    import msgpack
+except ImportError: # Optional, only needed for ?format=msgpack
+    msgpack = None
+
+# Columns the API returns for items and listings
+ITEM_FIELDS = ('id', 'user_id', 'name', 'cardset', 'condition', 'price',
+               'quantity', 'time_added')
+
+# Columns the API returns for wants, trade matches and daily price rollups
+WANT_FIELDS = ('id', 'user_id', 'name', 'cardset', 'condition', 'max_price',
+               'location_id', 'time_added')
+MATCH_FIELDS = ('id', 'time_matched')
+ROLLUP_FIELDS = ('name', 'cardset', 'condition', 'day', 'event_count',
+                 'price_min', 'price_median', 'price_max')
+
+# Page formats and their content types
+FORMATS = {
+    'json': 'application/json',
+    'columns': 'application/json',
+    'msgpack': 'application/x-msgpack'
+}
+
+
+class FormatError(ValueError):
+    """ Raised when a requested format is unknown or unavailable. """
+
+
+def parse_format(value):
+    """ Validate the format parameter, json by default. """
+
+    page_format = value or 'json'
+    if page_format not in FORMATS:
+        raise FormatError('Invalid format')
+    if page_format == 'msgpack' and msgpack is None:
+        raise FormatError('msgpack is not installed')
+    return page_format
+
+
+def select_fields(query, fields=ITEM_FIELDS):
+    """ Narrow a query of a model to the named columns. """
+
+    model = query.column_descriptions[0]['entity']
+    return query.with_entities(*[getattr(model, name) for name in fields])
+
+
+def select_nested(query, groups):
+    """ Narrow a query to the named columns of several models.
+
+        groups is a sequence of (prefix, model, fields). Columns of a group
+        with a prefix are labelled prefix.name and encoded as an object
+        under prefix; the others keep their names.
+    """
+
+    columns = []
+    for prefix, model, fields in groups:
+        for name in fields:
+            column = getattr(model, name)
+            if prefix:
+                column = column.label('%s.%s' % (prefix, name))
+            columns.append(column)
+    return query.with_entities(*columns)
+
+
+def to_text(value):
+    """ Encode a decimal as a string, so no precision is lost. """
+
+    return None if value is None else str(value)
+
+
+def to_iso(value):
+    """ Encode a date or time in ISO 8601. """
+
+    return None if value is None else value.isoformat()
+
+
+def converters(query):
+    """ Value converter for each column of a projected query, or None for
+        columns whose values encode as they are.
+    """
+
+    result = []
+    for column in query.column_descriptions:
+        column_type = column['type']
+        if isinstance(column_type, Numeric):
+            result.append(to_text)
+        elif isinstance(column_type, (Date, DateTime)):
+            result.append(to_iso)
+        else:
+            result.append(None)
+    return result
+
+
+def row_encoder(query):
+    """ Function turning a row of a projected query into a plain dict.
+
+        Columns labelled prefix.name by select_nested go into a dict under
+        prefix.
+    """
+
+    names = [column['name'] for column in query.column_descriptions]
+    convert = list(enumerate(converters(query)))
+    nested = [(index, name.split('.', 1)) for index, name in enumerate(names)
+              if '.' in name]
+
+    def encode(row):
+        """ Dict of a row's converted values by column name. """
+
+        values = list(row)
+        for index, function in convert:
+            if function is not None:
+                values[index] = function(values[index])
+        if not nested:
+            return dict(zip(names, values))
+        record = dict((name, value) for name, value in zip(names, values)
+                      if '.' not in name)
+        for index, (prefix, name) in nested:
+            record.setdefault(prefix, {})[name] = values[index]
+        return record
+    return encode
+
+
+def column_lists(query, rows):
+    """ Converted values of rows as one list per column, by column name. """
+
+    columns = {}
+    for (index, function), column in zip(enumerate(converters(query)),
+                                         query.column_descriptions):
+        values = [row[index] for row in rows]
+        if function is not None:
+            values = [function(value) for value in values]
+        columns[column['name']] = values
+    return columns
+
+
+def encode_rows(query, rows, key, **values):
+    """ Encode rows of a projected query as a JSON object listing them
+        under key, next to the other values given.
+
+        Returns the body and its content type.
+    """
+
+    encode = row_encoder(query)
+    document = dict(values)
+    document[key] = [encode(row) for row in rows]
+    return (json.dumps(document, separators=(',', ':'), sort_keys=True),
+            FORMATS['json'])
+
+
+def encode_page(query, rows, next_cursor, page_format):
+    """ Encode a page of rows of a projected query in a format.
+
+        Returns the body and its content type. The json format is the
+        objects the API has always returned, the others carry the same
+        values with each column as one list.
+    """
+
+    if page_format == 'json':
+        return encode_rows(query, rows, 'items', next_cursor=next_cursor)
+    document = {'items': column_lists(query, rows),
+                'next_cursor': next_cursor}
+    if page_format == 'msgpack':
+        return msgpack.packb(document), FORMATS[page_format]
+    return json.dumps(document, separators=(',', ':')), FORMATS[page_format]
@@ -0,0 +1,203 @@
+"""
+Queries behind each view, with the relationships the templates use loaded up
+front so rendering never falls back to one lazy SELECT per row.
+"""
+
+import threading
+from sqlalchemy import asc, desc, event
+from sqlalchemy.orm import joinedload, contains_eager
+from database_setup import User, Location, Item, Message, Conversation, \
+    ConversationMember, Listing, LocationSummary
+import pagination
+
+# Listings shown per page of a location
+LOCATION_PAGE_SIZE = 50
+
+# Most SQL statements each endpoint may issue, checked by StatementCounter
+# when the application runs with ENFORCE_QUERY_BUDGETS set. A listing that
+# starts issuing a statement per row will blow through these immediately.
+# Budgets hold with a cold user cache; a cached signed-in user saves one.
+ROUTE_BUDGETS = {
+    'show_main': 2,
+    'show_items': 4,
+    # Sending a message adds a fixed set of conversation and counter writes
+    'show_item': 11,
+    'show_user_items': 2,
+    'show_user_item': 2,
+    'show_user_messages': 2,
+    'show_conversation': 6,
+    'reply_message': 7,
+    'delete_message': 6,
+    # Item writes also update the listing, location totals and trade
+    # matches and record a price event, and deletes archive the item with
+    # its reservations and conversations
+    'edit_item': 10,
+    'delete_item': 17,
+    'items_json': 1,
+    'location_items_json': 1,
+    'prices_json': 1,
+    'user_matches_json': 1,
+    'show_user_wants': 4,
+    # Reserving or releasing also rematches the item, in case it sold out
+    'reserve_item': 7,
+    # Releasing puts the copies back on the item, listing and location
+    'close_reservation': 8,
+    'show_user_reservations': 4,
+    'show_archived_items': 2,
+    'show_archived_messages': 2,
+}
+
+
+def locations(session):
+    """ All locations sorted by name for the dropdown. """
+
+    return session.query(Location).order_by(asc(Location.name))
+
+
+def location(session, location_id):
+    """ A single location. """
+
+    return session.query(Location).filter_by(id=location_id)
+
+
+def latest_items(session, limit=5):
+    """ The most recently added items. """
+
+    return session.query(Item).order_by(desc(Item.time_added)).limit(limit)
+
+
+def location_items(session, location_id):
+    """ Listings of the items at a location, for the API to order. """
+
+    return session.query(Listing) \
+        .filter(Listing.location_id == location_id)
+
+
+def location_page_items(session, location_id, cursor=None):
+    """ Listings at a location newest first, one page past a keyset cursor
+        with one more to tell whether another page follows, in one index
+        range read.
+    """
+
+    return pagination.keyset_query(location_items(session, location_id),
+                                   'newest', cursor) \
+        .limit(LOCATION_PAGE_SIZE + 1)
+
+
+def location_summary(session, location_id):
+    """ Item count and price totals of a location. """
+
+    return session.query(LocationSummary).filter_by(location_id=location_id)
+
+
+def item(session, item_id):
+    """ A single item with its owner loaded. """
+
+    return session.query(Item) \
+        .filter_by(id=item_id) \
+        .options(joinedload(Item.user))
+
+
+def user_items(session, user_id):
+    """ Items in a user's binder. """
+
+    return session.query(Item).filter_by(user_id=user_id)
+
+
+def user(session, user_id):
+    """ A single user. """
+
+    return session.query(User).filter_by(id=user_id)
+
+
+def user_by_email(session, email):
+    """ A single user looked up by log-in email. """
+
+    return session.query(User).filter_by(email=email)
+
+
+def inbox(session, user_id):
+    """ A user's conversations, latest first, as (member, conversation,
+        latest message) rows with the item each is about loaded.
+    """
+
+    return session.query(ConversationMember, Conversation, Message) \
+        .filter(ConversationMember.user_id == user_id) \
+        .join(ConversationMember.conversation) \
+        .join(Message, Message.id == Conversation.last_message_id) \
+        .join(Conversation.item) \
+        .options(contains_eager(Conversation.item)) \
+        .order_by(desc(ConversationMember.updated_at),
+                  desc(ConversationMember.conversation_id))
+
+
+def conversation(session, conversation_id):
+    """ A single conversation with the item it is about loaded. """
+
+    return session.query(Conversation) \
+        .filter_by(id=conversation_id) \
+        .options(joinedload(Conversation.item))
+
+
+def message(session, message_id):
+    """ A single message with the item it is about loaded. """
+
+    return session.query(Message) \
+        .filter_by(id=message_id) \
+        .options(joinedload(Message.item))
+
+
+class StatementCounter(object):
+    """ Count the SQL statements a thread issues through some engines.
+
+        Can be used as a context manager around a block, or started and
+        stopped explicitly around a request.
+    """
+
+    def __init__(self, *engines):
+        self.engines = engines
+        self.statements = []
+        self.thread = None
+
+    @property
+    def count(self):
+        """ Number of statements seen so far. """
+
+        return len(self.statements)
+
+    def start(self):
+        """ Start counting statements issued by the calling thread. """
+
+        self.thread = threading.current_thread()
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self.record)
+        return self
+
+    def stop(self):
+        """ Stop counting. """
+
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self.record)
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        """ Engine event listener recording one statement. """
+
+        if threading.current_thread() is self.thread:
+            self.statements.append(statement)
+
+    def check(self, endpoint):
+        """ Raise AssertionError if an endpoint went over its budget. """
+
+        budget = ROUTE_BUDGETS.get(endpoint)
+        if budget is not None and self.count > budget:
+            raise AssertionError(
+                '%s issued %d SQL statements, budget is %d:\n%s'
+                % (endpoint, self.count, budget, '\n'.join(self.statements)))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
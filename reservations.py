@@ -0,0 +1,255 @@
+"""
+Inventory reservations for trades
+
+A buyer reserves copies of an item while they arrange the trade over
+messages. Reserving takes the copies off the item's quantity with one
+conditional UPDATE, which only succeeds while enough copies are left and,
+when the buyer says which version of the item they saw, while the item is
+still at that version. Nothing is read first and no lock is held between
+statements, so two buyers can never both get the last copy. Item maps its
+version column as the ORM version counter, so an edit made from a stale
+form fails instead of overwriting a reservation taken meanwhile.
+
+The seller confirms a held reservation once the trade is done, which keeps
+the copies off the item, and either side can release it, which puts them
+back. Held reservations expire after HOLD_SECONDS and sweep() puts their
+copies back. Every change of status is itself a compare-and-swap on the
+status, so of a confirm, a release and the sweeper racing for the same
+reservation exactly one takes effect.
+
+Usage:
+    python reservations.py    Expire held reservations past their time
+"""
+
+import datetime
+import os
+import sys
+import time
+from sqlalchemy import select, and_, or_
+from sqlalchemy.orm import contains_eager
+from database_setup import Item, Reservation
+import engines
+import listings
+import matching
+import pagecache
+
+ITEM = Item.__table__
+RESERVATION = Reservation.__table__
+
+# Seconds copies stay held before the sweeper puts them back
+HOLD_SECONDS = int(os.environ.get('TRADING_POST_HOLD_SECONDS', 900))
+
+# Reservations expired per sweeper transaction
+SWEEP_BATCH_SIZE = 1000
+
+# Reservations shown per page, newest first
+PAGE_SIZE = 50
+
+
+class ReservationError(ValueError):
+    """ Raised when a reservation cannot be made or changed. """
+
+
+def take(connection, item_id, buyer_id, quantity, version=None):
+    """ Take copies of someone else's item off its quantity for a buyer.
+
+        One conditional UPDATE that only applies while at least quantity
+        copies are left and, if a version is given, while the item is still
+        at it. Returns whether it applied. An item sold out this way no
+        longer matches any want.
+    """
+
+    where = and_(ITEM.c.id == item_id, ITEM.c.user_id != buyer_id,
+                 ITEM.c.quantity >= quantity)
+    if version is not None:
+        where = and_(where, ITEM.c.version == version)
+    result = connection.execute(ITEM.update().where(where).values(
+        quantity=ITEM.c.quantity - quantity, version=ITEM.c.version + 1))
+    if result.rowcount != 1:
+        return False
+    listings.adjust_quantity(connection, item_id, -quantity)
+    matching.refresh_items(connection, and_(ITEM.c.id == item_id,
+                                            ITEM.c.quantity <= 0))
+    return True
+
+
+def put_back(connection, item_id, quantity):
+    """ Return the copies of a reservation that ended to its item.
+
+        The item is rematched, since it may have been sold out. Callers bump
+        the cached pages of the item's location once they commit.
+    """
+
+    result = connection.execute(ITEM.update().where(ITEM.c.id == item_id)
+                                .values(quantity=ITEM.c.quantity + quantity,
+                                        version=ITEM.c.version + 1))
+    if result.rowcount:
+        listings.adjust_quantity(connection, item_id, quantity)
+        matching.refresh_items(connection, ITEM.c.id == item_id)
+
+
+def refusal(connection, item_id, buyer_id, version):
+    """ Reason copies of an item could not be taken, read after the fact.
+
+    """
+
+    item = connection.execute(
+        select([ITEM.c.user_id, ITEM.c.quantity, ITEM.c.version])
+        .where(ITEM.c.id == item_id)).first()
+    if item is None:
+        return 'No such item'
+    if item.user_id == buyer_id:
+        return 'You cannot reserve your own item'
+    if version is not None and item.version != version:
+        return 'The item has changed, check it and try again'
+    return 'Only %d left' % item.quantity
+
+
+def reserve(connection, item_id, buyer_id, quantity=1, version=None):
+    """ Hold copies of an item for a buyer, returning the reservation id.
+
+        Raises ReservationError when the copies cannot be taken.
+    """
+
+    if quantity < 1:
+        raise ReservationError('Reserve at least one copy')
+    if not take(connection, item_id, buyer_id, quantity, version):
+        raise ReservationError(refusal(connection, item_id, buyer_id,
+                                       version))
+    now = datetime.datetime.utcnow()
+    result = connection.execute(RESERVATION.insert().values(
+        item_id=item_id, buyer_id=buyer_id, quantity=quantity, status='held',
+        time_added=now,
+        expires_at=now + datetime.timedelta(seconds=HOLD_SECONDS)))
+    return result.inserted_primary_key[0]
+
+
+def close(connection, reservation_id, status, where=None):
+    """ Move a reservation from held to status, if it is still held.
+
+        Compares and swaps on the status, so only one of several closes
+        racing for a reservation applies. Returns whether this one did.
+    """
+
+    condition = and_(RESERVATION.c.id == reservation_id,
+                     RESERVATION.c.status == 'held')
+    if where is not None:
+        condition = and_(condition, where)
+    result = connection.execute(RESERVATION.update().where(condition).values(
+        status=status, time_closed=datetime.datetime.utcnow()))
+    return result.rowcount == 1
+
+
+def sold_by(seller_id):
+    """ Condition that a reservation is for one of a seller's items. """
+
+    return RESERVATION.c.item_id.in_(
+        select([ITEM.c.id]).where(ITEM.c.user_id == seller_id))
+
+
+def confirm(connection, reservation_id, seller_id):
+    """ Confirm the trade of a reservation on one of the seller's items.
+
+        The copies stay off the item. Raises ReservationError unless the
+        reservation is still held and has not expired.
+    """
+
+    if not close(connection, reservation_id, 'confirmed', and_(
+            sold_by(seller_id),
+            RESERVATION.c.expires_at > datetime.datetime.utcnow())):
+        raise ReservationError('The reservation is no longer held')
+
+
+def release(connection, reservation_id, user_id):
+    """ Release a reservation for its buyer or seller, putting the copies
+        back. Returns the item id.
+
+        Raises ReservationError unless the reservation is still held.
+    """
+
+    reservation = connection.execute(
+        select([RESERVATION.c.item_id, RESERVATION.c.quantity])
+        .where(RESERVATION.c.id == reservation_id)).first()
+    if reservation is None or not close(
+            connection, reservation_id, 'released',
+            or_(RESERVATION.c.buyer_id == user_id, sold_by(user_id))):
+        raise ReservationError('The reservation is no longer held')
+    put_back(connection, reservation.item_id, reservation.quantity)
+    return reservation.item_id
+
+
+def sweep_batch(connection, now):
+    """ Expire the next batch of held reservations past their time.
+
+        Returns the number of reservations read, 0 once none are left, and
+        the locations of the items copies went back to.
+    """
+
+    rows = connection.execute(
+        select([RESERVATION.c.id, RESERVATION.c.item_id,
+                RESERVATION.c.quantity])
+        .where(RESERVATION.c.status == 'held')
+        .where(RESERVATION.c.expires_at <= now)
+        .order_by(RESERVATION.c.expires_at)
+        .limit(SWEEP_BATCH_SIZE)).fetchall()
+    item_ids = set()
+    for row in rows:
+        # A confirm or release may have closed it since it was read
+        if close(connection, row.id, 'expired'):
+            put_back(connection, row.item_id, row.quantity)
+            item_ids.add(row.item_id)
+    return len(rows), listings.item_locations(connection, item_ids)
+
+
+def sweep(engine):
+    """ Expire every held reservation past its time.
+
+        Each batch commits on its own, so the item rows it writes are only
+        locked briefly, and cached public pages of the locations copies
+        went back to are bumped after it. Returns the number of
+        reservations read.
+    """
+
+    now = datetime.datetime.utcnow()
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            count, location_ids = sweep_batch(connection, now)
+        if not count:
+            return total
+        if location_ids:
+            pagecache.bump(*location_ids)
+        total += count
+
+
+def buyer_reservations(session, user_id):
+    """ Query of a buyer's reservations with their items, newest first.
+
+    """
+
+    return session.query(Reservation).join(Item) \
+        .options(contains_eager(Reservation.item)) \
+        .filter(Reservation.buyer_id == user_id) \
+        .order_by(Reservation.id.desc()).limit(PAGE_SIZE)
+
+
+def seller_reservations(session, user_id):
+    """ Query of the reservations on a seller's items, newest first. """
+
+    return session.query(Reservation).join(Item) \
+        .options(contains_eager(Reservation.item)) \
+        .filter(Item.user_id == user_id) \
+        .order_by(Reservation.id.desc()).limit(PAGE_SIZE)
+
+
+def main():
+    """ Command line entry point. """
+
+    start = time.time()
+    count = sweep(engines.create(pooled=False))
+    print "Swept %d reservations in %.1f s" % (count, time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Full-text card search over item names and sets
+
+On SQLite the index is an external-content FTS5 table kept in sync with the
+item table by triggers; on Postgres it is a GIN expression index over the
+same text. Either way writes to item update the index inside the same
+transaction, whichever code path makes them, and a search only touches the
+index entries matching its terms. Other databases get no index and fall back
+to LIKE conditions, which scan the item table.
+"""
+
+import decimal
+import logging
+import re
+from sqlalchemy import text
+from database_setup import Item
+
+LOGGER = logging.getLogger(__name__)
+
+# Page size used when the client does not ask for one, and the cap on it
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+SQLITE_INSTALL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_search USING fts5("
+    "name, cardset, content='item', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS item_search_insert AFTER INSERT ON item "
+    "BEGIN "
+    "INSERT INTO item_search (rowid, name, cardset) "
+    "VALUES (new.id, new.name, new.cardset); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS item_search_delete AFTER DELETE ON item "
+    "BEGIN "
+    "INSERT INTO item_search (item_search, rowid, name, cardset) "
+    "VALUES ('delete', old.id, old.name, old.cardset); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS item_search_update "
+    "AFTER UPDATE OF name, cardset ON item "
+    "BEGIN "
+    "INSERT INTO item_search (item_search, rowid, name, cardset) "
+    "VALUES ('delete', old.id, old.name, old.cardset); "
+    "INSERT INTO item_search (rowid, name, cardset) "
+    "VALUES (new.id, new.name, new.cardset); "
+    "END",
+    "INSERT INTO item_search (item_search) VALUES ('rebuild')",
+]
+
+POSTGRES_DOCUMENT = "to_tsvector('english', item.name || ' ' || item.cardset)"
+
+POSTGRES_INSTALL = [
+    "CREATE INDEX IF NOT EXISTS ix_item_search ON item "
+    "USING gin ((%s))" % POSTGRES_DOCUMENT,
+]
+
+
+def install(connection):
+    """ Create the search index for the connection's database. """
+
+    if connection.dialect.name == 'sqlite':
+        statements = SQLITE_INSTALL
+    elif connection.dialect.name == 'postgresql':
+        statements = POSTGRES_INSTALL
+    else:
+        LOGGER.warning('No search index for %s, searches will scan items',
+                       connection.dialect.name)
+        return
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def terms(query):
+    """ Split free text into search terms, dropping any query syntax. """
+
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+def match_clause(dialect, words):
+    """ Build the dialect's full-text condition, ranking expression, join
+        and parameters for a list of terms. Every term must match, as a
+        prefix with an index, anywhere in the name or set without one.
+    """
+
+    if dialect == 'sqlite':
+        return ("item_search MATCH :match",
+                "bm25(item_search)",
+                "JOIN item_search ON item_search.rowid = item.id",
+                {'match': ' '.join('"%s"*' % word for word in words)})
+    if dialect == 'postgresql':
+        return ("%s @@ to_tsquery('english', :match)" % POSTGRES_DOCUMENT,
+                "-ts_rank(%s, to_tsquery('english', :match))"
+                % POSTGRES_DOCUMENT,
+                "",
+                {'match': ' & '.join('%s:*' % word for word in words)})
+    return (' AND '.join("(item.name LIKE :word%d ESCAPE '!' OR "
+                         "item.cardset LIKE :word%d ESCAPE '!')" % (i, i)
+                         for i in range(len(words))),
+            "item.id",
+            "",
+            dict(('word%d' % i, '%%%s%%' % word.replace('_', '!_'))
+                 for i, word in enumerate(words)))
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def search(session, query, condition=None, min_price=None, max_price=None,
+           location_id=None, page=1, per_page=DEFAULT_PER_PAGE, items=None):
+    """ Return one page of items matching query, best matches first.
+
+        Returns the items and whether another page follows. Filters narrow
+        the matches by condition, price range and the owner's location.
+        items is the query of Item the matches are loaded from, such as a
+        column projection with the id, all of Item by default.
+    """
+
+    words = terms(query)
+    if not words:
+        return [], False
+    where, rank, join, params = match_clause(session.get_bind().dialect.name,
+                                             words)
+    conditions = [where]
+    params.update(limit=per_page + 1, offset=(page - 1) * per_page)
+    if condition:
+        conditions.append("item.condition = :condition")
+        params['condition'] = condition
+    if min_price is not None:
+        conditions.append("item.price >= :min_price")
+        params['min_price'] = float(min_price)
+    if max_price is not None:
+        conditions.append("item.price <= :max_price")
+        params['max_price'] = float(max_price)
+    if location_id is not None:
+        join += ' JOIN "user" ON "user".id = item.user_id'
+        conditions.append('"user".location_id = :location_id')
+        params['location_id'] = location_id
+    statement = text(
+        "SELECT item.id FROM item %s WHERE %s ORDER BY %s, item.id "
+        "LIMIT :limit OFFSET :offset"
+        % (join, ' AND '.join(conditions), rank))
+    ids = [row[0] for row in session.execute(statement, params)]
+    has_more = len(ids) > per_page
+    ids = ids[:per_page]
+    if not ids:
+        return [], False
+    if items is None:
+        items = session.query(Item)
+    found = dict((item.id, item) for item in items.filter(Item.id.in_(ids)))
+    return [found[item_id] for item_id in ids if item_id in found], has_more
+
+
+def parse_arguments(args):
+    """ Read the search parameters of a request's arguments.
+
+        Raises ValueError for malformed numbers.
+    """
+
+    per_page = int(args.get('per_page') or DEFAULT_PER_PAGE)
+    page = int(args.get('page') or 1)
+    if page < 1 or per_page < 1:
+        raise ValueError('page and per_page must be positive')
+    arguments = {
+        'query': args.get('q', ''),
+        'condition': args.get('condition') or None,
+        'min_price': None,
+        'max_price': None,
+        'location_id': None,
+        'page': page,
+        'per_page': min(per_page, MAX_PER_PAGE)
+    }
+    for name in ('min_price', 'max_price'):
+        if args.get(name):
+            try:
+                arguments[name] = decimal.Decimal(args[name])
+            except decimal.InvalidOperation:
+                raise ValueError('Invalid %s' % name)
+    if args.get('location_id'):
+        arguments['location_id'] = int(args['location_id'])
+    return arguments
@@ -0,0 +1,39 @@
+// Live updates pushed by the server over /events (Server-Sent Events).
+// Pages opt in with an element #unread-count (signed-in header badge)
+// and/or #listings carrying data-location-id (a location's item list).
+(function () {
+  var badge = document.getElementById('unread-count');
+  var listings = document.getElementById('listings');
+  if (!window.EventSource || (!badge && !listings)) {
+    return;
+  }
+  var url = '/events';
+  if (listings) {
+    url += '?location_id=' + encodeURIComponent(listings.getAttribute('data-location-id'));
+  }
+  var source = new EventSource(url, {withCredentials: true});
+
+  source.addEventListener('message', function (event) {
+    if (badge) {
+      badge.textContent = parseInt(badge.textContent, 10) + 1;
+    }
+  });
+
+  source.addEventListener('item', function (event) {
+    if (!listings) {
+      return;
+    }
+    var item = JSON.parse(event.data);
+    var heading = document.createElement('h3');
+    heading.className = 'item';
+    heading.textContent = item.quantity + 'x ' + item.name + ' (' + item.condition +
+      ', ' + item.cardset + ') - $' + item.price;
+    var entry = heading;
+    if (listings.getAttribute('data-link')) {
+      entry = document.createElement('a');
+      entry.href = item.url;
+      entry.appendChild(heading);
+    }
+    listings.insertBefore(entry, listings.firstChild);
+  });
+})();
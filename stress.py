@@ -0,0 +1,251 @@
+"""
+Stress test trade reservations from concurrent buyers
+
+Lists one item with --copies copies in a scratch SQLite database, or the
+database at --url, then runs --buyers threads for --seconds. Each buyer
+keeps reserving a few copies and then confirms the trade as the seller,
+releases it or leaves it to expire, while the seller keeps editing the
+price and a sweeper expires reservations. Afterwards it checks that no copy
+was lost or sold twice,
+
+    copies = quantity left + copies held + copies confirmed
+
+that the item's listing and location totals agree, and reports how many
+reservations were made or refused, how long each reservation transaction
+took and how many statements gave up waiting for a lock.
+
+Usage:
+    python stress.py [--buyers N] [--copies N] [--seconds N]
+                     [--hold SECONDS] [--url URL] [--seed N]
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from database_setup import Location, User, Item, Reservation, Listing, \
+    LocationSummary, init_db
+import engines
+import reservations
+
+
+class Stress(object):
+    """ One item being raced for by buyers, its seller and the sweeper,
+        with counts of what happened.
+    """
+
+    def __init__(self, engine, item_id, seller_id, seconds):
+        self.engine = engine
+        self.item_id = item_id
+        self.seller_id = seller_id
+        self.deadline = time.time() + seconds
+        self.counts = collections.Counter()
+        self.seconds = []
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds=None):
+        """ Count an outcome, with the time its transaction took. """
+
+        with self.lock:
+            self.counts[name] += 1
+            if seconds is not None:
+                self.seconds.append(seconds)
+
+    def buyer(self, buyer_id, rng):
+        """ Reserve copies until the deadline, settling each reservation.
+
+        """
+
+        while time.time() < self.deadline:
+            started = time.time()
+            try:
+                with self.engine.begin() as connection:
+                    reservation_id = reservations.reserve(
+                        connection, self.item_id, buyer_id, rng.randint(1, 3))
+                self.add('reserved', time.time() - started)
+                outcome = rng.choice(('confirm', 'release', 'expire'))
+                with self.engine.begin() as connection:
+                    if outcome == 'confirm':
+                        reservations.confirm(connection, reservation_id,
+                                             self.seller_id)
+                    elif outcome == 'release':
+                        reservations.release(connection, reservation_id,
+                                             buyer_id)
+                self.add(outcome)
+            except reservations.ReservationError:
+                self.add('refused', time.time() - started)
+                time.sleep(0.01)
+            except OperationalError:
+                self.add('lock timeouts')
+
+    def seller(self, rng):
+        """ Keep editing the item's price through the ORM until the
+            deadline.
+        """
+
+        session = sessionmaker(bind=self.engine)()
+        while time.time() < self.deadline:
+            try:
+                item = session.query(Item).get(self.item_id)
+                item.price = '%d.00' % rng.randint(4000, 6000)
+                session.commit()
+                self.add('edited')
+            except StaleDataError:
+                session.rollback()
+                self.add('edit conflicts')
+            except OperationalError:
+                session.rollback()
+                self.add('lock timeouts')
+            time.sleep(0.01)
+        session.close()
+
+    def sweeper(self):
+        """ Expire reservations every tenth of a second until the deadline.
+
+        """
+
+        while time.time() < self.deadline:
+            try:
+                reservations.sweep(self.engine)
+            except OperationalError:
+                self.add('lock timeouts')
+            time.sleep(0.1)
+
+    def run(self, buyer_ids, seed):
+        """ Run the buyers, the seller and the sweeper until the deadline.
+
+        """
+
+        threads = [threading.Thread(target=self.buyer, args=(
+            buyer_id, random.Random(seed + buyer_id)))
+                   for buyer_id in buyer_ids]
+        threads.append(threading.Thread(target=self.seller,
+                                        args=(random.Random(seed),)))
+        threads.append(threading.Thread(target=self.sweeper))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def report(self):
+        """ Print the counts and reservation times. """
+
+        for name, count in sorted(self.counts.items()):
+            print "%-16s %d" % (name, count)
+        if self.seconds:
+            print "reserve ms       p50 %.1f  p95 %.1f  max %.1f" % (
+                percentile(self.seconds, 0.50) * 1000,
+                percentile(self.seconds, 0.95) * 1000,
+                max(self.seconds) * 1000)
+
+
+def percentile(samples, fraction):
+    """ Nearest-rank percentile of a list of numbers. """
+
+    ordered = sorted(samples)
+    index = max(int(round(fraction * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def setup(engine, buyers, copies):
+    """ Add a location, a seller, the buyers and the item, returning the
+        ids of the item, its seller and the buyers.
+    """
+
+    session = sessionmaker(bind=engine)()
+    location = Location(name='Stress test')
+    session.add(location)
+    session.flush()
+    owner = User(email='seller@stress.test', location_id=location.id)
+    buyer_users = [User(email='buyer%d@stress.test' % number,
+                        location_id=location.id)
+                   for number in xrange(buyers)]
+    session.add_all([owner] + buyer_users)
+    session.flush()
+    item = Item(user_id=owner.id, name='Black Lotus', cardset='Alpha',
+                condition='Near Mint', price='5000.00', quantity=copies)
+    session.add(item)
+    session.commit()
+    ids = item.id, owner.id, [user.id for user in buyer_users]
+    session.close()
+    return ids
+
+
+def check(engine, item_id, copies):
+    """ List the ways the final state breaks the reservation invariants.
+
+    """
+
+    session = sessionmaker(bind=engine)()
+    item = session.query(Item).get(item_id)
+    taken = dict(session.query(Reservation.status,
+                               func.sum(Reservation.quantity))
+                 .filter(Reservation.item_id == item_id)
+                 .group_by(Reservation.status))
+    listing = session.query(Listing).get(item_id)
+    summary = session.query(LocationSummary).get(listing.location_id)
+    problems = []
+    accounted = item.quantity + (taken.get('held') or 0) + \
+        (taken.get('confirmed') or 0)
+    if accounted != copies:
+        problems.append('%d copies accounted for, %d listed'
+                        % (accounted, copies))
+    if item.quantity < 0:
+        problems.append('quantity went negative: %d' % item.quantity)
+    if listing.quantity != item.quantity:
+        problems.append('listing quantity %d, item quantity %d'
+                        % (listing.quantity, item.quantity))
+    if summary.quantity != item.quantity:
+        problems.append('location quantity %d, item quantity %d'
+                        % (summary.quantity, item.quantity))
+    session.close()
+    return problems, item.quantity, taken
+
+
+def main(argv):
+    """ Command line entry point. """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--buyers', type=int, default=8)
+    parser.add_argument('--copies', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--hold', type=int, default=1)
+    parser.add_argument('--url')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv[1:])
+    scratch = None
+    if not options.url:
+        handle, scratch = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        options.url = 'sqlite:///' + scratch
+    engine = engines.create(options.url)
+    init_db(engine)
+    reservations.HOLD_SECONDS = options.hold
+    item_id, seller_id, buyer_ids = setup(engine, options.buyers,
+                                          options.copies)
+    stress = Stress(engine, item_id, seller_id, options.seconds)
+    stress.run(buyer_ids, options.seed)
+    stress.report()
+    problems, left, taken = check(engine, item_id, options.copies)
+    print "copies left %d, held %d, confirmed %d" % (
+        left, taken.get('held') or 0, taken.get('confirmed') or 0)
+    for problem in problems:
+        print "FAILED " + problem
+    engine.dispose()
+    if scratch:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(scratch + suffix):
+                os.remove(scratch + suffix)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,332 @@
+"""
+Background tasks run after the request that queued them
+
+Routes hand slow side effects, such as revoking a token with Google or
+publishing events to the broker, to a pool of worker threads instead of
+running them before the response is sent. Work queued with after_commit()
+is only queued once the session's transaction commits, so nothing runs for
+writes that were rolled back. A task that raises is retried with
+exponential backoff, up to MAX_ATTEMPTS runs in all.
+
+Two interchangeable queues are provided. MemoryQueue holds tasks in the
+process that queued them; SqliteQueue keeps them in a SQLite file, so queued
+tasks survive a restart and the workers of any process can run them.
+"""
+
+import atexit
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from cache import SqliteFile
+from instrumentation import METRICS
+from pagination import CatalogJSONEncoder
+
+LOGGER = logging.getLogger(__name__)
+
+# Runs a task gets before it is given up on
+MAX_ATTEMPTS = 5
+
+# Seconds before the first retry, doubling with each further one
+RETRY_SECONDS = 1
+
+# Seconds an idle worker waits for a task before checking again
+POLL_SECONDS = 0.5
+
+# Seconds a SqliteQueue task stays claimed by a worker before another
+# worker may run it, in case the first one died
+CLAIM_SECONDS = 300
+
+# Tasks by name, filled by the task decorator
+TASKS = {}
+
+
+def task(function):
+    """ Decorator registering a function as a task.
+
+        Tasks are queued by name, so the module defining the task must be
+        imported by every worker process. Arguments must be JSON
+        serializable; on a SqliteQueue prices and times arrive as strings.
+    """
+
+    function.task_name = '%s.%s' % (function.__module__, function.__name__)
+    TASKS[function.task_name] = function
+    return function
+
+
+class MemoryQueue(object):
+    """ Thread-safe queue of tasks within one process. """
+
+    def __init__(self):
+        self.pending = []
+        self.ids = itertools.count(1)
+        self.ready = threading.Condition(threading.Lock())
+
+    def put(self, job, delay=0):
+        """ Queue a job to run after delay seconds. """
+
+        with self.ready:
+            if 'id' not in job:
+                job['id'] = next(self.ids)
+            heapq.heappush(self.pending, (time.time() + delay, job['id'], job))
+            self.ready.notify()
+
+    def get(self, timeout):
+        """ Next job that is due, or None if none is within timeout. """
+
+        deadline = time.time() + timeout
+        with self.ready:
+            while True:
+                now = time.time()
+                if self.pending and self.pending[0][0] <= now:
+                    return heapq.heappop(self.pending)[2]
+                if now >= deadline:
+                    return None
+                wait = deadline - now
+                if self.pending:
+                    wait = min(wait, self.pending[0][0] - now)
+                self.ready.wait(wait)
+
+    def done(self, job):
+        """ Forget a job that finished or was given up on. """
+
+    def retry(self, job, delay):
+        """ Queue a failed job again after delay seconds. """
+
+        self.put(job, delay)
+
+    def depth(self):
+        """ Number of jobs waiting to run. """
+
+        with self.ready:
+            return len(self.pending)
+
+
+class SqliteQueue(SqliteFile):
+    """ Durable queue of tasks shared between processes through a SQLite
+        file.
+
+        Workers claim a job by stamping it with a token and lease expiry in
+        one UPDATE, so no two workers run it at once, and delete it when
+        done.
+    """
+
+    def __init__(self, path):
+        SqliteFile.__init__(self, path)
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, '
+                'args TEXT NOT NULL, attempts INTEGER NOT NULL, '
+                'queued_at REAL NOT NULL, run_at REAL NOT NULL, '
+                'claim TEXT, claimed_until REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_tasks_run_at '
+                               'ON tasks (run_at)')
+
+    def put(self, job, delay=0):
+        """ Queue a job to run after delay seconds. """
+
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT INTO tasks (name, args, attempts, queued_at, run_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (job['name'], json.dumps(job['args'], cls=CatalogJSONEncoder),
+                 job['attempts'], job['queued_at'], time.time() + delay))
+
+    def get(self, timeout):
+        """ Claim the next job that is due, or None if none is within
+            timeout.
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            claim = uuid.uuid4().hex
+            now = time.time()
+            with self.connect() as connection:
+                connection.execute(
+                    'UPDATE tasks SET claim = ?, claimed_until = ? '
+                    'WHERE id = (SELECT id FROM tasks WHERE run_at <= ? '
+                    'AND (claimed_until IS NULL OR claimed_until < ?) '
+                    'ORDER BY run_at LIMIT 1)',
+                    (claim, now + CLAIM_SECONDS, now, now))
+                row = connection.execute(
+                    'SELECT id, name, args, attempts, queued_at FROM tasks '
+                    'WHERE claim = ?', (claim,)).fetchone()
+            if row is not None:
+                return {'id': row[0], 'name': row[1],
+                        'args': json.loads(row[2]), 'attempts': row[3],
+                        'queued_at': row[4]}
+            if now >= deadline:
+                return None
+            time.sleep(min(POLL_SECONDS, deadline - now))
+
+    def done(self, job):
+        """ Delete a job that finished or was given up on. """
+
+        with self.connect() as connection:
+            connection.execute('DELETE FROM tasks WHERE id = ?', (job['id'],))
+
+    def retry(self, job, delay):
+        """ Release a failed job to run again after delay seconds. """
+
+        with self.connect() as connection:
+            connection.execute(
+                'UPDATE tasks SET attempts = ?, run_at = ?, claim = NULL, '
+                'claimed_until = NULL WHERE id = ?',
+                (job['attempts'], time.time() + delay, job['id']))
+
+    def depth(self):
+        """ Number of jobs waiting to run or running. """
+
+        return self.connect().execute('SELECT COUNT(*) FROM tasks') \
+            .fetchone()[0]
+
+
+def queue_from_url(url):
+    """ Build a task queue from a URL such as memory:// or sqlite:///path.
+
+    """
+
+    if not url or url == 'memory://':
+        return MemoryQueue()
+    if url.startswith('sqlite:///'):
+        return SqliteQueue(url[len('sqlite:///'):])
+    raise ValueError('Unsupported task queue URL: %s' % url)
+
+
+class Workers(object):
+    """ Pool of daemon threads running the tasks of a queue. """
+
+    def __init__(self, tasks_queue, size):
+        self.queue = tasks_queue
+        self.size = size
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self):
+        """ Start the worker threads unless they are running already. """
+
+        with self.lock:
+            while len(self.threads) < self.size:
+                worker = threading.Thread(
+                    target=self.work,
+                    name='task-worker-%d' % len(self.threads))
+                worker.daemon = True
+                worker.start()
+                self.threads.append(worker)
+
+    def work(self):
+        """ Worker thread running jobs as they become due. """
+
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.get(POLL_SECONDS)
+                if job is not None:
+                    self.run(job)
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception('Task worker failed')
+                time.sleep(POLL_SECONDS)
+
+    def stop(self):
+        """ Stop the worker threads once they finish their current task.
+
+            Tasks still in a MemoryQueue are lost.
+        """
+
+        self.stopping.set()
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for worker in threads:
+            worker.join(POLL_SECONDS * 2)
+
+    def run(self, job):
+        """ Run one job, retrying or giving it up if it raises. """
+
+        started = time.time()
+        METRICS.observe('task_wait_seconds', started - job['queued_at'])
+        job['attempts'] += 1
+        try:
+            TASKS[job['name']](*job['args'])
+        except Exception: # pylint: disable=broad-except
+            if job['attempts'] < MAX_ATTEMPTS:
+                LOGGER.warning('Task %s failed, retrying', job['name'],
+                               exc_info=True)
+                METRICS.add('tasks_retried_total')
+                self.queue.retry(job,
+                                 RETRY_SECONDS * 2 ** (job['attempts'] - 1))
+                return
+            LOGGER.exception('Task %s failed %d times, giving up',
+                             job['name'], job['attempts'])
+            METRICS.add('tasks_failed_total')
+        else:
+            METRICS.add('tasks_completed_total')
+        finally:
+            METRICS.observe('task_run_seconds', time.time() - started)
+        self.queue.done(job)
+
+
+# Queue tasks are put on and the workers running them in this process
+QUEUE = queue_from_url(os.environ.get('TRADING_POST_TASK_QUEUE_URL'))
+WORKERS = Workers(QUEUE, int(os.environ.get('TRADING_POST_TASK_WORKERS', 2)))
+METRICS.gauge('task_queue_depth', QUEUE.depth)
+# Stopped before the interpreter tears down the modules they use
+atexit.register(WORKERS.stop)
+
+
+def enqueue(function, *args):
+    """ Queue a call of a task, starting this process's workers if needed.
+
+    """
+
+    QUEUE.put({'name': function.task_name, 'args': list(args),
+               'attempts': 0, 'queued_at': time.time()})
+    METRICS.add('tasks_queued_total')
+    WORKERS.start()
+
+
+def after_commit(session, function, *args):
+    """ Queue a call of a task once session's transaction commits. """
+
+    session.info.setdefault('pending_tasks', []).append((function, args))
+
+
+def call_after_commit(session, function, *args):
+    """ Call a function in this process once session's transaction commits,
+        for quick work that must not run in another process.
+    """
+
+    session.info.setdefault('pending_calls', []).append((function, args))
+
+
+@event.listens_for(Session, 'after_commit')
+def enqueue_pending(session):
+    """ Queue the tasks and make the calls recorded by the transaction that
+        committed.
+    """
+
+    for function, args in session.info.pop('pending_tasks', ()):
+        try:
+            enqueue(function, *args)
+        except Exception: # pylint: disable=broad-except
+            LOGGER.exception('Queueing task %s failed', function.task_name)
+    for function, args in session.info.pop('pending_calls', ()):
+        try:
+            function(*args)
+        except Exception: # pylint: disable=broad-except
+            LOGGER.exception('Calling %s after commit failed',
+                             function.__name__)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_pending(session):
+    """ Tasks and calls of a rolled back transaction are never run. """
+
+    session.info.pop('pending_tasks', None)
+    session.info.pop('pending_calls', None)